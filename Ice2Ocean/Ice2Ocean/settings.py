@@ -3,6 +3,7 @@ Django settings for Ice2Ocean project.
 """
 
 from os import path
+import tempfile
 PROJECT_ROOT = path.dirname(path.abspath(path.dirname(__file__)))
 
 DEBUG = True
@@ -30,6 +31,27 @@ DATABASES = {
     }
 }
 
+# Cached API responses go to the 'responses' cache: in production the 
+# ice2ocean blob container (see app/tools/djangocache.py); with DEBUG (for 
+# development and tests) a directory, so no storage account is needed.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'app.tools.djangocache.BlobCacheBackend',
+        'LOCATION': 'ice2ocean',
+        # Keys are versioned by the data (see app/tools/cachekeys.py), so 
+        # responses are kept until dropped.
+        'TIMEOUT': None,
+    },
+}
+if DEBUG:
+    CACHES['responses'].update({
+        'BACKEND': 'app.tools.djangocache.DirectoryCacheBackend',
+        'LOCATION': path.join(tempfile.gettempdir(), 'ice2ocean-responses'),
+    })
+
 LOGIN_URL = '/login'
 
 # Local time zone for this installation. Choices can be found here:
@@ -23,6 +23,10 @@ urlpatterns = patterns('',
     # API
     url(r'^api/music','app.api.music'),
     url(r'^api/get-raster','app.api.getraster'),
+    url(r'^api/get-aggregate','app.api.getaggregate'),
+    url(r'^api/get-zonal','app.api.getzonal'),
+    url(r'^api/get-pixel-series','app.api.getpixelseries'),
+    url(r'^api/get-tile/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)','app.api.gettile'),
     url(r'^api/get-info', 'app.api.getinfo'),
     url(r'^api/clear', 'app.api.clearservercache'),
     url(r'^api/list', 'app.api.listcache'),
@@ -60,6 +60,10 @@ def cachemon(request):
             # Stub... Kilroy
             'blobs':   b.list_blob_cache().blobs,
             'files':   b.list_local_cache(),
+            'used':    b.local_cache.total(),
+            'budget':  b.local_cache.budget,
+            'memory':  b.memory.stats(),
+            'shared':  b.shared.stats(),
             'year':    datetime.now().year,
         })
     )
\ No newline at end of file
@@ -14,12 +14,18 @@ from django.shortcuts import render
 from django.http import HttpRequest, HttpResponse, Http404, HttpResponseServerError, HttpResponseNotFound
 from django.template import RequestContext
 from django.views.decorators.cache import cache_control
+from django.core.cache import get_cache
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, quote_etag
 from django.conf import settings
 
 #### External modules
 from io import BytesIO
 import datetime
+import hashlib
 import json
+import logging
+import time
 import numpy as np
 import numpy.ma as ma
 from scipy.interpolate import interp1d
@@ -35,7 +41,17 @@ import tools.builder as b
 from settings import *
 import cannedresponses as cr
 from tools.drawing import *
-from tools.blobcache import BlobCache
+from tools.tieredcache import TieredCache, MemoryTier, DiskTier, CacheTier
+import tools.tiles as tiles
+import tools.renderpool as renderpool
+import tools.aggregate as aggregate
+import tools.prefetch as prefetch
+import tools.conditional as conditional
+import tools.cachekeys as cachekeys
+import tools.encoding as encoding
+import tools.stale as stale
+import tools.validation as validation
+from tools.singleflight import SingleFlight
 from tools.fieldtable import FieldManager
 from app.settings import *
 
@@ -44,9 +60,18 @@ from app.settings import *
 #  -- keyed by the request that generated the result.
 
 # AAA changed to ice2ocean blob storage:
-cache = BlobCache(connection_properties["STORAGE_ACCOUNT_NAME"], 
-                  connection_properties["STORAGE_ACCOUNT_KEY"], 
-                  connection_properties["STORAGE_CONTAINER"])
+# The 'responses' cache of settings.CACHES: the ice2ocean blob container 
+# (see tools/djangocache.py), or a local directory in development.
+cache = get_cache('responses')
+
+# Responses are read through (and written through) faster tiers in front of 
+# that cache: this process's memory, then local disk.
+responses = TieredCache([
+    MemoryTier(response_cache_properties['MEMORY_BYTES'], response_cache_properties['MEMORY_TTL']),
+    DiskTier(response_cache_properties['DISK_DIRECTORY'], response_cache_properties['DISK_BYTES'],
+             response_cache_properties['DISK_TTL']),
+    CacheTier(cache),
+])
 
 # Data Parameters (if we want to get at them directly)
 table_service = TableService(connection_properties["STORAGE_ACCOUNT_NAME"], 
@@ -58,6 +83,9 @@ fieldManager = FieldManager(table_service,connection_properties["FIELD_TABLE"])
 # Projection for bing maps
 bingProjection = pyproj.Proj("+init=EPSG:3857")
 
+# Parameters served from SnowModel .dat cubes (as opposed to netCDF files).
+cube_params = ('roff','prec')
+
 # time details...
 
 # AAA: modified to handle month/day data
@@ -106,6 +134,31 @@ def extract_time(request, default_value=None):
     else:
         return default_value
 
+def extract_datetime(rtime):
+    '''
+    Convert the result of extract_time to a datetime.
+
+    rtime: (year, month, day) or (year, julian hour)
+    '''
+    if len(rtime) == 3:
+        return datetime.datetime(*rtime)
+    year, hour = rtime
+    return datetime.datetime(year, 1, 1) + datetime.timedelta(hours=hour)
+
+def cube_band(header, when):
+    '''
+    The band of a cube holding the datetime when (the first band for None).
+
+    Raises NoData (see tools/validation.py) if the cube does not cover it.
+    '''
+    try:
+        band = header.band(when) if when else 0
+    except ValueError as e:
+        raise validation.NoData(str(e))
+    if header.nt is not None and band >= header.nt:
+        raise validation.NoData('{0} is past the end of the cube'.format(when))
+    return band
+
 # Note the use of builder.fetch_ds(...) ( or b.fetch_ds(...) in this file)
 #  as opposed to nc.Dataset(...) This is critical for use in azure -- 
 #  local files are not persistent.
@@ -120,8 +173,6 @@ def extract_time(request, default_value=None):
 # accidentally get skipped.
 #   - serialize the key to json
 #   - associate the key with the value in the blob cache.
-# If someone were feeling ambitious: 
-#    an azure blob storage cache driver for Django would be interesting.
 def cacheResult(key, value):
     '''
     Wrapper to formalize caching steps (so 'I' don't forget to serialize)
@@ -130,7 +181,203 @@ def cacheResult(key, value):
     value: something for the blob store.
     '''
     reqstr = json.dumps(key)
-    cache.putresponse(reqstr, value)
+    cache.set(reqstr, value)
+
+# Identical cache misses arriving together are computed once per host and
+# shared (see tools/singleflight.py).
+flight = SingleFlight()
+
+def data_version(param):
+    '''
+    The version of the data responses for param are made from: the cube's 
+    ETag (cube parameters only) and the revision of its field table row.
+    '''
+    if not param:
+        return None
+    cube = b.source_version(param)[0] if param in cube_params else None
+    return [cube, fieldManager.revision(param)]
+
+def _query(request, args):
+    query = dict(request.GET.items())
+    query.update(args)
+    return query
+
+def response_key(endpoint, request, **args):
+    '''
+    The cache key for a request to endpoint (see tools/cachekeys.py).
+
+    args: arguments that come from the url rather than the query string.
+
+    Raises Invalid (see tools/validation.py) for a request the endpoint 
+    can't serve, before anything is fetched.
+    '''
+    query = _query(request, args)
+    validation.check(endpoint, query, fieldManager.params, b.vector_tables)
+    return cachekeys.response_key(endpoint, query, data_version(query.get('param')))
+
+def latest_key(endpoint, request, **args):
+    '''
+    Where the key of the latest cached version of a request to endpoint is 
+    kept (see tools/cachekeys.py).
+    '''
+    return cachekeys.latest_key(endpoint, _query(request, args))
+
+# Stale responses are served while they are recomputed in the background 
+# (see tools/stale.py).
+refresher = stale.Refresher() if stale_properties['ENABLED'] else None
+
+def cached_body(cache_key, refresh=None, latest=None):
+    '''
+    The cached response body for cache_key, or None on a miss.
+
+    refresh: optional; recomputes and stores the body. With it a stale body
+             is returned, and refresh run in the background; without it a 
+             stale body is a miss.
+    latest:  optional; the request's latest_key. When there is nothing 
+             under cache_key, the body cached for the data it replaced is 
+             taken (as stale).
+    '''
+    entry = responses.get(cache_key)
+    current = True
+    if entry is None and refresh is not None and latest is not None:
+        previous = responses.get(latest)
+        if previous is not None and previous != cache_key:
+            entry, current = responses.get(previous), False
+    if entry is None:
+        return None
+    cached, body = stale.unstamp(entry)
+    fresh_for, stale_for = stale.window(cache_key.partition('/')[0])
+    state = stale.state(time.time() - cached, fresh_for, stale_for, current)
+    if state == stale.FRESH:
+        return body
+    if state == stale.STALE and refresh is not None and refresher is not None:
+        # Shared with identical misses, and skipped if another process has 
+        # just refreshed it.
+        refresher.schedule(cache_key, lambda: flight.do(cache_key, refresh, recheck=lambda: cached_body(cache_key)))
+        return body if current else stale.Previous(body, cached)
+    return None
+
+# Requests found to have no data are answered from memory for a while 
+# (see tools/validation.py).
+nodata = validation.NegativeCache()
+
+def no_data(cache_key):
+    '''
+    Remember that the request for cache_key has no data, and say so.
+    '''
+    nodata.add(cache_key)
+    return cr.no_data()
+
+def store(cache_key, body, content_type, latest=None):
+    '''
+    Cache a response body, compressed if it is worth it (see 
+    tools/encoding.py). Returns the body as stored.
+
+    latest: optional; the request's latest_key, pointed at cache_key.
+    '''
+    stored = encoding.pack(body, content_type, response_cache_properties['ENCODING'])
+    responses.put(cache_key, stale.stamp(stored, time.time()))
+    if latest is not None:
+        responses.put(latest, cache_key)
+    return stored
+
+def cached_response(request, stored, content_type):
+    '''
+    The response for a body as stored: sent as it is when the client's 
+    Accept-Encoding takes its encoding, decoded otherwise.
+    '''
+    body, coding = encoding.negotiate(stored, request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    response = HttpResponse(body, content_type)
+    if coding:
+        response['Content-Encoding'] = coding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if isinstance(stored, stale.Previous):
+        # Validators of its own, or a client could revalidate it against 
+        # the new data's (condition leaves headers already set alone).
+        response['ETag'] = quote_etag(conditional.strong_etag(hashlib.sha1(stored).hexdigest(), request.path,
+                                                              sorted(request.GET.lists()), accepted_encodings(request)))
+        response['Last-Modified'] = http_date(stored.cached)
+    return response
+
+def accepted_encodings(request):
+    '''
+    The stored encodings the client takes; the same body sent differently 
+    needs a different ETag.
+    '''
+    accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    return [c for c in ('br', 'gzip') if encoding.accepts(accept, c)]
+
+# Conditional requests (see tools/conditional.py): a client that already 
+# has a response gets a 304 instead of the body while what it was made 
+# from is unchanged.
+
+def cached_version(endpoint):
+    '''
+    A source for the validators of endpoint: a digest of the cached response 
+    (read through the tiers, so usually from memory), and when it was cached.
+    '''
+    def version(request):
+        entry = responses.get(response_key(endpoint, request))
+        if entry is None:
+            return None, None
+        cached, body = stale.unstamp(entry)
+        return hashlib.sha1(body).hexdigest(), datetime.datetime.utcfromtimestamp(cached)
+    return version
+
+def raster_version(request):
+    '''
+    Rasters of cube parameters change with their cube and their field table 
+    row (color limits, colormap); the rest with their cached image. No 
+    validators for a request getraster would not answer with an image.
+    '''
+    rparm = request.GET.get('param', None)
+    if rparm not in cube_params:
+        return cached_version('raster')(request)
+    if response_key('raster', request) in nodata:
+        return None, None
+    rtime = extract_time(request)
+    cube_band(b.fetch_header(rparm), extract_datetime(rtime) if rtime else None)
+    version, modified = b.source_version(rparm)
+    if version is None:
+        return None, None
+    return [version, fieldManager.getInfo(rparm).get('etag')], modified
+
+def info_version(request):
+    '''
+    The field table rows getinfo returns, by their ETags.
+    '''
+    param = request.GET.get('param', None)
+    rows = [fieldManager.getInfo(param)] if param else fieldManager.getAll()
+    return [r.get('etag') for r in rows], None
+
+raster_etag, raster_modified = conditional.validators(raster_version, accepted_encodings)
+vector_etag, vector_modified = conditional.validators(cached_version('vector'), accepted_encodings)
+timeseries_etag, timeseries_modified = conditional.validators(cached_version('timeseries'), accepted_encodings)
+info_etag, info_modified = conditional.validators(info_version)
+
+# After each raster request, what someone browsing is likely to ask for next
+# is warmed in the background (see tools/prefetch.py).
+_throttle = prefetch.Throttle(prefetch_properties['BYTES_PER_SECOND'])
+prefetcher = prefetch.Prefetcher(renderpool.warm_raster, b.warm_overviews,
+                                 busy=lambda: b.downloading() or renderpool.busy(),
+                                 start=lambda: b.set_background(_throttle),
+                                 version=b.source_version) \
+             if prefetch_properties['ENABLED'] else None
+
+def prefetch_raster(rparm, rtime, width, height):
+    '''
+    Tell the prefetcher about a raster request for a cube parameter.
+    '''
+    if prefetcher is None or rparm not in cube_params:
+        return
+    try:
+        header = b.fetch_header(rparm)
+        band = cube_band(header, extract_datetime(rtime) if rtime else None)
+        prefetcher.observe(rparm, band, cube_params,
+                           int(width) if width else None, int(height) if height else None)
+    except:
+        # Never at the expense of the request itself.
+        pass
 
 def music(request):
     '''
@@ -147,22 +394,38 @@ def music(request):
         return HttpResponseNotFound(content="You must provide a valid argument (ex. message=1) in your query string. Either the index was out of range, wasn't an integer, or it was omitted entirely.")
 
 @cache_control(must_revalidate=False, max_age=3600)
+@conditional.condition(etag_func=vector_etag, last_modified_func=vector_modified)
 def getvector(request):
     assert isinstance(request, HttpRequest)
-    json_request = json.dumps(request.GET)
+    try:
+        cache_key = response_key('vector', request)
+    except:
+        return cr.invalid_parameter()
+    if cache_key in nodata:
+        return cr.no_data()
     try:
         table = request.GET.get('table',None)
         glName = request.GET.get('name',None)
         glName += " Glacier"
-        body = cache.blobstore.get_blob_to_bytes('ice2ocean',json_request)
-        response = HttpResponse(body,'text/xml')
+        body = cached_body(cache_key)
+        if body is None:
+            raise KeyError(cache_key)
+        response = cached_response(request, body, 'text/plain')
+        return response
     except:
         try:
             if 'moderncenterlines' in table:
                 query = """SELECT ST_AsText(ST_Transform(geom,4246)) FROM %s WHERE glimsid IN (SELECT glimsid FROM modern WHERE name = '%s')""" %(table, glName)
             else:
                 query = """SELECT ST_AsText(ST_Transform(geom,4246)) FROM %s WHERE name = '%s'""" %(table, glName)
-            ds = b.fetch_query(query)
+
+            def run_query():
+                # One WKT geometry per line.
+                ds = b.fetch_query(query)
+                if ds.empty:
+                    raise validation.NoData(glName)
+                body = '\n'.join(str(wkt) for wkt in ds.iloc[:, 0])
+                return store(cache_key, body, 'text/plain')
             # Kilroy: switch to shapely
             # AAA: this is to accommodate 
  #           poly = geometry.from_wkt(ds[0][0])
@@ -171,18 +434,53 @@ def getvector(request):
  #               for i in range(0,len(e.coords),20):
  #                   lat = e.coords[i][1]
  #                   lon = e.coords[i][0]
- #           response = HttpResponse(ds[0][0],content_type = "text/plain")
- #           print 'past response'
- #           return response
-        except:
-            print ""
-            a.message
+
+            body = flight.do(cache_key, run_query, recheck=lambda: cached_body(cache_key))
+            return cached_response(request, body, 'text/plain')
+        except validation.NoData:
+            return no_data(cache_key)
+        except Exception:
+            logging.exception('getvector failed for %s', request.get_full_path())
             return cr.invalid_parameter()
 
+def timeseries_query(table, mascon, location, version, region, glacier, collection):
+    '''
+    The SQL for a gettimeseries request.
+    '''
+    if 'GRACE' in table:
+        if mascon <> None:
+            query = """SELECT main.date, SUM(main.values_filter1d * cf.correction) FROM
+                (SELECT mascon, (area_km2 / 1e5) AS correction FROM mascon_fit WHERE mascon=%s) as cf LEFT JOIN
+                (SELECT mascon, date, values_filter1d from mascon_solution where version = %s) as main
+                ON cf.mascon = main.mascon GROUP BY date ORDER BY date;""" %(mascon,version)
+        else:
+            query = """SELECT main.date, SUM(main.values_filter1d * cf.correction) FROM
+                (SELECT mascon, (area_km2 / 1e5) AS correction FROM mascon_fit WHERE region=%s) as cf LEFT JOIN
+                (SELECT mascon, date, values_filter1d from mascon_solution where version = %s) as main
+                ON cf.mascon = main.mascon GROUP BY date ORDER BY date;""" %(region,version)
+    elif 'streamgauges' in table:
+        query = """SELECT date, gaugeid, discharge FROM streamgauge_data WHERE gaugeid IN  
+                  (SELECT gaugeid from streamgauges where name ~ %s) ORDER BY date""" %(location)
+    elif 'pointbalances' in table:
+        query = """SELECT start_date, end_date, stake, elevation, balance, 
+                   ST_AsText(ST_Transform(geom,4246)) FROM point_balances 
+                   WHERE name = %s ORDER BY start_date""" %(glacier)
+    elif 'snowradar' in table:
+        query = """SELECT s.gid, s.elevation, s.geom, s.swe FROM snowradar AS s,
+                  snowradar_lines AS line WHERE line.collection = %s 
+                  AND ST_Intersects(line.geom, s.geom) ORDER BY s.elevation""" %(collection)
+    return query
+
 @cache_control(must_revalidate=False, max_age=3600)
+@conditional.condition(etag_func=timeseries_etag, last_modified_func=timeseries_modified)
 def gettimeseries(request):
     assert isinstance(request, HttpRequest)
-    json_request = json.dumps(request.GET)
+    try:
+        cache_key = response_key('timeseries', request)
+    except:
+        return cr.invalid_parameter()
+    if cache_key in nodata:
+        return cr.no_data()
     try:
         table = request.GET.get('table',None)
         mascon = request.GET.get('mascon',None)
@@ -191,52 +489,52 @@ def gettimeseries(request):
         region = request.GET.get('region',None)
         glacier = request.GET.get('glacier',None)
         collection = request.GET.get('collection',None)
-        body = cache.blobstore.get_blob_to_bytes('ice2ocean',json_request)
-        response = HttpResponse(body,'text/xml')
-    except:
-        try:
-            if 'GRACE' in table:
-                if mascon <> None:
-                    query = """SELECT main.date, SUM(main.values_filter1d * cf.correction) FROM
-                        (SELECT mascon, (area_km2 / 1e5) AS correction FROM mascon_fit WHERE mascon=%s) as cf LEFT JOIN
-                        (SELECT mascon, date, values_filter1d from mascon_solution where version = %s) as main
-                        ON cf.mascon = main.mascon GROUP BY date ORDER BY date;""" %(mascon,version)
-                else:
-                    query = """SELECT main.date, SUM(main.values_filter1d * cf.correction) FROM
-                        (SELECT mascon, (area_km2 / 1e5) AS correction FROM mascon_fit WHERE region=%s) as cf LEFT JOIN
-                        (SELECT mascon, date, values_filter1d from mascon_solution where version = %s) as main
-                        ON cf.mascon = main.mascon GROUP BY date ORDER BY date;""" %(region,version)
-            elif 'streamgauges' in table:
-                query = """SELECT date, gaugeid, discharge FROM streamgauge_data WHERE gaugeid IN  
-                          (SELECT gaugeid from streamgauges where name ~ %s) ORDER BY date""" %(location)
-            elif 'pointbalances' in table:
-                query = """SELECT start_date, end_date, stake, elevation, balance, 
-                           ST_AsText(ST_Transform(geom,4246)) FROM point_balances 
-                           WHERE name = %s ORDER BY start_date""" %(glacier)
-            elif 'snowradar' in table:
-                query = """SELECT s.gid, s.elevation, s.geom, s.swe FROM snowradar AS s,
-                          snowradar_lines AS line WHERE line.collection = %s 
-                          AND ST_Intersects(line.geom, s.geom) ORDER BY s.elevation""" %(collection)
+
+        def run_query():
+            query = timeseries_query(table, mascon, location, version, region, glacier, collection)
             print(query)
             ds = b.fetch_query(query)
-            response = HttpResponse(mimetype = 'text/csv')
-            ds.to_csv(response)
+            if ds.empty:
+                raise validation.NoData(query)
+            buf = BytesIO()
+            ds.to_csv(buf)
+            body = buf.getvalue()
+            buf.close()
+            return store(cache_key, body, 'text/csv')
+
+        # A stale series is served while it is queried again.
+        body = cached_body(cache_key, refresh=run_query)
+        if body is None:
+            raise KeyError(cache_key)
+        response = cached_response(request, body, 'text/csv')
+        return response
+    except:
+        try:
+            # Clients asking for the same series at once share one query.
+            body = flight.do(cache_key, run_query, recheck=lambda: cached_body(cache_key))
+            response = cached_response(request, body, 'text/csv')
             return response
-        except:
-            print ""
-            a.message
+        except validation.NoData:
+            return no_data(cache_key)
+        except Exception:
+            logging.exception('gettimeseries failed for %s', request.get_full_path())
             return cr.invalid_parameter()
 
-
 @cache_control(must_revalidate=False, max_age=3600)
 def gettimeseries_metadata(request):
     assert isinstance(request, HttpRequest)
-    json_request = json.dumps(request.GET)
+    try:
+        cache_key = response_key('timeseries-metadata', request)
+    except:
+        return cr.invalid_parameter()
     try:
         table = request.GET.get('table',None)
         location = request.GET.get('location',None)
-        body = cache.blobstore.get_blob_to_bytes('ice2ocean',json_request)
-        response = HttpResponse(body,'text/xml')
+        body = cached_body(cache_key)
+        if body is None:
+            raise KeyError(cache_key)
+        response = cached_response(request, body, 'text/xml')
+        return response
     except:
         try:
             if 'streamgauges' in table:
@@ -244,87 +542,79 @@ def gettimeseries_metadata(request):
             response = HttpResponse(metatext,content_type = "text/plain")
             print 'past response'
             return response
-        except:
-            print ""
-            a.message
+        except Exception:
+            logging.exception('gettimeseries_metadata failed for %s', request.get_full_path())
             return cr.invalid_parameter()
 
 @cache_control(must_revalidate=False, max_age=3600)
+@conditional.condition(etag_func=raster_etag, last_modified_func=raster_modified)
 def getraster(request):
     assert isinstance(request, HttpRequest)
-    json_request = json.dumps(request.GET)
+    try:
+        cache_key = response_key('raster', request)
+        latest = latest_key('raster', request)
+    except:
+        return cr.invalid_parameter()
+    if cache_key in nodata:
+        return cr.no_data()
     try:
         rparm = request.GET.get('param', None)
         rtime = extract_time(request)
         cmap = request.GET.get('cmap','binary')
-        body = cache.blobstore.get_blob_to_bytes('ice2ocean',json_request)
-        response = HttpResponse(body,'image/png')
+        width = request.GET.get('width', None)
+        height = request.GET.get('height', None)
+
+        def render():
+            control = fieldManager.getInfo(rparm)
+            # The cube is memory mapped as (time, ny, nx); the grid
+            # dimensions and time axis come from its .ctl descriptor.
+            header = b.fetch_header(rparm)
+            # Without a time the first band is served.
+            band = cube_band(header, extract_datetime(rtime) if rtime else None)
+            # Draw it in the render pool (reprojected to web mercator, 
+            # from the coarsest overview that still covers width/height)
+            # so the request thread never holds the GIL for the render.
+            data = renderpool.raster(rparm, band, cmap, float(control["color_min"]), float(control["color_max"]),
+                                     int(width) if width else None, int(height) if height else None,
+                                     bingProjection.srs)
+            return store(cache_key, data, 'image/png', latest)
+
+        # Until a new cube's image is drawn, the last one is served.
+        body = cached_body(cache_key, refresh=render if rparm in cube_params else None, latest=latest)
+        if body is None:
+            raise KeyError(cache_key)
+        prefetch_raster(rparm, rtime, width, height)
+        response = cached_response(request, body, 'image/png')
         return response
     except:
         try:
             ### AAA new method of extracting an image based on param 
-            if rparm in ('roff','prec'):
-                control = fieldManager.getInfo(rparm)
+            if rparm in cube_params:
                 # ds = b.fetch_ds(rparm,rtime) 
-                ds = b.fetch_ds2(rparm)
-                print ds
-                #lats = ds.variables['latitude'][:]
-                #lons = ds.variables['longitude'][:]
-                #dataField = ds.variables[control["RowKey"]][:].reshape(len(lats),len(lons))
-                #ds.close()
-                
-                # AAA leave out the reprojection for now
-                #plons,plats = bingProjection(lons,lats)
-                #plons = plons[0,:]
-                #plats = plats[:,0]
-                #print plons, plats
-               # x = np.arange(xMin, xMin + cellSize * fh.nx, cellSize)
-               # y = np.arange(yMin, yMin + cellSize * fh.ny, cellSize)
-
-                #for aRow in parfile:
-                #    if (aRow[0] != '!'):
-                #        t = aRow.split('=')[0].strip()
-                #    try:
-                #        exec(t + " = " + aRow.split('=')[1].strip())
-                #    except:
-                #        a = 1
-
-                nx = 1810
-                ny = 900
-                d = ds.reshape(-1,ny,nx)
-                subset = d[0,:,:]
-                img = subset*(subset > 0)
-                y, x = np.mgrid[0:ny,0:nx]
-                buf = BytesIO()
-                plt.imshow(img)
-                #plot_to_bytes(lons,lats,dataField,buf,float(control["color_min"]), float(control["color_max"]), cmap_name=cmap)
-                plot_to_bytes(x,y,img,buf,float(control["color_min"]), float(control["color_max"]), cmap_name=cmap)
-                buf.seek(0)
-                data = buf.read()
-                buf.close()
 
-                cache.blobstore.put_block_blob_from_bytes('ice2ocean',json_request,data)
-        
-                response = HttpResponse(data,'image/png')
+                # Identical misses share one download and render.
+                try:
+                    data = flight.do(cache_key, render, recheck=lambda: cached_body(cache_key))
+                except (renderpool.RenderBusy, renderpool.RenderTimeout):
+                    return cr.busy()
+                prefetch_raster(rparm, rtime, width, height)
+
+                response = cached_response(request, data, 'image/png')
 
             else:
                 control = fieldManager.getInfo(rparm)
 
-                ds = b.fetch_ds(rtime)
-                if not ds:
+                # The dataset handle stays in memory between requests and 
+                #  its projected coordinates are shared between the worker 
+                #  processes (see builder.fetch_coords).
+                coords = b.fetch_coords(rparm, rtime, bingProjection)
+                if coords is None:
                     oops = HttpResponseServerError()
-                    oops.content = "Unable to retrieve data for request {0}".format(json_request)
+                    oops.content = "Unable to retrieve data for request {0}".format(json.dumps(request.GET))
                     return oops
-                lats = ds.variables['lat_psi'][:]
-                lons = ds.variables['lon_psi'][:]
-
-                plons,plats = bingProjection(lons,lats)
-
-                plons = plons[0,:]
-                plats = plats[:,0]
+                plons,plats = coords
 
                 slab = depthSliceOnly(rtime,float(rdepth),control["RowKey"])[1:,1:]
-                ds.close()
 
                 buf = BytesIO()
                 plot_to_bytes(plons,plats,slab,buf,float(control["color_min"]), float(control["color_max"]),cmap_name=cmap)
@@ -332,20 +622,260 @@ def getraster(request):
                 data = buf.read()
                 buf.close()
 
-                cache.blobstore.put_block_blob_from_bytes('liveocean', json_request, data)
+                store(cache_key, data, 'image/png')
         
                 response = HttpResponse(data,'image/png')
          
             return response
-        except Exception as a:
-            try:
-                ds.close()
-            except:
-                print ""
-            a.message
+        except validation.NoData:
+            return no_data(cache_key)
+        except Exception:
+            logging.exception('getraster failed for %s', request.get_full_path())
+            return cr.invalid_parameter()
+
+@cache_control(must_revalidate=False, max_age=3600)
+def gettile(request, z, x, y):
+    '''
+    Returns a 256x256 web mercator (EPSG:3857) png tile of a cube parameter.
+
+    z, x, y: the tile address, from the url (/api/get-tile/z/x/y).
+
+    Takes the same param, time and cmap arguments as getraster. Tiles are
+    cached per (param, time, cmap, z, x, y).
+    '''
+    assert isinstance(request, HttpRequest)
+    try:
+        z, x, y = int(z), int(x), int(y)
+        rparm = request.GET.get('param', None)
+        rtime = extract_time(request)
+        cmap = request.GET.get('cmap','binary')
+        if rparm not in cube_params or not tiles.valid_tile(z, x, y):
+            return cr.invalid_parameter()
+        cache_key = response_key('tile', request, z=z, x=x, y=y)
+        latest = latest_key('tile', request, z=z, x=x, y=y)
+    except:
+        return cr.invalid_parameter()
+    if cache_key in nodata:
+        return cr.no_data()
+
+    def render():
+        control = fieldManager.getInfo(rparm)
+        header = b.fetch_header(rparm)
+        band = cube_band(header, extract_datetime(rtime) if rtime else None)
+
+        # Low zoom tiles come from the coarsest overview that still fills them.
+        bounds = tiles.tile_bounds(z, x, y)
+        # The band stays in memory for the neighbouring tiles.
+        oheader, grid = b.fetch_overview_band(rparm, band, tiles.grid_scale(header, bingProjection, bounds), header=header)
+
+        tile = tiles.sample(grid, oheader, bingProjection, bounds)
+        # Same clamping as getraster.
+        tile = tile*(tile > 0)
+
+        buf = BytesIO()
+        write_png(colorize(tile, float(control["color_min"]), float(control["color_max"]), cmap), buf)
+        data = buf.getvalue()
+        buf.close()
+
+        return store(cache_key, data, 'image/png', latest)
+
+    body = cached_body(cache_key, refresh=render, latest=latest)
+    if body is not None:
+        return cached_response(request, body, 'image/png')
+
+    try:
+        data = flight.do(cache_key, render, recheck=lambda: cached_body(cache_key))
+        return cached_response(request, data, 'image/png')
+    except validation.NoData:
+        return no_data(cache_key)
+    except Exception:
+        logging.exception('gettile failed for %s', request.get_full_path())
+        return cr.invalid_parameter()
+
+@cache_control(must_revalidate=False, max_age=3600)
+def getaggregate(request):
+    '''
+    Returns a png of a cube parameter reduced over a range of days.
+
+    param:      a cube parameter (roff, prec).
+    start, end: the first and last day, inclusive (YYYY-MM-DD).
+    op:         sum (default), mean, max or min.
+    cmap, width, height: as for getraster.
+    color_min, color_max: optional color limits. By default the parameter's
+                limits are used, multiplied by the number of days for sums.
+
+    The reduced grid is cached locally, so redrawing a range is cheap.
+    '''
+    assert isinstance(request, HttpRequest)
+    try:
+        rparm = request.GET.get('param', None)
+        start = datetime.datetime.strptime(request.GET['start'], '%Y-%m-%d')
+        end = datetime.datetime.strptime(request.GET['end'], '%Y-%m-%d')
+        op = request.GET.get('op', 'sum')
+        cmap = request.GET.get('cmap','binary')
+        width = request.GET.get('width', None)
+        height = request.GET.get('height', None)
+        width = int(width) if width else None
+        height = int(height) if height else None
+        if rparm not in cube_params or op not in aggregate.OPS or end < start:
+            return cr.invalid_parameter()
+        cache_key = response_key('aggregate', request)
+        latest = latest_key('aggregate', request)
+    except:
+        return cr.invalid_parameter()
+    if cache_key in nodata:
+        return cr.no_data()
+
+    def render():
+        control = fieldManager.getInfo(rparm)
+        header = b.fetch_header(rparm)
+        first, last = cube_band(header, start), cube_band(header, end)
+        scale = (last - first + 1) if op == 'sum' else 1
+        cmin = float(request.GET.get('color_min', float(control["color_min"]) * scale))
+        cmax = float(request.GET.get('color_max', float(control["color_max"]) * scale))
+        data = renderpool.aggregate(rparm, first, last, op, cmap, cmin, cmax, width, height, bingProjection.srs)
+        return store(cache_key, data, 'image/png', latest)
+
+    body = cached_body(cache_key, refresh=render, latest=latest)
+    if body is not None:
+        return cached_response(request, body, 'image/png')
+
+    try:
+        data = flight.do(cache_key, render, recheck=lambda: cached_body(cache_key))
+        return cached_response(request, data, 'image/png')
+    except (renderpool.RenderBusy, renderpool.RenderTimeout):
+        return cr.busy()
+    except validation.NoData:
+        return no_data(cache_key)
+    except Exception:
+        logging.exception('getaggregate failed for %s', request.get_full_path())
+        return cr.invalid_parameter()
+
+@cache_control(must_revalidate=False, max_age=3600)
+def getzonal(request):
+    '''
+    Returns daily per-zone totals of a cube parameter: how much runoff (or 
+    precipitation) each glacier or basin gets, in m^3 per day.
+
+    param:      a cube parameter (roff, prec).
+    zones:      a zone layer, glaciers (default) or basins (see zone_properties).
+    id:         optional comma separated zone ids; all zones by default.
+    start, end: the first and last day, inclusive (YYYY-MM-DD).
+    format:     csv (default; a date column then one column per zone) or 
+                json ({"zones": [{"id", "name"}], "dates": [...], 
+                "totals": [[one per zone] per date]}).
+
+    The polygons are rasterized once per grid (see tools/zonal.py).
+    '''
+    assert isinstance(request, HttpRequest)
+    try:
+        rparm = request.GET.get('param', None)
+        zoneset = request.GET.get('zones', 'glaciers')
+        ids = [z for z in request.GET.get('id', '').split(',') if z]
+        start = datetime.datetime.strptime(request.GET['start'], '%Y-%m-%d')
+        end = datetime.datetime.strptime(request.GET['end'], '%Y-%m-%d')
+        fmt = request.GET.get('format', 'csv')
+        if rparm not in cube_params or zoneset not in zone_properties or fmt not in ('csv', 'json') or end < start:
+            return cr.invalid_parameter()
+        cache_key = response_key('zonal', request)
+        latest = latest_key('zonal', request)
+    except:
+        return cr.invalid_parameter()
+    if cache_key in nodata:
+        return cr.no_data()
+
+    content_type = 'text/csv' if fmt == 'csv' else 'application/json'
+
+    def compute():
+        header = b.fetch_header(rparm)
+        first, last = cube_band(header, start), cube_band(header, end)
+        zone_ids, names, totals = renderpool.zonal(rparm, zoneset, first, last, ids or None)
+        dates = [header.when(first + i).strftime('%Y-%m-%d') for i in range(totals.shape[0])]
+        buf = BytesIO()
+        if fmt == 'csv':
+            writer = csv.writer(buf)
+            writer.writerow(['date'] + [str(z) for z in zone_ids])
+            for d, row in zip(dates, totals):
+                writer.writerow([d] + ['{0:.6g}'.format(v) for v in row])
+        else:
+            json.dump({'param': rparm,
+                       'zones': [{'id': str(z), 'name': n} for z, n in zip(zone_ids, names)],
+                       'dates': dates,
+                       'totals': totals.tolist()}, buf)
+        body = buf.getvalue()
+        return store(cache_key, body, content_type, latest)
+
+    body = cached_body(cache_key, refresh=compute, latest=latest)
+    if body is not None:
+        return cached_response(request, body, content_type)
+
+    try:
+        body = flight.do(cache_key, compute, recheck=lambda: cached_body(cache_key))
+        return cached_response(request, body, content_type)
+    except (renderpool.RenderBusy, renderpool.RenderTimeout):
+        return cr.busy()
+    except validation.NoData:
+        return no_data(cache_key)
+    except Exception:
+        logging.exception('getzonal failed for %s', request.get_full_path())
+        return cr.invalid_parameter()
+
+@cache_control(must_revalidate=False, max_age=3600)
+def getpixelseries(request):
+    '''
+    Returns the daily values of a cube parameter at a point.
+
+    param:      a cube parameter (roff, prec).
+    lat, lon:   the point; the series is that of the grid cell holding it.
+    start, end: optional first and last day, inclusive (YYYY-MM-DD); the 
+                whole cube by default.
+    format:     csv (default; date,value rows) or json ({"dates": [...], 
+                "values": [...]}). No-data days are empty (csv) or null (json).
+
+    The series comes from the cube's time-major copy (see tools/series.py), 
+    one contiguous read.
+    '''
+    assert isinstance(request, HttpRequest)
+    try:
+        rparm = request.GET.get('param', None)
+        lat = float(request.GET['lat'])
+        lon = float(request.GET['lon'])
+        start = request.GET.get('start', None)
+        end = request.GET.get('end', None)
+        start = datetime.datetime.strptime(start, '%Y-%m-%d') if start else None
+        end = datetime.datetime.strptime(end, '%Y-%m-%d') if end else None
+        fmt = request.GET.get('format', 'csv')
+        if rparm not in cube_params or fmt not in ('csv', 'json') or (start and end and end < start):
             return cr.invalid_parameter()
+    except:
+        return cr.invalid_parameter()
+
+    try:
+        header = b.fetch_header(rparm)
+        first = header.band(start) if start else 0
+        last = header.band(end) if end else None
+        header, values = b.fetch_pixel_series(rparm, lon, lat, first, last)
+    except Exception:
+        logging.exception('getpixelseries failed for %s', request.get_full_path())
+        return cr.invalid_parameter()
+
+    dates = [header.when(first + i).strftime('%Y-%m-%d') for i in range(len(values))]
+    valid = np.isfinite(values)
+    if header.undef is not None:
+        valid &= (values != header.undef)
+    buf = BytesIO()
+    if fmt == 'csv':
+        writer = csv.writer(buf)
+        writer.writerow(['date', rparm])
+        for d, v, ok in zip(dates, values, valid):
+            writer.writerow([d, '{0:.6g}'.format(v) if ok else ''])
+        return HttpResponse(buf.getvalue(),'text/csv')
+    json.dump({'param': rparm, 'lat': lat, 'lon': lon, 'dates': dates,
+               'values': [float(v) if ok else None for v, ok in zip(values, valid)]}, buf)
+    return HttpResponse(buf.getvalue(),'application/json')
 
 @cache_control(must_revalidate=True, max_age=3600)
+@conditional.condition(etag_func=info_etag, last_modified_func=info_modified)
 def getinfo(request):
     '''
     Returns parameter metadata.
@@ -360,6 +890,8 @@ def getinfo(request):
     try:
         param = request.GET.get("param",None)
         if param:
+            if param not in fieldManager.params():
+                raise Http404()
             resp = fieldManager.getInfo(param)
         else:
             resp = fieldManager.getAll()
@@ -371,14 +903,17 @@ def getinfo(request):
 def clearservercache(request):
     '''
     This is a debug request. It is dangerous. Cassandra!!
+
+    size: optional; evict the least recently used files in the local cache 
+          until it fits in this many bytes (0 empties it, bar open files).
+    responses: optional; an endpoint (raster, tile, aggregate, zonal, 
+          timeseries, vector...) whose cached responses are all dropped, 
+          from every tier.
+
+    Lists the cached files and whether each one was deleted. Only files the 
+    local cache put there are ever touched.
     '''
     assert isinstance(request, HttpRequest)
-    import tempfile, os
-    td = tempfile.gettempdir()
-    # Potential disaster here...
-    files = [ f for f in os.listdir(td) if f.endswith(".nc") ]
-    resp = []
-
     desiredSize = request.GET.get("size", None)
 
     try:
@@ -386,31 +921,20 @@ def clearservercache(request):
     except:
         desiredSize = None
 
-    for f in files:
-        path = "{0}\\{1}".format(td,f)
-        i = {
-                "file": f,
-                "size": os.path.getsize(path),
-                "deleted": "Nope."
-            }
-        try:
-            if desiredSize and i["size"] < desiredSize :
-                # and another one right here....
-                os.remove(path)
-                i["deleted"] = "Yes"
-        except Exception as a:
-            i["deleted"] = "No, {0}".format(a.message)
-        
-        resp.append(i)
+    namespace = request.GET.get("responses", None)
+    if namespace in cachekeys.ENDPOINTS:
+        responses.drop(namespace)
+        nodata.clear()
+
+    files = b.list_local_cache()
+    deleted = set(b.local_cache.evict(desiredSize)) if desiredSize is not None else set()
+    resp = [{"file": f["file"],
+             "size": f["size"],
+             "deleted": "Yes" if f["file"] in deleted else ("No, it is open" if f["pinned"] else "Nope.")}
+            for f in files]
 
     return HttpResponse(json.dumps(resp),'application/json')
 
 def listcache(request):
     assert isinstance(request, HttpRequest)
-    import tempfile, os
-    td = "{0}".format(tempfile.gettempdir())
-    files = [ {"file": f, "size": os.path.getsize("{0}\\{1}".format(td,f))} 
-                for f in os.listdir(td) 
-                    if f.endswith(".nc") ]
-
-    return HttpResponse(json.dumps(files),'text/html')
\ No newline at end of file
+    return HttpResponse(json.dumps(b.list_local_cache()),'text/html')
\ No newline at end of file
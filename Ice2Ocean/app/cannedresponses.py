@@ -16,6 +16,20 @@ def invalid_parameter():
     '''
     return HttpResponseNotFound(content="One of the parameters was invalid. Check that you're using the right datatypes.")
 
+def no_data():
+    '''
+    The request was fine, there just is no data for it.
+    '''
+    return HttpResponseNotFound(content="There is no data for that request. Check the dates and names you asked for.")
+
+def busy():
+    '''
+    The server is too busy to do the work right now. The client should retry.
+    '''
+    resp = HttpResponse(content="The server is busy drawing other images. Try again in a little while.", status=503)
+    resp['Retry-After'] = '10'
+    return resp
+
 def catastrophe():
     '''
     Use very sparingly
@@ -59,4 +59,189 @@ connection_properties = {
     'DATABASE_USER' : 'arendta',
     'DATABASE_PASSWORD' : 'glA$iEr1',
 
-}
\ No newline at end of file
+}
+
+'''
+SnowModel grid
+Used when a model output cube has no .ctl descriptor next to it.
+'''
+
+grid_properties = {
+    # Suffix of the GrADS descriptor stored alongside each .dat cube.
+    'DESCRIPTOR_SUFFIX': '.ctl',
+
+    # Grid dimensions (cells) of the Gulf of Alaska SnowModel domain.
+    'NX': 1810,
+    'NY': 900,
+
+    # The model's no-data value.
+    'UNDEF': -9999.0,
+
+    # Georeferencing of the grid, as in snowmodel.par: the projection, the
+    # coordinates of the center of the lower left cell and the cell size
+    # (metres). A descriptor with real XDEF/YDEF coordinates overrides the
+    # origin and cell size. Kilroy: check these against the current run's
+    # snowmodel.par whenever the domain changes.
+    'PROJECTION': '+init=EPSG:3338',
+    'SRID': 3338,  # the same projection, as a PostGIS SRID
+    'XMN': -233500.0,
+    'YMN': 679500.0,
+    'DELTAX': 1000.0,
+    'DELTAY': 1000.0,
+}
+
+'''
+Local cache
+Downloaded model output kept on local disk (see tools/localcache.py).
+'''
+
+cache_properties = {
+    # Where the files go; None for the system temp directory.
+    'DIRECTORY': None,
+
+    # Bytes the cached files may take up before the least recently used 
+    # ones are deleted.
+    'BUDGET_BYTES': 16 * 1024 ** 3,
+
+    # Seconds a request waits for another process's download of the same 
+    # blob before giving up.
+    'DOWNLOAD_TIMEOUT': 600,
+
+    # Seconds a cached blob is trusted before its ETag is checked again; a 
+    # blob that changed is downloaded afresh.
+    'REVALIDATE_SECONDS': 60,
+
+    # Decoded arrays (bands, coordinates) kept in memory by each process, 
+    # in bytes, and the number of open datasets kept (see tools/memorycache.py).
+    'MEMORY_BYTES': 512 * 1024 ** 2,
+    'MEMORY_HANDLES': 32,
+
+    # Decoded grids shared by all the worker processes on the host (see 
+    # tools/sharedgrids.py): where they go (None for /dev/shm, or the temp 
+    # directory without it) and the bytes kept once no process holds them.
+    'SHARED_DIRECTORY': None,
+    'SHARED_BYTES': 2 * 1024 ** 3,
+}
+
+'''
+Response cache
+Response bodies are cached in tiers (see tools/tieredcache.py): in each 
+process, on local disk, and in the 'responses' cache of CACHES in the 
+project settings (the blob cache). A TTL of None keeps a body until it is 
+pushed out; the last tier's is the TIMEOUT there.
+'''
+
+response_cache_properties = {
+    # In process: bytes of bodies kept, and seconds each is served for.
+    'MEMORY_BYTES': 64 * 1024 ** 2,
+    'MEMORY_TTL': 300,
+
+    # On local disk: where (None for a directory in the system temp 
+    # directory), bytes kept, and seconds each is served for.
+    'DISK_DIRECTORY': None,
+    'DISK_BYTES': 1024 ** 3,
+    'DISK_TTL': 24 * 3600,
+
+    # How text bodies are compressed when cached: gzip, or br (needs the 
+    # brotli module; gzip without it). See tools/encoding.py.
+    'ENCODING': 'gzip',
+}
+
+'''
+Zones
+Polygon layers in the spatial database that zonal statistics are taken 
+over (see tools/zonal.py): the table and its zone id and name columns.
+'''
+
+zone_properties = {
+    'glaciers': {'TABLE': 'modern', 'ID': 'glimsid', 'NAME': 'name'},
+    # Kilroy: confirm the basin layer's table name once it is loaded.
+    'basins': {'TABLE': 'basins', 'ID': 'gid', 'NAME': 'name'},
+}
+
+'''
+Rendering
+Rasters are drawn in a pool of worker processes (see tools/renderpool.py).
+'''
+
+render_properties = {
+    # Worker processes in the pool.
+    'PROCESSES': 2,
+
+    # Recycle each worker after this many renders (None never recycles).
+    'JOBS_PER_PROCESS': 200,
+
+    # Renders allowed to be waiting or running at once. Requests past this 
+    # are turned away (503) rather than queued.
+    'QUEUE_DEPTH': 8,
+
+    # Seconds a request waits for its render.
+    'TIMEOUT': 60,
+}
+
+'''
+Prefetching
+After a raster request, the likely next ones (neighbouring days, the other 
+parameter, overviews) are warmed in the background (see tools/prefetch.py).
+'''
+
+prefetch_properties = {
+    # Off switch.
+    'ENABLED': True,
+
+    # Background threads doing the warming.
+    'THREADS': 2,
+
+    # Predictions waiting at once; more are dropped.
+    'QUEUE_DEPTH': 32,
+
+    # Bytes per second prefetch downloads may take, all together.
+    'BYTES_PER_SECOND': 8 * 1024 ** 2,
+}
+
+'''
+Stale while revalidate
+Cached responses are fresh for a while, then stale for a while longer: a 
+stale body is still served at once while it is recomputed in the 
+background (see tools/stale.py). A response cached for older data (a cube 
+since replaced) counts as stale.
+'''
+
+stale_properties = {
+    # Off switch; stale bodies are then misses.
+    'ENABLED': True,
+
+    # Background threads doing the refreshing.
+    'THREADS': 2,
+
+    # Refreshes waiting at once; stale bodies beyond that are served again
+    # until there is room.
+    'QUEUE_DEPTH': 64,
+
+    # endpoint: (fresh, stale) seconds since the body was cached. Fresh 
+    # None is fresh as long as the data it was made from is current. 
+    # Endpoints not listed are fresh until they drop out of the cache.
+    'WINDOWS': {
+        'raster': (None, 7 * 24 * 3600),
+        'tile': (None, 7 * 24 * 3600),
+        'aggregate': (None, 7 * 24 * 3600),
+        'zonal': (None, 7 * 24 * 3600),
+        'timeseries': (3600, 7 * 24 * 3600),
+    },
+}
+
+'''
+Validation
+Requests are checked before anything is fetched (see tools/validation.py). 
+Requests found to have no data are answered from memory for a while.
+'''
+
+validation_properties = {
+    # Lists the tables get-vector may query: those with a PostGIS geometry
+    # column named geom, as its queries expect. Run once per process.
+    'VECTOR_TABLES_QUERY': "SELECT f_table_name FROM geometry_columns WHERE f_geometry_column = 'geom'",
+
+    # Seconds a request with no data is remembered, and how many are.
+    'NEGATIVE_TTL': 60,
+    'NEGATIVE_KEYS': 10000,
+}
@@ -3,8 +3,45 @@ This file demonstrates writing tests using the unittest module. These will pass
 when you run "manage.py test".
 """
 
-from django.test import TestCase
-from django.test.client import Client
+from datetime import datetime
+import base64
+import hashlib
+from io import BytesIO
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from django.test import SimpleTestCase, TestCase
+from django.test.client import Client, RequestFactory
+from django.http import HttpResponse
+from app.tools.drawing import plot_to_bytes, plt
+from app.tools.grid import GridHeader
+import app.tools.tiles as tiles
+import app.tools.overviews as overviews
+import app.tools.regrid as regrid
+import pyproj
+from app.tools.singleflight import SingleFlight
+import app.tools.renderpool as renderpool
+import app.tools.aggregate as aggregate
+import app.tools.zonal as zonal
+import app.tools.series as series
+import app.tools.compressed as compressed
+import app.tools.download as download
+from app.tools.localcache import LocalCache
+from app.tools.memorycache import MemoryCache
+from app.tools.sharedgrids import SharedGrids
+import app.tools.background as background
+import app.tools.prefetch as prefetch
+import app.tools.conditional as conditional
+from app.tools.tieredcache import TieredCache, MemoryTier, DiskTier
+import app.tools.cachekeys as cachekeys
+from app.tools.localblobs import LocalBlobService, MissingBlob
+from app.tools.djangocache import BlobCacheBackend, DirectoryCacheBackend
+import app.tools.encoding as encoding
+import app.tools.stale as stale
+import app.tools.validation as validation
+from app.tools.fieldtable import FieldManager
 
 class ViewTest(TestCase):
     """Tests for the application views."""
@@ -25,4 +62,865 @@ class ViewTest(TestCase):
     def test_about(self):
         """Tests the about page."""
         response = self.client.get('/about')
-        self.assertContains(response, 'About', 3, 200)
\ No newline at end of file
+        self.assertContains(response, 'About', 3, 200)
+
+class DrawingTest(SimpleTestCase):
+    """Tests for the lookup table renderer."""
+    def render(self, c, mode, x=None, y=None):
+        buf = BytesIO()
+        ny, nx = c.shape
+        x = np.arange(nx) if x is None else x
+        y = np.arange(ny) if y is None else y
+        plot_to_bytes(x, y, c, buf, 0.3, 7.1, cmap_name='jet', mode=mode)
+        buf.seek(0)
+        return plt.imread(buf)
+
+    def assertSameImage(self, c, x=None, y=None):
+        lut = self.render(c, 'lut', x, y)
+        mpl = self.render(c, 'matplotlib', x, y)
+        self.assertEqual(lut.shape, mpl.shape)
+        self.assertEqual(np.count_nonzero(lut != mpl), 0)
+
+    def test_matches_matplotlib(self):
+        """The lut renderer draws the same pixels as pcolormesh on the full grid."""
+        c = np.random.RandomState(0).rand(900, 1810) * 10
+        self.assertSameImage(c)
+        self.assertSameImage(c.astype(np.float32), np.linspace(-1.6e7, 1.9e7, 1810), np.linspace(-3e6, 8.1e6, 900))
+
+    def test_matches_matplotlib_meshes(self):
+        """Backwards axes, masked cells and sizes matplotlib rounds down match too."""
+        c = np.random.RandomState(1).rand(431, 255) * 10
+        self.assertSameImage(c, np.linspace(0, 1, 255), np.linspace(1, 0, 431))
+        self.assertSameImage(np.ma.masked_greater(c, 8.5), np.linspace(1, 0, 255), np.linspace(1, 0, 431))
+
+    def test_masked_cells_are_transparent(self):
+        """Masked cells have zero alpha; north is the top row."""
+        c = np.ma.masked_less(np.ones((30, 40)) * 5, 0)
+        c[-3:, :] = np.ma.masked
+        img = self.render(c, 'lut')
+        self.assertEqual(img[0, 0, 3], 0)
+        self.assertEqual(img[-1, 0, 3], 1)
+
+
+class GridHeaderTest(SimpleTestCase):
+    """Tests for reading .ctl descriptors."""
+    def test_parse(self):
+        """Dimensions, no-data value and the time axis are read."""
+        h = GridHeader.parse("DSET ^roff.dat\nUNDEF -9999.0\n"
+                             "XDEF 40 LINEAR 1 1\nYDEF 30 LINEAR 1 1\n"
+                             "TDEF 365 LINEAR 01sep1979 1dy\nOPTIONS big_endian\n")
+        self.assertEqual((h.nx, h.ny, h.nt), (40, 30, 365))
+        self.assertEqual(h.undef, -9999.0)
+        self.assertEqual(h.tstart, datetime(1979, 9, 1))
+        self.assertEqual(h.tstep, (1, 'dy'))
+        self.assertEqual(h.dtype, '>f4')
+        # Partial bands at the end of a file are ignored.
+        self.assertEqual(h.bands_in(h.bandsize * 3 + 10), 3)
+
+    def test_band_index(self):
+        """Dates map to bands along the TDEF axis and back."""
+        h = GridHeader.parse("XDEF 4 LINEAR 1 1\nYDEF 3 LINEAR 1 1\n"
+                             "TDEF 12784 LINEAR 01sep1979 1dy\n")
+        self.assertEqual(h.band(datetime(1979, 9, 1)), 0)
+        self.assertEqual(h.band(datetime(1980, 9, 1)), 366)
+        self.assertEqual(h.when(366), datetime(1980, 9, 1))
+        self.assertRaises(ValueError, h.band, datetime(1979, 8, 31))
+
+
+class TilesTest(SimpleTestCase):
+    """Tests for the web mercator tile arithmetic."""
+    def test_tile_bounds(self):
+        """Tile 0/0/0 is the whole map; 1/1/0 is its north east quarter."""
+        o = tiles.ORIGIN_SHIFT
+        self.assertEqual(tiles.tile_bounds(0, 0, 0), (-o, -o, o, o))
+        self.assertEqual(tiles.tile_bounds(1, 1, 0), (0, 0, o, o))
+        self.assertFalse(tiles.valid_tile(1, 2, 0))
+
+
+class OverviewTest(SimpleTestCase):
+    """Tests for the overview pyramid."""
+    def test_block_means_skip_nodata(self):
+        """No-data cells are left out of the block means."""
+        band = np.array([[1.0, 3.0, -9999.0, -9999.0],
+                         [-9999.0, 5.0, -9999.0, -9999.0],
+                         [2.0, 2.0, 2.0, 2.0]])
+        half, quarter = overviews.reduce_band(band, -9999.0, (2, 4))
+        self.assertEqual(half.shape, (2, 2))
+        self.assertEqual(half[0, 0], 3.0)
+        self.assertEqual(half[0, 1], -9999.0)
+        self.assertEqual(half[1, 0], 2.0)
+        self.assertAlmostEqual(quarter[0, 0], 17.0 / 7, places=5)
+
+    def test_factors_for(self):
+        """The coarsest level that still fills the output comes first."""
+        self.assertEqual(overviews.factors_for(5.3), [4, 2, 1])
+        self.assertEqual(overviews.factors_for(0.5), [1])
+
+
+class RegridTest(SimpleTestCase):
+    """Tests for the cached web mercator resampling index."""
+    def test_reproject_skips_nodata(self):
+        """A constant band stays constant; no-data cells are left out."""
+        h = GridHeader(40, 30, 1, undef=-9999.0, xdef=(0.0, 1000.0), ydef=(1000000.0, 1000.0))
+        band = np.ones((30, 40), dtype=np.float32) * 3
+        band[10:20, 10:20] = -9999.0
+        mercator = pyproj.Proj("+init=EPSG:3857")
+        bounds = regrid.mercator_bounds(h, mercator)
+        index = regrid.RegridIndex.build(h, mercator, bounds, 40, 30)
+        out = index.apply(band, h.undef)
+        self.assertEqual(out.shape, (30, 40))
+        self.assertTrue(np.allclose(out.compressed(), 3))
+        self.assertTrue(0 < out.mask.mean() < 1)
+
+    def test_index_files(self):
+        """Whole grid indexes go to the local cache; tile indexes stay in memory."""
+        h = GridHeader(40, 30, 1, xdef=(0.0, 1000.0), ydef=(1000000.0, 1000.0))
+        mercator = pyproj.Proj("+init=EPSG:3857")
+        bounds = regrid.mercator_bounds(h, mercator)
+        files = LocalCache(tempfile.mkdtemp(), budget=10 ** 8)
+        index = regrid.get_index(h, mercator, bounds, 40, 30, files=files)
+        regrid.get_index(h, mercator, bounds, 20, 15, method='nearest')
+        self.assertEqual(len(files.listing()), 1)
+        regrid._indexes.clear()
+        self.assertTrue(np.array_equal(regrid.get_index(h, mercator, bounds, 40, 30, files=files).cells, index.cells))
+
+
+class SingleFlightTest(SimpleTestCase):
+    """Tests for coalescing identical work."""
+    def test_concurrent_calls_share_one_result(self):
+        """Only the first caller for a key does the work."""
+        flight = SingleFlight(lockdir=tempfile.mkdtemp())
+        calls = []
+        started = threading.Event()
+
+        def work():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return 'png'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', work)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', work))) for i in range(4)]
+        for t in followers:
+            t.start()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['png'] * 5)
+
+    def test_recheck_skips_work(self):
+        """A result published by another process is picked up."""
+        flight = SingleFlight(lockdir=tempfile.mkdtemp())
+        self.assertEqual(flight.do('key', lambda: 'new', recheck=lambda: 'published'), 'published')
+        self.assertEqual(flight.do('key', lambda: 'new', recheck=lambda: None), 'new')
+
+
+# Jobs for the render pool; module level, as they are pickled by name.
+def render_sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def render_fail():
+    raise ValueError('no such band')
+
+def render_die():
+    os._exit(1)
+
+class RenderPoolTest(SimpleTestCase):
+    """Tests for the render pool's bounds and failures."""
+    def assertFree(self):
+        self.assertFalse(renderpool.busy())
+        depth = renderpool.render_properties['QUEUE_DEPTH']
+        taken = [renderpool._slots.acquire(False) for i in range(depth)]
+        for t in taken:
+            if t:
+                renderpool._slots.release()
+        self.assertTrue(all(taken))
+
+    def test_results_and_errors(self):
+        """Results come back; a failing job raises RenderError and frees its slot."""
+        self.assertEqual(renderpool.submit(render_sleep, 0), 0)
+        self.assertRaises(renderpool.RenderError, renderpool.submit, render_fail)
+        self.assertFree()
+
+    def test_busy(self):
+        """With every slot taken, more work is turned away."""
+        depth = renderpool.render_properties['QUEUE_DEPTH']
+        for i in range(depth):
+            renderpool._slots.acquire(False)
+        try:
+            self.assertRaises(renderpool.RenderBusy, renderpool.submit, render_sleep, 0)
+        finally:
+            for i in range(depth):
+                renderpool._slots.release()
+        self.assertFree()
+
+    def test_timeout_and_dead_worker(self):
+        """Jobs past their timeout, lost with their worker or not, free their slot."""
+        pool = renderpool._get_pool()
+        self.assertRaises(renderpool.RenderTimeout, renderpool.submit, render_sleep, 5, timeout=0.1)
+        self.assertFree()
+        for i in range(renderpool.render_properties['PROCESSES'] - 1):
+            self.assertRaises(renderpool.RenderTimeout, renderpool.submit, render_die, timeout=0.5)
+            self.assertFree()
+        # As many overdue jobs as workers: the pool is replaced.
+        self.assertIsNot(renderpool._get_pool(), pool)
+        self.assertEqual(renderpool.submit(render_sleep, 0), 0)
+
+class AggregateTest(SimpleTestCase):
+    """Tests for reducing a cube over a range of days."""
+    def test_reductions_skip_nodata(self):
+        """Chunked sums, means and maxima leave no-data cells out."""
+        cube = np.arange(2 * 3 * 10, dtype=np.float32).reshape(10, 2, 3)
+        cube[4, 0, 0] = -9999.0
+        cube[:, 1, 2] = -9999.0
+        total = aggregate.reduce_bands(cube, 2, 8, 'sum', -9999.0, chunk=3)
+        self.assertEqual(total[0, 1], cube[2:9, 0, 1].sum())
+        self.assertEqual(total[0, 0], cube[2:9, 0, 0].sum() + 9999.0)
+        self.assertEqual(total[1, 2], -9999.0)
+        mean = aggregate.reduce_bands(cube, 2, 8, 'mean', -9999.0, chunk=3)
+        self.assertAlmostEqual(mean[0, 0], (cube[2:9, 0, 0].sum() + 9999.0) / 6, places=4)
+        peak = aggregate.reduce_bands(cube, 0, 9, 'max', -9999.0, chunk=4)
+        self.assertEqual(peak[1, 1], cube[9, 1, 1])
+        self.assertRaises(IndexError, aggregate.reduce_bands, cube, 5, 10)
+
+class ZonalTest(SimpleTestCase):
+    """Tests for per-zone totals over polygons."""
+    def test_zone_totals(self):
+        """Partly covered cells are weighted by the area inside the polygon."""
+        header = GridHeader(4, 3, 5, undef=-9999.0, xdef=(0.0, 10.0), ydef=(0.0, 10.0))
+        # Covers cells (col 0..1, row 0) fully and half of (col 2, row 0),
+        # with a hole over nothing but cell (col 0, row 2).
+        square = 'POLYGON((-5 -5,20 -5,20 5,-5 5,-5 -5))'
+        holed = 'MULTIPOLYGON(((-5 15,15 15,15 25,-5 25,-5 15),(-5 15,5 15,5 25,-5 25,-5 15)),((25 5,35 5,35 15,25 15,25 5)))'
+        matrix = zonal.zone_matrix([square, holed], header)
+        self.assertEqual(matrix.shape, (12, 2))
+        self.assertAlmostEqual(matrix[0, 0], 100.0)
+        self.assertAlmostEqual(matrix[2, 0], 50.0)
+        self.assertAlmostEqual(matrix[8, 1], 0.0)
+        self.assertAlmostEqual(matrix[9, 1], 100.0)
+        self.assertAlmostEqual(matrix[7, 1], 100.0)
+
+        cube = np.ones((5, 3, 4), dtype=np.float32)
+        cube[2] = 2.0
+        cube[:, 0, 1] = -9999.0
+        totals = zonal.zone_totals(cube, matrix, 1, 3, header.undef, chunk=2)
+        self.assertEqual(totals.shape, (3, 2))
+        self.assertAlmostEqual(totals[1, 0], 2.0 * 150.0)
+        self.assertAlmostEqual(totals[0, 1], 200.0)
+
+class SeriesTest(SimpleTestCase):
+    """Tests for the time-major copy of a cube."""
+    def test_transpose_in_blocks(self):
+        """Each cell's history comes back from the copy in one read."""
+        header = GridHeader(5, 3, 7)
+        cube = np.arange(7 * 3 * 5, dtype=np.float32).reshape(7, 3, 5)
+        path = tempfile.mktemp(suffix='.ts.dat')
+        # A budget of two rows per block, so the last block is partial.
+        series.build_series(cube, header, path, block_bytes=2 * 7 * 5 * 4)
+        copy = series.open_series(header, path, os.path.getsize(path))
+        self.assertEqual(copy.shape, (3, 5, 7))
+        np.testing.assert_array_equal(series.read_series(copy, 4, 2, 0, 6), cube[:, 2, 4])
+        np.testing.assert_array_equal(series.read_series(copy, 1, 0, 2, 3), cube[2:4, 0, 1])
+        self.assertRaises(IndexError, series.read_series, copy, 0, 0, 3, 7)
+        del copy
+        os.remove(path)
+
+class CompressedTest(SimpleTestCase):
+    """Tests for the chunked, compressed cube container."""
+    def test_round_trip(self):
+        """Slices of the container match the raw cube, no-data included."""
+        header = GridHeader(150, 70, 11, undef=-9999.0)
+        cube = np.random.rand(11, 70, 150).astype(np.float32)
+        cube[9, 3, 4] = -9999.0
+        path = tempfile.mktemp(suffix='.z.nc')
+        compressed.convert_cube(cube, header, path, chunks=(4, 32, 64))
+        var = compressed.open_cube(path)
+        self.assertEqual(var.shape, cube.shape)
+        self.assertEqual(tuple(var.chunking()), (4, 32, 64))
+        np.testing.assert_array_equal(var[9], cube[9])
+        np.testing.assert_array_equal(var[2:10, 5, :], cube[2:10, 5, :])
+        self.assertEqual(var[9, 3, 4], -9999.0)
+        self.assertEqual(compressed.compressed_name('roff.dat'), 'roff.z.nc')
+        self.assertEqual(compressed.compressed_name('roff_2014_1_1.nc'), 'roff_2014_1_1.z.nc')
+        var.group().close()
+        os.remove(path)
+
+class FakeBlobService(object):
+    """Serves one blob from memory, failing the range reads listed in fail."""
+    def __init__(self, data, md5=None, fail=()):
+        self.data = data
+        self.md5 = md5
+        self.fail = list(fail)
+        self.reads = []
+
+    def get_blob_properties(self, container, name):
+        return {'content-length': str(len(self.data)), 'etag': '"1"', 'content-md5': self.md5}
+
+    def get_blob(self, container, name, x_ms_range=None):
+        start, end = [int(v) for v in x_ms_range[len('bytes='):].split('-')]
+        self.reads.append(start)
+        if start in self.fail:
+            self.fail.remove(start)
+            raise IOError('connection reset')
+        return self.data[start:end + 1]
+
+class DownloadTest(SimpleTestCase):
+    """Tests for parallel ranged blob downloads."""
+    def setUp(self):
+        self.data = np.random.bytes(1000)
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        for p in (self.path, self.path + '.part', self.path + '.part.json'):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def test_retry_and_resume(self):
+        """Failed ranges are retried alone; a resumed download skips done ranges."""
+        service = FakeBlobService(self.data, fail=[300, 300, 300])
+        self.assertRaises(download.DownloadError, download.download, service, 'c', 'b', self.path,
+                          range_bytes=100, threads=1, retries=3)
+        self.assertFalse(os.path.exists(self.path))
+        service.reads = []
+        download.download(service, 'c', 'b', self.path, range_bytes=100, threads=4)
+        self.assertEqual(sorted(service.reads), [300, 400, 500, 600, 700, 800, 900])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_checksum(self):
+        """A download that does not match Content-MD5 never reaches the cache."""
+        service = FakeBlobService(self.data, base64.b64encode(hashlib.md5(b'other').digest()))
+        self.assertRaises(download.DownloadError, download.download, service, 'c', 'b', self.path, range_bytes=64)
+        self.assertFalse(os.path.exists(self.path))
+        service.md5 = base64.b64encode(hashlib.md5(self.data).digest())
+        download.download(service, 'c', 'b', self.path, range_bytes=64)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_cancel(self):
+        """A cancelled download keeps its ranges for the next one."""
+        service = FakeBlobService(self.data)
+        self.assertRaises(download.DownloadCancelled, download.download, service, 'c', 'b', self.path,
+                          range_bytes=100, threads=1, cancel=lambda: len(service.reads) >= 3)
+        self.assertFalse(os.path.exists(self.path))
+        service.reads = []
+        download.download(service, 'c', 'b', self.path, range_bytes=100)
+        self.assertEqual(sorted(service.reads), [300, 400, 500, 600, 700, 800, 900])
+
+class LocalCacheTest(SimpleTestCase):
+    """Tests for the size bounded local file cache."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def put(self, cache, name, size):
+        def write(path, heartbeat):
+            with open(path, 'wb') as f:
+                f.write(b'x' * size)
+        return cache.fetch(name, write)
+
+    def test_lru_eviction(self):
+        """The least recently used unpinned files go first, other files never."""
+        with open(os.path.join(self.directory, 'other.nc'), 'wb') as f:
+            f.write(b'x' * 1000)
+        cache = LocalCache(self.directory, budget=300)
+        for name in ('a', 'b', 'c'):
+            self.put(cache, name, 100)
+            time.sleep(0.01)
+        cache.get('a')
+        owner = np.zeros(1)
+        cache.pin('b', owner)
+        self.put(cache, 'd', 100)
+        self.assertEqual(sorted(f['file'] for f in cache.listing()), ['a', 'b', 'd'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'other.nc')))
+        del owner
+        self.assertEqual(cache.evict(200), ['b'])
+        self.assertEqual(cache.total(), 200)
+
+    def test_index_survives_restart(self):
+        """A new cache picks its entries up from the index file."""
+        cache = LocalCache(self.directory, budget=1000)
+        self.put(cache, 'a', 10)
+        self.assertEqual(LocalCache(self.directory, budget=1000).listing()[0]['file'], 'a')
+
+    def test_one_download_per_host(self):
+        """Concurrent misses for a file download it once; the rest wait."""
+        cache = LocalCache(self.directory, budget=1000)
+        other = LocalCache(self.directory, budget=1000)
+        downloads = []
+        def write(path, heartbeat):
+            downloads.append(path)
+            time.sleep(0.2)
+            heartbeat()
+            with open(path, 'wb') as f:
+                f.write(b'x' * 10)
+            return '"etag"'
+        threads = [threading.Thread(target=c.fetch, args=('a', write)) for c in (cache, other, cache)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(downloads), 1)
+        self.assertEqual(other.version('a'), '"etag"')
+
+    def test_written_aside(self):
+        """Nobody finds a file under its name until it has been written."""
+        cache = LocalCache(self.directory, budget=1000)
+        seen = []
+        def write(path, heartbeat):
+            with open(path, 'wb') as f:
+                f.write(b'x' * 10)
+            seen.append((path, cache.get('a.npz')))
+        path = cache.fetch('a.npz', write)
+        self.assertEqual(seen, [(cache.partial_path('a.npz'), None)])
+        self.assertTrue(seen[0][0].endswith('.npz'))
+        self.assertEqual(os.path.getsize(path), 10)
+        self.assertFalse(os.path.exists(cache.partial_path('a.npz')))
+
+    def test_request_preempts_prefetch(self):
+        """A request waiting on a prefetch's download makes it give way."""
+        cache = LocalCache(self.directory, budget=1000)
+        started = threading.Event()
+        outcome = []
+        def prefetch(path, heartbeat):
+            started.set()
+            while not cache.wanted('a'):
+                time.sleep(0.01)
+            raise download.DownloadCancelled('a')
+        def background():
+            try:
+                cache.fetch('a', prefetch, background=True)
+            except download.DownloadCancelled:
+                outcome.append('cancelled')
+        t = threading.Thread(target=background)
+        t.start()
+        started.wait()
+        def write(path, heartbeat):
+            with open(path, 'wb') as f:
+                f.write(b'x' * 10)
+        start = time.time()
+        cache.fetch('a', write, timeout=5)
+        t.join()
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(outcome, ['cancelled'])
+        self.assertFalse(cache.wanted('a'))
+
+class MemoryCacheTest(SimpleTestCase):
+    """Tests for the in-process cache of arrays and handles."""
+    def test_budget_and_versions(self):
+        """Arrays are evicted by exact size, and a new blob version drops the old."""
+        memory = MemoryCache(budget=1000, max_handles=1)
+        memory.put(('roff.dat', '"1"', 'band', 0), np.zeros(100, dtype=np.float32))
+        memory.put(('roff.dat', '"1"', 'band', 1), np.zeros(100, dtype=np.float32))
+        self.assertEqual(memory.stats()['bytes'], 800)
+        memory.get(('roff.dat', '"1"', 'band', 0))
+        memory.put(('prec.dat', '"1"', 'band', 0), np.zeros(60, dtype=np.float32))
+        self.assertIsNone(memory.get(('roff.dat', '"1"', 'band', 1)))
+        self.assertEqual(memory.stats()['bytes'], 640)
+
+        memory.put(('roff.dat', '"1"', 'handle'), object())
+        memory.put(('prec.dat', '"1"', 'handle'), object())
+        self.assertEqual(memory.stats()['handles'], 1)
+
+        memory.put(('roff.dat', '"2"', 'band', 0), np.zeros(10, dtype=np.float32))
+        self.assertIsNone(memory.get(('roff.dat', '"1"', 'band', 0)))
+        stats = memory.stats()
+        self.assertEqual(stats['bytes'], 280)
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 2, 2))
+
+class SharedGridsTest(SimpleTestCase):
+    """Tests for the host wide store of decoded grids."""
+    def test_build_once_and_sweep(self):
+        """A grid is built once, attached read-only, and swept once released."""
+        directory = tempfile.mkdtemp()
+        one = SharedGrids(directory, budget=0)
+        other = SharedGrids(directory, budget=0)
+        builds = []
+        def build():
+            builds.append(1)
+            return np.arange(12, dtype=np.float32).reshape(3, 4)
+        grid = one.get('roff band 3', build)
+        again = other.get('roff band 3', build)
+        self.assertEqual(len(builds), 1)
+        np.testing.assert_array_equal(again, grid)
+        self.assertFalse(again.flags.writeable)
+        # Held by this (live) process, so it survives a sweep.
+        self.assertEqual(one.sweep(), 0)
+        one.release_all()
+        other.release_all()
+        self.assertEqual(one.sweep(), 1)
+        self.assertEqual(one.stats()['bytes'], 0)
+
+class BackgroundTest(SimpleTestCase):
+    """Tests for the background workers."""
+    def test_workers(self):
+        """Work is queued once per key, dropped when the queue is full."""
+        gate = threading.Event()
+        ran = []
+        def run(work):
+            gate.wait()
+            if work == 'bad':
+                raise ValueError(work)
+            ran.append(work)
+        workers = background.Workers(run, 1, 2, keep=lambda key: key in ('once', 'bad'))
+        self.assertEqual(workers.threads, [])
+        self.assertTrue(workers.submit('once'))
+        time.sleep(0.1)
+        self.assertTrue(workers.submit('bad'))
+        self.assertFalse(workers.submit('bad'))
+        self.assertTrue(workers.submit('b', key='k'))
+        self.assertFalse(workers.submit('c'))
+        self.assertEqual(len(workers.threads), 1)
+        gate.set()
+        workers.join()
+        self.assertFalse(workers.submit('once'))
+        self.assertTrue(workers.submit('b', key='k'))
+        self.assertTrue(workers.submit('bad'))
+        workers.join()
+        self.assertEqual(ran, ['once', 'b', 'b'])
+        self.assertEqual(workers.stats(), {'done': 3, 'failed': 2, 'dropped': 1,
+                                           'queued': 0, 'pending': 1})
+
+class PrefetchTest(SimpleTestCase):
+    """Tests for predictive prefetching."""
+    def test_predict(self):
+        """Predictions follow the direction of stepping, then the siblings."""
+        self.assertEqual(prefetch.predict(4, 'roff', 5, ('roff', 'prec')),
+                         [('roff', 6), ('roff', 7), ('prec', 5)])
+        self.assertEqual(prefetch.predict(5, 'roff', 4, ()), [('roff', 3), ('roff', 2)])
+        self.assertEqual(prefetch.predict(None, 'roff', 0, ()), [('roff', 1)])
+
+    def test_throttle(self):
+        """A throttled transfer is held to its rate, resumed bytes aside."""
+        progress = prefetch.Throttle(1000).callback()
+        start = time.time()
+        progress(5000, 5300)
+        progress(5300, 5300)
+        self.assertTrue(0.25 < time.time() - start < 1)
+
+    def test_prefetcher(self):
+        """Predictions are warmed once, after foreground work is done."""
+        busy = [True]
+        warmed = []
+        version = ['"1"']
+        fetcher = prefetch.Prefetcher(lambda *args: warmed.append(args),
+                                      lambda param: warmed.append(param),
+                                      busy=lambda: busy[0], threads=1, depth=8,
+                                      version=lambda param: version[0])
+        fetcher.observe('roff', 4, ('roff', 'prec'), 800, 600)
+        fetcher.observe('roff', 4, ('roff', 'prec'), 800, 600)
+        time.sleep(0.2)
+        self.assertEqual(warmed, [])
+        busy[0] = False
+        fetcher.workers.join()
+        self.assertEqual(warmed, ['roff', ('roff', 5, 800, 600), ('roff', 3, 800, 600),
+                                  ('prec', 4, 800, 600)])
+        self.assertEqual(fetcher.stats()['warmed'], 4)
+        fetcher.observe('prec', 4)
+        version[0] = '"2"'
+        fetcher.observe('roff', 6)
+        fetcher.workers.join()
+        self.assertEqual(warmed.count('prec'), 1)
+        self.assertEqual(warmed.count('roff'), 2)
+
+class FakeQuery(dict):
+    """Just enough of a QueryDict for the validators."""
+    def lists(self):
+        return [(k, [v]) for k, v in self.items()]
+
+class FakeRequest(object):
+    def __init__(self, path, **args):
+        self.path = path
+        self.GET = FakeQuery(args)
+
+class ConditionalTest(SimpleTestCase):
+    """Tests for the conditional request validators."""
+    def test_http_date(self):
+        """Blob service dates become naive UTC datetimes."""
+        self.assertEqual(conditional.http_date('Wed, 21 Oct 2015 07:28:00 GMT'),
+                         datetime(2015, 10, 21, 7, 28))
+        self.assertIsNone(conditional.http_date(None))
+        self.assertIsNone(conditional.http_date('yesterday'))
+
+    def test_validators(self):
+        """The ETag follows the source version and the arguments; lookups happen once."""
+        versions = {'roff': '"0x1"', 'prec': '"0x2"'}
+        calls = []
+        def source(request):
+            calls.append(1)
+            return versions[request.GET['param']], datetime(2015, 10, 21)
+        etag_func, modified_func = conditional.validators(source)
+
+        request = FakeRequest('/api/get-raster', param='roff', day='1')
+        etag = etag_func(request)
+        self.assertEqual(modified_func(request), datetime(2015, 10, 21))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(etag_func(FakeRequest('/api/get-raster', day='1', param='roff')), etag)
+        self.assertNotEqual(etag_func(FakeRequest('/api/get-raster', param='roff', day='2')), etag)
+        versions['roff'] = '"0x3"'
+        self.assertNotEqual(etag_func(FakeRequest('/api/get-raster', param='roff', day='1')), etag)
+        # No source, no validators.
+        self.assertIsNone(etag_func(FakeRequest('/api/get-raster', param='snow')))
+
+    def test_condition(self):
+        """Only responses that succeeded keep their validators."""
+        status = [200]
+        @conditional.condition(etag_func=lambda request: 'abc',
+                               last_modified_func=lambda request: datetime(2015, 10, 21))
+        def view(request):
+            return HttpResponse('body', status=status[0])
+        self.assertEqual(view(RequestFactory().get('/api/get-raster'))['ETag'], '"abc"')
+        response = view(RequestFactory().get('/api/get-raster', HTTP_IF_NONE_MATCH='"abc"'))
+        self.assertEqual((response.status_code, response['ETag']), (304, '"abc"'))
+        for status[0] in (404, 503):
+            response = view(RequestFactory().get('/api/get-raster'))
+            self.assertFalse(response.has_header('ETag') or response.has_header('Last-Modified'))
+
+class BrokenTier(object):
+    """A tier whose service is down."""
+    name = 'broken'
+    def get(self, key):
+        raise IOError('down')
+    def put(self, key, value):
+        raise IOError('down')
+    def delete(self, key):
+        raise IOError('down')
+
+class TieredCacheTest(SimpleTestCase):
+    """Tests for the tiered response cache."""
+    def test_read_through(self):
+        """A hit in a slow tier is copied into the faster ones."""
+        memory = MemoryTier(100)
+        disk = DiskTier(tempfile.mkdtemp(), budget=1000)
+        durable = MemoryTier(1000)
+        responses = TieredCache([memory, disk, durable])
+        durable.put('{"param": "roff"}', b'png')
+        self.assertEqual(responses['{"param": "roff"}'], b'png')
+        self.assertEqual(memory.get('{"param": "roff"}'), b'png')
+        self.assertEqual(disk.get('{"param": "roff"}'), b'png')
+        self.assertEqual([(t['hits'], t['misses']) for t in responses.stats()], [(0, 1), (0, 1), (1, 0)])
+        self.assertRaises(KeyError, lambda: responses['{"param": "prec"}'])
+
+    def test_write_through_and_ttl(self):
+        """Writes reach every tier; expired entries and failing tiers are passed over."""
+        memory = MemoryTier(100, ttl=0)
+        disk = DiskTier(tempfile.mkdtemp(), budget=1000)
+        responses = TieredCache([memory, BrokenTier(), disk])
+        responses.put('k', b'body')
+        time.sleep(0.01)
+        self.assertIsNone(memory.get('k'))
+        self.assertEqual(responses.get('k'), b'body')
+        stats = responses.stats()
+        # The write, the read, and copying the disk hit back up.
+        self.assertEqual(stats[1]['errors'], 3)
+        self.assertEqual(stats[2]['hits'], 1)
+        responses.invalidate('k')
+        self.assertIsNone(responses.get('k'))
+
+    def test_memory_budget(self):
+        """The memory tier drops the least recently used bodies past its budget."""
+        memory = MemoryTier(10)
+        memory.put('a', b'12345')
+        memory.put('b', b'12345')
+        memory.get('a')
+        memory.put('c', b'12345')
+        self.assertIsNone(memory.get('b'))
+        self.assertEqual(memory.get('a'), b'12345')
+        memory.put('huge', b'x' * 11)
+        self.assertIsNone(memory.get('huge'))
+
+class CacheKeysTest(SimpleTestCase):
+    """Tests for canonical response cache keys."""
+    def test_canonical(self):
+        """Order, ignored arguments, defaults and number formats don't change the key."""
+        key = cachekeys.response_key('raster', {'param': 'roff', 'year': '2010', 'month': '6', 'day': '1'}, ['"0x1"', 'r1'])
+        self.assertEqual(cachekeys.response_key('raster', {'day': '01', 'month': '06', 'year': '2010', 'param': 'roff',
+                                                           'cmap': 'binary', '_': '1445412345'}, ['"0x1"', 'r1']), key)
+        self.assertTrue(key.startswith('raster/'))
+        self.assertEqual(len(key), len('raster/') + 40)
+        self.assertEqual(cachekeys.canonical('zonal', {'id': 'b, a,a', 'start': '2010-6-1'}),
+                         [('format', 'csv'), ('id', 'a,b'), ('start', '2010-06-01'), ('zones', 'glaciers')])
+        self.assertRaises(ValueError, cachekeys.canonical, 'raster', {'width': 'wide'})
+
+    def test_versioned(self):
+        """New data, other endpoints and other arguments make other keys."""
+        args = {'param': 'roff', 'day': '1', 'month': '6', 'year': '2010'}
+        key = cachekeys.response_key('raster', args, ['"0x1"', 'r1'])
+        self.assertNotEqual(cachekeys.response_key('raster', args, ['"0x2"', 'r1']), key)
+        self.assertNotEqual(cachekeys.response_key('raster', dict(args, day='2'), ['"0x1"', 'r1']), key)
+        self.assertNotEqual(cachekeys.response_key('tile', args, ['"0x1"', 'r1']), key)
+
+    def test_blob_name(self):
+        """Keys pass through as blob names; other strings are hashed."""
+        key = cachekeys.response_key('vector', {'table': 'modern', 'name': 'Columbia'})
+        self.assertEqual(cachekeys.blob_name(key), key)
+        self.assertEqual(len(cachekeys.blob_name('{"anything": [1, 2]}')), len('misc/') + 40)
+
+    def test_drop_namespace(self):
+        """A whole endpoint's responses are dropped from every tier at once."""
+        memory = MemoryTier(1000)
+        disk = DiskTier(tempfile.mkdtemp(), budget=1000)
+        responses = TieredCache([memory, disk])
+        raster = cachekeys.response_key('raster', {'param': 'roff'})
+        vector = cachekeys.response_key('vector', {'table': 'modern'})
+        responses.put(raster, b'png')
+        responses.put(vector, b'xml')
+        responses.drop('raster')
+        self.assertIsNone(memory.get(raster))
+        self.assertIsNone(disk.get(raster))
+        self.assertEqual(responses.get(vector), b'xml')
+        self.assertEqual(disk.get(vector), b'xml')
+
+class LocalBlobsTest(SimpleTestCase):
+    """Tests for the local stand-in for the blob service."""
+    def test_blobs(self):
+        """Blobs keep their bytes and metadata, list by prefix and delete."""
+        blobs = LocalBlobService(tempfile.mkdtemp())
+        blobs.create_container('cache')
+        blobs.put_block_blob_from_bytes('cache', 'v1/raster/abc', b'png', x_ms_meta_name_values={'expires': '12.5'})
+        blobs.put_block_blob_from_bytes('cache', 'v1/vector/def', b'xml')
+        blob = blobs.get_blob('cache', 'v1/raster/abc')
+        self.assertEqual(bytes(blob), b'png')
+        self.assertEqual(blob.properties['x-ms-meta-expires'], '12.5')
+        self.assertEqual(blob.properties['content-length'], '3')
+        self.assertEqual([b.name for b in blobs.list_blobs('cache', prefix='v1/raster/').blobs], ['v1/raster/abc'])
+        blobs.delete_blob('cache', 'v1/raster/abc')
+        self.assertRaises(MissingBlob, blobs.get_blob_to_bytes, 'cache', 'v1/raster/abc')
+        self.assertRaises(MissingBlob, blobs.delete_blob, 'cache', 'v1/raster/abc')
+        self.assertEqual([b.name for b in blobs.list_blobs('cache').blobs], ['v1/vector/def'])
+
+class DjangoCacheTest(SimpleTestCase):
+    """Tests for the Django cache backends on blob storage."""
+    def test_lazy(self):
+        """The blob backend does not reach the storage account until used."""
+        cache = BlobCacheBackend('ice2ocean', {'OPTIONS': {'ACCOUNT_NAME': 'nosuch', 'ACCOUNT_KEY': 'a2V5'}})
+        self.assertIsNone(cache._blobs)
+
+    def test_backend(self):
+        """Values round trip, one at a time or many, and drop by namespace."""
+        cache = DirectoryCacheBackend(tempfile.mkdtemp(), {'TIMEOUT': None})
+        self.assertIsNone(cache.default_timeout)
+        raster = cachekeys.response_key('raster', {'param': 'roff'})
+        vector = cachekeys.response_key('vector', {'table': 'modern'})
+        cache.set(raster, b'png')
+        cache.set_many({vector: b'xml', 'other': b'misc'})
+        self.assertEqual(cache.get(raster), b'png')
+        self.assertEqual(cache.get_many([raster, vector, 'other', 'missing']),
+                         {raster: b'png', vector: b'xml', 'other': b'misc'})
+        cache.delete_prefix('raster/')
+        self.assertIsNone(cache.get(raster))
+        self.assertEqual(cache.get(vector), b'xml')
+        cache.clear()
+        self.assertEqual(cache.get_many([vector, 'other']), {})
+
+    def test_expiry(self):
+        """Values expire after their timeout; 0 expires at once."""
+        cache = DirectoryCacheBackend(tempfile.mkdtemp(), {'TIMEOUT': 1})
+        cache.set('short', b'a')
+        cache.set('long', b'b', None)
+        cache.set('none', b'c', 0)
+        self.assertEqual(cache.get('short'), b'a')
+        self.assertIsNone(cache.get('none'))
+        time.sleep(1.1)
+        self.assertIsNone(cache.get('short'))
+        self.assertEqual(cache.get('long'), b'b')
+
+class EncodingTest(SimpleTestCase):
+    """Tests for precompressed response bodies."""
+    def test_pack(self):
+        """Text is stored compressed, and sent as stored or decoded."""
+        body = b'date,runoff\n' * 200
+        stored = encoding.pack(body, 'text/csv')
+        self.assertEqual(encoding.unpack(stored)[0], 'gzip')
+        self.assertLess(len(stored), len(body))
+        self.assertEqual(encoding.negotiate(stored, 'gzip, deflate'), (encoding.unpack(stored)[1], 'gzip'))
+        self.assertEqual(encoding.negotiate(stored, ''), (body, None))
+        self.assertEqual(encoding.negotiate(stored, 'gzip;q=0'), (body, None))
+
+    def test_identity(self):
+        """Images and small bodies are stored as they are."""
+        for body, content_type in ((b'\x89PNG' * 500, 'image/png'), (b'a,b\n', 'text/csv')):
+            stored = encoding.pack(body, content_type)
+            self.assertEqual(encoding.negotiate(stored, 'gzip'), (body, None))
+
+class StaleTest(SimpleTestCase):
+    """Tests for stale while revalidate."""
+    def test_state(self):
+        """Bodies go stale past their freshness window, or with their data."""
+        self.assertEqual(stale.state(10, 60, 600), stale.FRESH)
+        self.assertEqual(stale.state(100, 60, 600), stale.STALE)
+        self.assertEqual(stale.state(700, 60, 600), stale.EXPIRED)
+        self.assertEqual(stale.state(10 ** 6, None, 600), stale.FRESH)
+        self.assertEqual(stale.state(10, None, 600, current=False), stale.STALE)
+        self.assertEqual(stale.state(10, None, 0, current=False), stale.EXPIRED)
+        self.assertEqual(stale.unstamp(stale.stamp('gzip:abc', 1234.4)), (1234.0, 'gzip:abc'))
+
+    def test_refresher(self):
+        """A key is refreshed once at a time, and failures are counted."""
+        gate = threading.Event()
+        refreshed = []
+        def refresh():
+            gate.wait()
+            refreshed.append(1)
+        refresher = stale.Refresher(threads=1, depth=4)
+        refresher.schedule('raster/a', refresh)
+        refresher.schedule('raster/a', refresh)
+        refresher.schedule('raster/b', lambda: 1 / 0)
+        gate.set()
+        refresher.workers.join()
+        self.assertEqual(refreshed, [1])
+        stats = refresher.stats()
+        self.assertEqual((stats['refreshed'], stats['failed'], stats['refreshing']), (1, 1, 0))
+
+class FakeEntity(object):
+    """A table row."""
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+class FakeTableService(object):
+    """Just enough of a TableService for the FieldManager."""
+    def __init__(self, params):
+        self.params = params
+        self.queries = 0
+
+    def query_entities(self, table, filter=None):
+        self.queries += 1
+        return [FakeEntity(PartitionKey=p) for p in self.params]
+
+class ValidationTest(SimpleTestCase):
+    """Tests for fast-fail validation and the negative cache."""
+    def test_check(self):
+        """Unknown parameters and tables, and missing arguments, are invalid."""
+        params = lambda: frozenset(['roff', 'prec'])
+        validation.check('raster', {'param': 'roff'}, params)
+        self.assertRaises(validation.Invalid, validation.check, 'raster', {'param': 'snow'}, params)
+        self.assertRaises(validation.Invalid, validation.check, 'tile', {}, params)
+        validation.check('timeseries', {'table': 'GRACE', 'version': '1', 'region': '2'}, params)
+        self.assertRaises(validation.Invalid, validation.check, 'timeseries', {'table': 'GRACE', 'region': '2'}, params)
+        self.assertRaises(validation.Invalid, validation.check, 'timeseries', {'table': 'nosuch'}, params)
+        tables = lambda: frozenset(['modern', 'moderncenterlines'])
+        validation.check('vector', {'table': 'modern', 'name': 'Columbia'}, params, tables)
+        self.assertRaises(validation.Invalid, validation.check, 'vector', {'table': 'pg_user', 'name': 'x'}, params, tables)
+        self.assertRaises(validation.Invalid, validation.check, 'vector', {'table': 'modern'}, params, tables)
+        validation.check('vector', {'table': 'outlines', 'name': 'x'}, params, lambda: None)
+
+    def test_catalog(self):
+        """The parameter list is looked up once, not per request."""
+        service = FakeTableService(['roff', 'prec'])
+        fields = FieldManager(service, 'fields')
+        self.assertEqual(fields.params(), frozenset(['roff', 'prec']))
+        self.assertIn('roff', fields.params())
+        self.assertEqual(service.queries, 1)
+
+    def test_negative(self):
+        """Keys with no data are remembered for a while."""
+        nodata = validation.NegativeCache(ttl=0.2, size=2)
+        nodata.add('raster/a')
+        self.assertIn('raster/a', nodata)
+        nodata.add('raster/b')
+        nodata.add('raster/c')
+        self.assertNotIn('raster/a', nodata)
+        time.sleep(0.25)
+        self.assertNotIn('raster/c', nodata)
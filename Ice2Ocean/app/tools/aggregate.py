@@ -0,0 +1,59 @@
+'''
+Reductions of a cube over a range of bands (days).
+
+The reduction streams through the memory mapped cube a few bands at a
+time, so memory stays bounded by CHUNK_BANDS whatever the length of the
+range (a year of daily runoff is over 2GB of bands).
+'''
+import numpy as np
+
+# Bands read per step.
+CHUNK_BANDS = 8
+
+# Supported reductions.
+OPS = ('sum', 'mean', 'max', 'min')
+
+def reduce_bands(cube, first, last, op='sum', undef=None, chunk=CHUNK_BANDS):
+    '''
+    Reduce bands first..last (inclusive) of a (time, ny, nx) cube.
+
+    op:    one of OPS. No-data (undef or non-finite) cells are left out;
+           a cell with no data over the whole range is undef (or nan) in
+           the result.
+
+    Returns a (ny, nx) float32 array.
+    '''
+    if op not in OPS:
+        raise ValueError("Unknown reduction '{0}'".format(op))
+    if first < 0 or last >= cube.shape[0] or first > last:
+        raise IndexError('Bands {0}..{1} are not in the cube'.format(first, last))
+
+    shape = cube.shape[1:]
+    counts = np.zeros(shape, dtype=np.int32)
+    if op in ('sum', 'mean'):
+        acc = np.zeros(shape, dtype=np.float64)
+    elif op == 'max':
+        acc = np.empty(shape, dtype=np.float64)
+        acc.fill(-np.inf)
+    else:
+        acc = np.empty(shape, dtype=np.float64)
+        acc.fill(np.inf)
+
+    for start in range(first, last + 1, chunk):
+        block = np.asarray(cube[start:min(start + chunk, last + 1)], dtype=np.float64)
+        valid = np.isfinite(block)
+        if undef is not None:
+            valid &= (block != undef)
+        counts += valid.sum(axis=0)
+        if op in ('sum', 'mean'):
+            acc += np.where(valid, block, 0).sum(axis=0)
+        elif op == 'max':
+            acc = np.maximum(acc, np.where(valid, block, -np.inf).max(axis=0))
+        else:
+            acc = np.minimum(acc, np.where(valid, block, np.inf).min(axis=0))
+
+    if op == 'mean':
+        acc /= np.where(counts > 0, counts, 1)
+    out = acc.astype(np.float32)
+    out[counts == 0] = undef if undef is not None else np.nan
+    return out
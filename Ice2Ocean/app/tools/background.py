@@ -0,0 +1,101 @@
+'''
+Background work that must never hold up a request.
+
+Prefetching and stale refreshes both hand work to a few daemon threads
+and return at once. They share the code, not the threads: each has its
+own Workers, so a refresh never waits behind prefetches that are held
+off by foreground work or throttled. A Workers object:
+
+  * the queue is bounded, and work that does not fit is dropped and
+    counted rather than waited for (the caller will see the need again);
+  * work already waiting or running under the same key is not queued
+    twice;
+  * the threads start with the first piece of work, not on import;
+  * what was done, failed and dropped is counted for stats.
+'''
+import collections
+import threading
+import Queue
+
+class Workers:
+    '''
+    A bounded queue of work run on daemon threads. See the module notes.
+
+    run(work):  does one piece of work; raising counts it as failed.
+    threads:    worker threads.
+    depth:      pieces of work waiting at most.
+    start():    optional; run on each thread before it does any work.
+    keep(key):  optional; True for keys that stay pending once their work
+                is done, so it is never queued again. Work that failed is
+                always queued again.
+    '''
+
+    def __init__(self, run, threads, depth, start=None, keep=None):
+        self.run = run
+        self.nthreads = threads
+        self.start = start
+        self.keep = keep or (lambda key: False)
+        self.queue = Queue.Queue(depth)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.done = collections.Counter()
+        self.threads = []
+
+    def _start(self):
+        with self.lock:
+            while len(self.threads) < self.nthreads:
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, work, key=None):
+        '''
+        Queue work unless work under key (work itself by default) is
+        already pending. Returns True if it was queued.
+        '''
+        key = work if key is None else key
+        self._start()
+        with self.lock:
+            if key in self.pending:
+                return False
+            try:
+                self.queue.put_nowait((key, work))
+            except Queue.Full:
+                self.done['dropped'] += 1
+                return False
+            self.pending.add(key)
+            return True
+
+    def _work(self):
+        if self.start:
+            self.start()
+        while True:
+            key, work = self.queue.get()
+            outcome = 'failed'
+            try:
+                self.run(work)
+                outcome = 'done'
+            except Exception:
+                pass
+            finally:
+                with self.lock:
+                    if outcome != 'done' or not self.keep(key):
+                        self.pending.discard(key)
+                    self.done[outcome] += 1
+                self.queue.task_done()
+
+    def join(self):
+        '''
+        Wait until all queued work has been run.
+        '''
+        self.queue.join()
+
+    def stats(self):
+        '''
+        {'done', 'failed', 'dropped', 'queued', 'pending'} counts.
+        '''
+        with self.lock:
+            return {'done': self.done['done'], 'failed': self.done['failed'],
+                    'dropped': self.done['dropped'], 'queued': self.queue.qsize(),
+                    'pending': len(self.pending)}
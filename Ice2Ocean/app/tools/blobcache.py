@@ -1,24 +1,8 @@
 '''
 Utility functions for caching request responses to an Azure blob store.
 '''
-import string
 from azure.storage import BlobService
-
-def str2blobname(str):
-    '''
-    Convert a string into a valid blob name consisting of letters, numbers, 
-    and dashes.
-    
-    Note that blob names _are_ case sensitive.
-
-    This could be replaced by any decent hashing strategy; here it is used to
-    ease debugging. The resulting blob names are human (roughly, and for some 
-    definition of human) readable.
-    '''
-    whitelist = string.letters + string.digits + '-'
-    s = str.replace('.','-')
-    return ''.join(c for c in s if c in whitelist)
-
+from cachekeys import blob_name
 
 class BlobCache:
     '''
@@ -27,23 +11,25 @@ class BlobCache:
     name:      the name of a storage account.
     key:       the access key for the storage account.
     container: the name of the container to use.
+    blobstore: optional; a stand-in for the blob service, such as a
+               localblobs.LocalBlobService (name and key are then unused).
     '''
 
-    def __init__(self, name, key, container):
+    def __init__(self, name, key, container, blobstore=None):
         self.container = container
-        self.blobstore = BlobService(name, key)
+        self.blobstore = blobstore or BlobService(name, key)
         self.blobstore.create_container(self.container)
 
     def getresponse(self, cachekey):
         '''
         Get a value from the cache.
 
-        cachekey: The key.
+        cachekey: The key (see cachekeys.py; other strings are hashed).
 
         Kilroy notes that this throws an exception rather than returning a 
         value on failure.
         '''
-        return self.blobstore.get_blob_to_text(self.container,str2blobname(cachekey))
+        return self.blobstore.get_blob_to_text(self.container,blob_name(cachekey))
 
     def putresponse(self, cachekey, value):
         '''
@@ -53,7 +39,7 @@ class BlobCache:
 
         value: The value to associate with the key.
         '''
-        return self.blobstore.put_block_blob_from_text(self.container, str2blobname(cachekey), value)
+        return self.blobstore.put_block_blob_from_text(self.container, blob_name(cachekey), value)
 
     def invalidate(self, cachekey):
         '''
@@ -61,4 +47,4 @@ class BlobCache:
 
         cachekey: The key.
         '''
-        self.blobstore.delete_blob(self.container, str2blobname(cachekey))
\ No newline at end of file
+        self.blobstore.delete_blob(self.container, blob_name(cachekey))
@@ -16,8 +16,9 @@ socket.setdefaulttimeout(timeout)
 
 # Bring in important information
 from azure.storage import *
+from azure import WindowsAzureMissingResourceError
 from app.settings import * #  The connection settings.
-import sys,re, string, json, os, subprocess, tempfile
+import sys,re, string, json, os, subprocess, tempfile, hashlib, time, threading
 
 # Note this import ordering is significant.
 import matplotlib
@@ -27,6 +28,17 @@ import matplotlib.pyplot as plt
 import netCDF4 as nc
 import numpy as np
 from drawing import *
+from grid import GridHeader
+import overviews as ov
+import aggregate as agg
+import zonal
+import series as ts
+import compressed as z
+import download as dl
+from conditional import http_date
+from localcache import LocalCache
+from memorycache import MemoryCache
+from sharedgrids import SharedGrids
 import psycopg2 as DBase # PostgreSQL Connection
 from sshtunnel import SSHTunnelForwarder
 from sqlalchemy import create_engine
@@ -105,6 +117,18 @@ def label_error(name):
 def naming(year, month, day):
     return p_naming_format.format(year, month, day)
 
+def vector_tables():
+    '''
+    The names of the tables get-vector may query (see 
+    validation_properties), looked up in the database the first time they 
+    are needed. None while the database can't be reached.
+    '''
+    if _vector_tables[0] is None:
+        result = fetch_query(validation_properties['VECTOR_TABLES_QUERY'])
+        if result is not None:
+            _vector_tables[0] = frozenset(result.iloc[:, 0])
+    return _vector_tables[0]
+
 def fetch_query(query):
     '''
     Returns a query result from the relational database
@@ -137,48 +161,524 @@ def fetch_query(query):
     #    cursor.close()
     #    connection.close()
 
-def fetch_ds2(param, callback=None):
-    name = param + '.dat'
-    # The local path to the file (may not exist), based on the system temp directory
-    fpath = '{0}\{1}'.format(tempfile.gettempdir(),name)
-    fexists = os.path.exists(fpath)
-    if fexists:
-        # Try to open the file
-        return np.fromfile(fpath,dtype=np.float32)
-    else:
-        # Failing that we should fetch it from blob storage. 
-        
-        # First get the blob properties.
+# Downloaded blobs (and files derived from them) on local disk, kept 
+# within a byte budget (see localcache.py and cache_properties).
+local_cache = LocalCache()
+
+# Open datasets and decoded arrays, keyed by (blob name, ETag, ...) (see 
+# memorycache.py).
+memory = MemoryCache(cache_properties['MEMORY_BYTES'], cache_properties['MEMORY_HANDLES'])
+
+# Decoded bands and coordinates, shared with the other worker processes 
+# on this host (see sharedgrids.py).
+shared = SharedGrids()
+
+# When each cached blob's ETag was last checked: name -> time.
+_checked = {}
+
+# The tables get-vector may query, once looked up (see vector_tables).
+_vector_tables = [None]
+
+# Downloads for requests under way in this process; prefetching holds off 
+# while there are any (see prefetch.py).
+_downloads = [0]
+_downloads_lock = threading.Lock()
+
+# Per thread: the Throttle of a prefetch thread, see set_background.
+_thread = threading.local()
+
+def set_background(throttle):
+    '''
+    Make the calling thread's downloads prefetches: one range at a time, 
+    held to throttle's rate (see prefetch.Throttle), not counted as 
+    foreground work, and given up as soon as a request waits for the same 
+    blob (see LocalCache.fetch); the request resumes from the partial file.
+    '''
+    _thread.throttle = throttle
+
+def downloading():
+    '''
+    True while a request thread of this process is downloading a blob.
+    '''
+    return _downloads[0] > 0
+
+def _local_path(name):
+    '''
+    The local path for a blob (may not exist), in the local cache directory.
+    '''
+    return local_cache.path(name)
+
+def _fetch_blob(name, callback=None):
+    '''
+    Download the named blob from the model output container to the local 
+    cache, unless it is already there. Returns the local path.
+
+    The blob comes down in parallel byte ranges and is only moved into the 
+    cache once it is complete and matches its Content-MD5 (see download.py), 
+    so a file in the cache is always whole. Only one process on the host 
+    downloads a blob at a time; the rest wait for it (see LocalCache.fetch).
+
+    name: Name of the blob to fetch.
+    '''
+    _revalidate(name)
+
+    throttle = getattr(_thread, 'throttle', None)
+
+    def download(fpath, heartbeat):
+        throttled = throttle.callback() if throttle else None
+        def progress(current, total):
+            heartbeat()
+            if callback:
+                callback(current, total)
+            if throttled:
+                throttled(current, total)
+        if throttle:
+            return dl.download(p_blob_service, p_blob_container, name, fpath, progress, threads=1,
+                               cancel=lambda: local_cache.wanted(name))
+        with _downloads_lock:
+            _downloads[0] += 1
+        try:
+            return dl.download(p_blob_service, p_blob_container, name, fpath, progress)
+        finally:
+            with _downloads_lock:
+                _downloads[0] -= 1
+
+    return local_cache.fetch(name, download, background=throttle is not None)
+
+def _revalidate(name):
+    '''
+    Every REVALIDATE_SECONDS, check a cached blob's ETag against the blob 
+    service; if the blob has changed, drop the local copy and everything 
+    kept in memory for it, so it is fetched afresh.
+    '''
+    version = local_cache.version(name)
+    if version is None or time.time() - _checked.get(name, 0) < cache_properties['REVALIDATE_SECONDS']:
+        return
+    _checked[name] = time.time()
+    try:
+        current = p_blob_service.get_blob_properties(p_blob_container, name).get('etag')
+    except WindowsAzureMissingResourceError:
+        current = None
+    if current != version:
+        memory.invalidate(name)
+        local_cache.remove(name)
+
+# Blob properties looked up without downloading: name -> (when, properties).
+_sources = {}
+
+def _properties(name):
+    '''
+    The properties (headers) of a blob, as the blob service has them, 
+    looked up at most every REVALIDATE_SECONDS. Raises the missing blob 
+    error for a blob that does not exist.
+    '''
+    when, props = _sources.get(name, (0, None))
+    if time.time() - when >= cache_properties['REVALIDATE_SECONDS']:
         props = p_blob_service.get_blob_properties(p_blob_container, name)
-        
-        # Then attempt to fetch the blob, attempt no more than 4 times.
-        p_blob_service.get_blob_to_path(p_blob_container, name, fpath, progress_callback=callback)
-        # Keep track of how many times we've tried. 
-        attempt = 0
-        # Keep up with the int-ized version of the correct file size.
-        size = int(props['content-length'])
-        
-        # Try to download the blob repeatedly, checking each time that the 
-        # transfer hasn't finished or run out of attempts.
-        #
-        #   Kilroy notes that this test is problematic
-        #    A blob will pass this test if the downloaded size 
-        #                           and the reported blob size 
-        #                                            are equal.
-        #    
-        #    This does not correctly identify blobs that have 
-        #                             been partially uploaded.
-        while not (size == os.path.getsize(fpath)) and attempt < 3 :
-            p_blob_service.get_blob_to_path(p_blob_container, name, fpath, progress_callback=callback)
-            attempt = attempt + 1
-
-        # Now try to open the ds as it has ostensibly been downloaded.
+        _sources[name] = (time.time(), props)
+    return props
+
+def source_version(param):
+    '''
+    (ETag, last modified datetime) of the .dat cube for param, as the blob 
+    service has it (see _properties). Nothing is downloaded. Raises the 
+    missing blob error for an unknown param.
+    '''
+    props = _properties(param + '.dat')
+    return props.get('etag'), http_date(props.get('last-modified'))
+
+def _store_derived(name, path, source):
+    '''
+    Upload the file at path (name's place in the local cache) as the blob 
+    name, built from the local copy of the blob source: its ETag goes in 
+    the blob's metadata (see _built_from). The local file is recorded as 
+    the version uploaded.
+    '''
+    p_blob_service.put_block_blob_from_path(p_blob_container, name, path,
+                                            x_ms_meta_name_values={'source': _version(source) or ''})
+    _sources.pop(name, None)
+    local_cache.add(name, _properties(name).get('etag'))
+
+def _built_from(name, source):
+    '''
+    True if the derived blob name (a compressed copy, an overview, a series 
+    copy) was built from the current version of the blob source. Copies 
+    built from a version since replaced, or that don't say, are ignored 
+    until they are built again. Raises the missing blob error if name does 
+    not exist.
+    '''
+    built = _properties(name).get('x-ms-meta-source')
+    try:
+        current = _properties(source).get('etag')
+    except WindowsAzureMissingResourceError:
+        return False
+    return built is not None and built == current
+
+def _version(name):
+    # The ETag of the local copy of a blob fetched with _fetch_blob.
+    return local_cache.version(name)
+
+def _open_pinned(name, fpath, opener):
+    '''
+    opener(fpath), with name pinned in the local cache for as long as the 
+    result is in use.
+    '''
+    ds = opener(fpath)
+    # A netCDF variable can't be weakly referenced; its dataset can.
+    local_cache.pin(name, ds.group() if isinstance(ds, nc.Variable) else ds)
+    return ds
+
+def _is_open(ds):
+    # Callers may close a netCDF dataset they were handed.
+    if isinstance(ds, nc.Variable):
+        ds = ds.group()
+    try:
+        return ds.isopen()
+    except AttributeError:
+        return True
+
+def _open_cached(name, fpath, opener):
+    '''
+    _open_pinned, reusing the handle opened last time for this version of 
+    the blob.
+    '''
+    key = (name, _version(name), 'handle')
+    ds = memory.get(key)
+    if ds is None or not _is_open(ds):
+        ds = memory.put(key, _open_pinned(name, fpath, opener))
+    return ds
+
+def fetch_header(param, required=False):
+    '''
+    Returns the GridHeader describing the .dat cube for param.
+
+    The header comes from the cube's .ctl descriptor. Cubes without one are 
+    assumed to be on the default grid (see grid_properties), unless required 
+    is set, in which case the missing blob error is raised.
+    '''
+    name = param + grid_properties['DESCRIPTOR_SUFFIX']
+    try:
+        fpath = _fetch_blob(name)
+    except WindowsAzureMissingResourceError:
+        if required:
+            raise
+        return GridHeader.default()
+    key = (name, _version(name), 'header')
+    header = memory.get(key)
+    if header is None:
+        with open(fpath, 'r') as f:
+            header = memory.put(key, GridHeader.parse(f.read()), nbytes=0)
+    return header
+
+# Compressed copies found missing recently: name -> when. Saves asking the 
+# blob service about them on every request.
+_absent = {}
+ABSENT_SECONDS = 600
+
+def _fetch_compressed(name, source, callback=None):
+    '''
+    The local path of the compressed copy of name (see compressed.py), or 
+    None if it has not been built from the current version of the blob 
+    source (see _built_from).
+    '''
+    zname = z.compressed_name(name)
+    if time.time() - _absent.get(zname, 0) < ABSENT_SECONDS:
+        return None
+    try:
+        if not _built_from(zname, source):
+            return None
+        return _fetch_blob(zname, callback)
+    except WindowsAzureMissingResourceError:
+        _absent[zname] = time.time()
+        return None
+
+def fetch_ds2(param, callback=None, header=None, compressed=True):
+    '''
+    Returns a read-only (time, ny, nx) array of the cube for param.
+
+    This is the cube's chunked, compressed copy when there is one (only the 
+    chunks a slice touches are decompressed), otherwise a memory map of the 
+    raw .dat cube (only the bands, or windows, that are indexed get read).
+
+    header:     The cube's GridHeader, if the caller already has it.
+    compressed: False to always use the raw cube.
+    '''
+    header = header or fetch_header(param)
+    zpath = _fetch_compressed(param, param + '.dat', callback) if compressed else None
+    if zpath is not None:
         try:
-            return np.fromfile(fpath,dtype=np.float32)
+            return _open_cached(z.compressed_name(param), zpath, z.open_cube)
         except:
-            # This could do something more intelligent, like raise an 
-            #  appropriate exception.
-            return None
+            pass
+    fpath = _fetch_blob(param + '.dat', callback)
+
+    # Now try to open the ds as it has ostensibly been downloaded.
+    try:
+        return _open_cached(param + '.dat', fpath, lambda p: header.open(p, os.path.getsize(p)))
+    except:
+        # This could do something more intelligent, like raise an 
+        #  appropriate exception.
+        return None
+
+def fetch_overview(param, scale, header=None):
+    '''
+    Returns (header, cube) for the coarsest overview of param that still 
+    has a cell for every output pixel, falling back to the full resolution 
+    cube when no overview fits (or none has been built).
+
+    scale: the number of full resolution cells per output pixel.
+    '''
+    name, header, cube = _pick_overview(param, scale, header)
+    return header, cube
+
+def _pick_overview(param, scale, header=None):
+    # fetch_overview, also returning the name of the cube picked.
+    for f in ov.factors_for(scale):
+        if f == 1:
+            header = header or fetch_header(param)
+            return param, header, fetch_ds2(param, header=header)
+        name = ov.overview_name(param, f)
+        try:
+            if not _built_from(name + '.dat', param + '.dat'):
+                continue
+            oheader = fetch_header(name, required=True)
+            return name, oheader, fetch_ds2(name, header=oheader)
+        except WindowsAzureMissingResourceError:
+            continue
+
+def fetch_overview_band(param, band, scale, header=None):
+    '''
+    Returns (header, band) for a band (index) of the overview fetch_overview
+    picks, as an in-memory array (see fetch_band).
+    '''
+    name, oheader, cube = _pick_overview(param, scale, header)
+    return oheader, fetch_band(name, band, oheader)
+
+def warm_overviews(param):
+    '''
+    Fetch the overviews of param to the local cache, coarsest first (their 
+    compressed copies where there are some). Overviews not built are skipped.
+    '''
+    for f in sorted(ov.OVERVIEW_FACTORS, reverse=True):
+        name = ov.overview_name(param, f)
+        try:
+            if not _built_from(name + '.dat', param + '.dat'):
+                continue
+            header = fetch_header(name, required=True)
+        except WindowsAzureMissingResourceError:
+            continue
+        fetch_ds2(name, header=header)
+
+def fetch_band(param, band, header=None):
+    '''
+    Returns band (an index) of the cube for param (or an overview name) as 
+    a decoded (ny, nx) array, read-only and shared with the other worker 
+    processes on this host (see sharedgrids.py).
+    '''
+    cube = fetch_ds2(param, header=header)
+    if band >= cube.shape[0]:
+        raise IndexError('Band {0} is past the end of {1}'.format(band, param))
+    name = z.compressed_name(param) if isinstance(cube, nc.Variable) else param + '.dat'
+    return shared.get(repr((name, _version(name), 'band', band)), lambda: np.array(cube[band]))
+
+def fetch_variable(param, time, variable):
+    '''
+    Returns a variable (coordinates, say) of the netCDF file for param and 
+    time (see fetch_ds), decoded and kept in memory for the next request.
+    '''
+    ds = fetch_ds(param, time)
+    if ds is None:
+        return None
+    name = p_naming_format.format(param, *time)
+    zname = z.compressed_name(name)
+    name = zname if _version(zname) else name
+    key = (name, _version(name), 'variable', variable)
+    data = memory.get(key)
+    if data is None:
+        data = memory.put(key, np.ma.asarray(ds.variables[variable][:]))
+    return data
+
+def fetch_coords(param, time, proj, lon='lon_psi', lat='lat_psi'):
+    '''
+    Returns (x, y): the projected column and row coordinates of the netCDF 
+    file for param and time, read-only and shared with the other worker 
+    processes on this host (see sharedgrids.py). None if the file cannot 
+    be had.
+
+    proj: the pyproj.Proj to project the lon and lat variables with.
+    '''
+    lons = fetch_variable(param, time, lon)
+    lats = fetch_variable(param, time, lat)
+    if lons is None or lats is None:
+        return None
+    name = p_naming_format.format(param, *time)
+    key = (name, _version(name), 'coords', proj.srs, lon, lat)
+
+    projected = []
+    def build(axis):
+        if not projected:
+            x, y = proj(lons, lats)
+            projected.extend([np.array(x[0,:]), np.array(y[:,0])])
+        return projected[axis]
+    return tuple(shared.get(repr(key + (axis,)), lambda axis=axis: build(axis)) for axis in (0, 1))
+
+def fetch_aggregate(param, first, last, op, scale=1):
+    '''
+    Returns (header, grid) for the .dat cube of param reduced with op over 
+    bands first..last (see aggregate.reduce_bands), read from the coarsest 
+    overview that fits scale (see fetch_overview).
+
+    The reduced grids are kept in the local cache as single band cubes, so 
+    drawing the same range again (another cmap or size) skips the reduction.
+    Their names carry the version of the cube they were reduced from, so a 
+    replaced cube is reduced afresh.
+    '''
+    source, header, cube = _pick_overview(param, scale)
+    source = z.compressed_name(source) if isinstance(cube, nc.Variable) else source + '.dat'
+    version = hashlib.sha1(repr(_version(source))).hexdigest()[:12]
+    name = '{0}.{1}.{2}-{3}.{4}x{5}.{6}'.format(param, op, first, last, header.nx, header.ny, version)
+    fpath = _local_path(name + '.dat')
+
+    rheader = GridHeader(header.nx, header.ny, 1, undef=header.undef,
+                         xdef=header.geotransform()[0:2], ydef=header.geotransform()[2:4],
+                         dtype=header.dtype)
+    if local_cache.get(name + '.dat') is None:
+        grid = agg.reduce_bands(cube, first, last, op, header.undef)
+        tmp = '{0}.{1}'.format(fpath, os.getpid())
+        grid.astype(header.dtype).tofile(tmp)
+        try:
+            os.rename(tmp, fpath)
+        except OSError:
+            os.remove(tmp)
+        local_cache.add(name + '.dat')
+    return rheader, rheader.open(fpath, os.path.getsize(fpath))[0]
+
+def fetch_zones(zoneset, header):
+    '''
+    Returns (matrix, ids, names) for a zone layer (see zone_properties) 
+    rasterized onto the grid described by header (see zonal.zone_matrix).
+
+    The polygons are only rasterized once per grid; the matrix is kept in 
+    the local cache. Delete it there to pick up edits to the layer.
+    '''
+    layer = zone_properties[zoneset]
+    spec = repr((zoneset, header.nx, header.ny, header.geotransform(), grid_properties['SRID']))
+    name = 'zones.{0}.{1}.npz'.format(zoneset, hashlib.sha1(spec).hexdigest())
+
+    built = []
+    def build(path, heartbeat):
+        query = """SELECT %s AS id, %s AS name, ST_AsText(ST_Transform(geom,%d)) AS wkt FROM %s ORDER BY %s""" % (
+            layer['ID'], layer['NAME'], grid_properties['SRID'], layer['TABLE'], layer['ID'])
+        rows = fetch_query(query)
+        if rows is None:
+            raise IOError("Could not read the '{0}' zones".format(zoneset))
+        ids, names = list(rows['id']), list(rows['name'])
+        built.append((zonal.zone_matrix(list(rows['wkt']), header), ids, names))
+        zonal.save_matrix(path, *built[0])
+
+    # One process on the host rasterizes them; the rest read its file.
+    fpath = local_cache.fetch(name, build)
+    return built[0] if built else zonal.load_matrix(fpath)
+
+def zonal_totals(param, zoneset, first, last, ids=None):
+    '''
+    Returns (ids, names, totals) where totals is the (days, zones) array of 
+    per-zone totals of the .dat cube of param over bands first..last (see 
+    zonal.zone_totals).
+
+    ids: optional zone ids to restrict the result to, in that order.
+    '''
+    header = fetch_header(param)
+    matrix, all_ids, names = fetch_zones(zoneset, header)
+    if ids:
+        lookup = dict((str(z), j) for j, z in enumerate(all_ids))
+        columns = [lookup[str(z)] for z in ids]
+        matrix = matrix[:, columns]
+        all_ids = [all_ids[j] for j in columns]
+        names = [names[j] for j in columns]
+    cube = fetch_ds2(param, header=header)
+    return all_ids, names, zonal.zone_totals(cube, matrix, first, last, header.undef)
+
+def build_overviews(param):
+    '''
+    Build the overview pyramid for the .dat cube of param and store it in 
+    the model output container next to the cube, recording the version of 
+    the cube it was built from (see _built_from).
+
+    This is part of ingesting a cube (see instance.py).
+    '''
+    header = fetch_header(param)
+    cube = fetch_ds2(param, header=header, compressed=False)
+    for f, dat, ctl in ov.build_overviews(cube, header, _local_path(param)):
+        name = ov.overview_name(param, f)
+        _store_derived(name + grid_properties['DESCRIPTOR_SUFFIX'], ctl, param + '.dat')
+        _store_derived(name + '.dat', dat, param + '.dat')
+
+def build_compressed(name):
+    '''
+    Build the chunked, compressed copy (see compressed.py) of the named 
+    .dat cube or netCDF blob and store it in the model output container 
+    next to the original, recording the version it was built from (see 
+    _built_from). The overviews of a cube are compressed too.
+
+    This is part of ingesting model output (see instance.py).
+    '''
+    zname = z.compressed_name(name)
+    if name.endswith('.dat'):
+        param = name[:-len('.dat')]
+        header = fetch_header(param)
+        path = z.convert_cube(fetch_ds2(param, header=header, compressed=False), header, _local_path(zname))
+        for f in ov.OVERVIEW_FACTORS:
+            try:
+                build_compressed(ov.overview_name(param, f) + '.dat')
+            except WindowsAzureMissingResourceError:
+                pass
+    else:
+        path = z.convert_netcdf(_fetch_blob(name), _local_path(zname))
+    _store_derived(zname, path, name)
+    _absent.pop(zname, None)
+
+def build_series(param):
+    '''
+    Build the time-major copy of the .dat cube for param (see series.py) 
+    and store it in the model output container next to the cube, recording 
+    the version of the cube it was built from (see _built_from).
+
+    This is part of ingesting a cube (see instance.py).
+    '''
+    header = fetch_header(param)
+    cube = fetch_ds2(param, header=header, compressed=False)
+    name = ts.series_name(param) + '.dat'
+    path = ts.build_series(cube, header, _local_path(name))
+    _store_derived(name, path, param + '.dat')
+
+def fetch_pixel_series(param, lon, lat, first=0, last=None):
+    '''
+    Returns (header, values): the values of the cell of param's cube holding 
+    lon/lat for bands first..last (inclusive; last defaults to the end).
+
+    The series is read from the time-major copy when there is one, and from 
+    the band-major cube (one read per band) when there is not.
+
+    Raises a ValueError if the point is off the grid.
+    '''
+    header = fetch_header(param)
+    col, row = header.cells([lon], [lat])
+    if col[0] < 0:
+        raise ValueError('{0}, {1} is off the grid'.format(lat, lon))
+    try:
+        name = ts.series_name(param) + '.dat'
+        if not _built_from(name, param + '.dat'):
+            raise WindowsAzureMissingResourceError(name)
+        series = _open_pinned(name, _fetch_blob(name), lambda p: ts.open_series(header, p, os.path.getsize(p)))
+        last = series.shape[2] - 1 if last is None else last
+        return header, ts.read_series(series, col[0], row[0], first, last)
+    except WindowsAzureMissingResourceError:
+        cube = fetch_ds2(param, header=header)
+        last = cube.shape[0] - 1 if last is None else last
+        if first < 0 or last >= cube.shape[0] or first > last:
+            raise IndexError('Bands {0}..{1} are not in the cube'.format(first, last))
+        return header, np.array(cube[first:last + 1, row[0], col[0]], dtype=np.float32)
 
 def fetch_ds(param, time, callback=None):
     '''
@@ -190,47 +690,21 @@ def fetch_ds(param, time, callback=None):
     year, month, day = time
     name = p_naming_format.format(param,year,month,day)
     
-    # The local path to the file (may not exist), based on the system temp directory
-    fpath = '{0}\{1}'.format(tempfile.gettempdir(),name)
-    fexists = os.path.exists(fpath)
-
-    if fexists:
-        # Try to open the file
-        return nc.Dataset(fpath, 'r')
-    else:
-        # Failing that we should fetch it from blob storage. 
-        
-        # First get the blob properties.
-        props = p_blob_service.get_blob_properties(p_blob_container, name)
-        
-        # Then attempt to fetch the blob, attempt no more than 4 times.
-        p_blob_service.get_blob_to_path(p_blob_container, name, fpath, progress_callback=callback)
-        # Keep track of how many times we've tried. 
-        attempt = 0
-        # Keep up with the int-ized version of the correct file size.
-        size = int(props['content-length'])
-        
-        # Try to download the blob repeatedly, checking each time that the 
-        # transfer hasn't finished or run out of attempts.
-        #
-        #   Kilroy notes that this test is problematic
-        #    A blob will pass this test if the downloaded size 
-        #                           and the reported blob size 
-        #                                            are equal.
-        #    
-        #    This does not correctly identify blobs that have 
-        #                             been partially uploaded.
-        while not (size == os.path.getsize(fpath)) and attempt < 3 :
-            p_blob_service.get_blob_to_path(p_blob_container, name, fpath, progress_callback=callback)
-            attempt = attempt + 1
-
-        # Now try to open the ds as it has ostensibly been downloaded.
+    zpath = _fetch_compressed(name, name, callback)
+    if zpath is not None:
         try:
-            return nc.Dataset(fpath, 'r')
+            return _open_cached(z.compressed_name(name), zpath, z.open_dataset)
         except:
-            # This could do something more intelligent, like raise an 
-            #  appropriate exception.
-            return None
+            pass
+    fpath = _fetch_blob(name, callback)
+
+    # Now try to open the ds as it has ostensibly been downloaded.
+    try:
+        return _open_cached(name, fpath, lambda p: nc.Dataset(p, 'r'))
+    except:
+        # This could do something more intelligent, like raise an 
+        #  appropriate exception.
+        return None
 
 def retrieveRow(PartitionKey,RowKey):
     ''' 
@@ -243,10 +717,11 @@ def retrieveRow(PartitionKey,RowKey):
         return None
 
 def list_local_cache():
-    td = tempfile.gettempdir()
-    return [ {"file": f, "size": os.path.getsize("{0}\\{1}".format(td,f))} 
-                for f in os.listdir(td) 
-                    if f.endswith(".nc") ];
+    '''
+    The files in the local cache, most recently used first (see 
+    LocalCache.listing).
+    '''
+    return local_cache.listing()
 
 def list_blob_cache():
     return p_blob_service.list_blobs(p_blob_container, include='metadata')
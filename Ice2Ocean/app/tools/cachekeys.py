@@ -0,0 +1,120 @@
+'''
+Canonical, versioned keys for cached responses.
+
+Responses used to be cached under json.dumps(request.GET), so the same
+request with its arguments in another order, with arguments the endpoint
+ignores, or with a cache buster on the end was a miss, and replacing the
+model output left the old responses in place under the same keys. Here:
+
+  * each endpoint lists the arguments it actually uses, and how to
+    normalize each one (numbers, dates, defaults); everything else is
+    left out of the key;
+  * the version of the data the response is made from (the cube blob's
+    ETag, the field table row's ETag) goes into the key, so new data
+    means new keys;
+  * latest_key names where the key of a request's most recently cached
+    version is kept, so a response for replaced data can still be found
+    and served stale while the new one is made (see stale.py);
+  * the key is '<endpoint>/<sha1>': fixed length, safe as a blob or file
+    name, and namespaced per endpoint so a whole family can be dropped at
+    once (see TieredCache.drop).
+'''
+import datetime
+import hashlib
+import json
+
+# Bump to orphan every cached response (a change in what a key covers, or
+# in how bodies are stored).
+SCHEMA = 3
+
+def text(value):
+    return value.strip()
+
+def lower(value):
+    return value.strip().lower()
+
+def integer(value):
+    return str(int(value))
+
+def number(value):
+    return '{0:.6g}'.format(float(value))
+
+def day(value):
+    return datetime.datetime.strptime(value.strip(), '%Y-%m-%d').strftime('%Y-%m-%d')
+
+def ids(value):
+    return ','.join(sorted(set(i.strip() for i in value.split(',') if i.strip())))
+
+_TIME = {'year': (integer, None), 'month': (integer, None), 'day': (integer, None), 'hour': (integer, None)}
+
+def _spec(*parts, **args):
+    spec = {}
+    for part in parts:
+        spec.update(part)
+    spec.update(args)
+    return spec
+
+# endpoint -> {argument: (normalizer, default)}. Arguments missing from a
+# request take their default; those without one are left out.
+ENDPOINTS = {
+    'raster': _spec(_TIME, param=(text, None), depth=(number, None), cmap=(text, 'binary'),
+                    width=(integer, None), height=(integer, None)),
+    'tile': _spec(_TIME, param=(text, None), cmap=(text, 'binary'),
+                  z=(integer, None), x=(integer, None), y=(integer, None)),
+    'aggregate': _spec(param=(text, None), start=(day, None), end=(day, None), op=(lower, 'sum'),
+                       cmap=(text, 'binary'), width=(integer, None), height=(integer, None),
+                       color_min=(number, None), color_max=(number, None)),
+    'zonal': _spec(param=(text, None), zones=(text, 'glaciers'), id=(ids, None),
+                   start=(day, None), end=(day, None), format=(lower, 'csv')),
+    'timeseries': _spec(table=(text, None), mascon=(text, None), location=(text, None),
+                        version=(text, None), region=(text, None), glacier=(text, None),
+                        collection=(text, None)),
+    'timeseries-metadata': _spec(table=(text, None), location=(text, None)),
+    'vector': _spec(table=(text, None), name=(text, None)),
+}
+
+def canonical(endpoint, args):
+    '''
+    The arguments of a request to endpoint that matter, normalized, as a
+    sorted list of (name, value).
+
+    args: a dict of argument -> string (a QueryDict will do).
+
+    Raises KeyError for an unknown endpoint, ValueError for an argument
+    that does not normalize (a width that is not a number...).
+    '''
+    out = []
+    for name, (normalize, default) in ENDPOINTS[endpoint].items():
+        value = args.get(name, None)
+        if value is None or value == '':
+            value = default
+        else:
+            value = normalize(value)
+        if value is not None:
+            out.append((name, value))
+    return sorted(out)
+
+def response_key(endpoint, args, version=None):
+    '''
+    The cache key for a request to endpoint with args, made from data at
+    version (anything JSON serializable; None when it is not versioned).
+    '''
+    digest = hashlib.sha1(json.dumps([SCHEMA, canonical(endpoint, args), version], sort_keys=True))
+    return '{0}/{1}'.format(endpoint, digest.hexdigest())
+
+def latest_key(endpoint, args):
+    '''
+    The key under which the key of the latest cached version of a request
+    to endpoint with args is kept.
+    '''
+    return response_key(endpoint, args, 'latest')
+
+def blob_name(key):
+    '''
+    A blob name for any cache key: keys made by response_key are used as
+    they are, anything else is hashed.
+    '''
+    namespace, sep, digest = key.partition('/')
+    if namespace in ENDPOINTS and len(digest) == 40:
+        return key
+    return 'misc/' + hashlib.sha1(key.encode('utf-8')).hexdigest()
@@ -0,0 +1,138 @@
+'''
+Chunked, compressed copies of the model output.
+
+The .dat cubes are raw float32 and the NAME_FORMAT netCDF files are
+written without compression, so both have to be downloaded whole and are
+large. The converter rewrites either into a netCDF4 (HDF5) container with
+zlib compressed time x y x chunks next to the original (param.z.nc for
+param.dat, name.z.nc for name.nc). Reading a slice only decompresses the
+chunks it touches.
+
+CHUNKS favours maps, which are most of the traffic: a band reads the 120
+or so chunks covering it, and the next few bands come out of the chunk
+cache. Pixel histories have their own time-major copy (see series.py).
+'''
+import os
+
+import numpy as np
+import netCDF4 as nc
+
+# (time, y, x) chunk shape; 512KB of float32 per chunk before compression.
+CHUNKS = (8, 128, 128)
+
+# zlib level. Past 4 the files hardly shrink and writing slows a lot.
+COMPLEVEL = 4
+
+# Per variable chunk cache, in bytes. Big enough for a band's worth of
+# chunks, so stepping through consecutive days decompresses each chunk once.
+CHUNK_CACHE_BYTES = 128 * 1024 * 1024
+
+# Name of the data variable in a converted cube.
+CUBE_VARIABLE = 'data'
+
+def compressed_name(name):
+    '''
+    The blob name of the compressed copy of name (a .dat or .nc blob, or
+    a cube name without extension).
+    '''
+    for ext in ('.dat', '.nc'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return '{0}.z.nc'.format(name)
+
+def chunks_for(shape, chunks=CHUNKS):
+    '''
+    The chunk shape for a variable of the given shape: the trailing
+    dimensions of chunks, clipped to the variable.
+    '''
+    tail = chunks[-len(shape):] if len(shape) <= len(chunks) else (1,) * (len(shape) - len(chunks)) + chunks
+    return tuple(max(1, min(c, n)) for c, n in zip(tail, shape))
+
+def convert_cube(cube, header, path, chunks=CHUNKS, complevel=COMPLEVEL):
+    '''
+    Write a (time, ny, nx) cube described by header to a compressed
+    container at path. The descriptor goes along as the 'descriptor'
+    attribute, so the container stands on its own.
+    '''
+    ds = nc.Dataset(path, 'w', format='NETCDF4')
+    try:
+        ds.createDimension('time', None)
+        ds.createDimension('y', header.ny)
+        ds.createDimension('x', header.nx)
+        ds.descriptor = header.dumps(os.path.basename(path))
+        x, y = header.coords()
+        ds.createVariable('x', 'f8', ('x',))[:] = x
+        ds.createVariable('y', 'f8', ('y',))[:] = y
+        kwargs = {}
+        if header.undef is not None:
+            kwargs['fill_value'] = header.undef
+        var = ds.createVariable(CUBE_VARIABLE, np.dtype(header.dtype).str[1:], ('time', 'y', 'x'),
+                                zlib=True, shuffle=True, complevel=complevel,
+                                chunksizes=chunks_for((cube.shape[0] or 1, header.ny, header.nx), chunks), **kwargs)
+        # Whole chunks along time at a time, so each chunk is compressed once.
+        step = chunks[0]
+        for start in range(0, cube.shape[0], step):
+            stop = min(start + step, cube.shape[0])
+            var[start:stop] = np.asarray(cube[start:stop])
+    finally:
+        ds.close()
+    return path
+
+def convert_netcdf(src, path, chunks=CHUNKS, complevel=COMPLEVEL):
+    '''
+    Copy the netCDF file at src to a compressed container at path,
+    dimensions, attributes and all.
+    '''
+    inp = nc.Dataset(src, 'r')
+    out = nc.Dataset(path, 'w', format='NETCDF4')
+    try:
+        out.setncatts(dict((k, inp.getncattr(k)) for k in inp.ncattrs()))
+        for name, dim in inp.dimensions.items():
+            out.createDimension(name, None if dim.isunlimited() else len(dim))
+        for name, var in inp.variables.items():
+            var.set_auto_maskandscale(False)
+            attrs = dict((k, var.getncattr(k)) for k in var.ncattrs())
+            kwargs = {}
+            if '_FillValue' in attrs:
+                kwargs['fill_value'] = attrs.pop('_FillValue')
+            if var.ndim and var.dtype != str:
+                kwargs.update(zlib=True, shuffle=True, complevel=complevel,
+                              chunksizes=chunks_for(tuple(max(1, n) for n in var.shape), chunks))
+            copy = out.createVariable(name, var.dtype, var.dimensions, **kwargs)
+            copy.set_auto_maskandscale(False)
+            copy.setncatts(attrs)
+            if not var.ndim:
+                copy.assignValue(var.getValue())
+                continue
+            step = chunks_for(var.shape, chunks)[0] if var.shape[0] else 1
+            for start in range(0, var.shape[0], step):
+                stop = min(start + step, var.shape[0])
+                copy[start:stop] = var[start:stop]
+    finally:
+        out.close()
+        inp.close()
+    return path
+
+def open_cube(path):
+    '''
+    Open a container written by convert_cube. Returns its data variable,
+    which slices like the (time, ny, nx) memory map of the raw cube (no
+    masking: no-data cells come back as undef).
+    '''
+    ds = nc.Dataset(path, 'r')
+    var = ds.variables[CUBE_VARIABLE]
+    var.set_auto_maskandscale(False)
+    var.set_var_chunk_cache(size=CHUNK_CACHE_BYTES)
+    return var
+
+def open_dataset(path):
+    '''
+    Open a container written by convert_netcdf (or any netCDF file) for
+    reading, with room in the chunk cache for a band of every variable.
+    '''
+    ds = nc.Dataset(path, 'r')
+    for var in ds.variables.values():
+        if var.chunking() not in (None, 'contiguous'):
+            var.set_var_chunk_cache(size=CHUNK_CACHE_BYTES)
+    return ds
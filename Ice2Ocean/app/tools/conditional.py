@@ -0,0 +1,89 @@
+'''
+Validators for conditional requests.
+
+Responses carry a strong ETag and a Last-Modified date, so a client or
+CDN holding a copy revalidates it with If-None-Match / If-Modified-Since
+and gets an empty 304 back instead of the body. The ETag is a digest of
+what the response is made from (the version of its source: a blob's or
+table row's ETag) and the request's arguments, so it changes exactly
+when the response would.
+
+validators() makes the etag_func and last_modified_func for Django's
+condition decorator; views use condition() here rather than Django's, as
+Django's puts the validators on error responses too, and a client that
+revalidated a 404 or a 503 would be told it is still good.
+'''
+import datetime
+import email.utils
+import hashlib
+import json
+from functools import wraps
+
+from django.views.decorators import http
+
+def strong_etag(*parts):
+    '''
+    A strong ETag (unquoted) for a response made from parts, anything JSON
+    serializable.
+    '''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+def http_date(value):
+    '''
+    An HTTP date (as in a Last-Modified header) as a naive UTC datetime;
+    None if there is none or it can't be parsed.
+    '''
+    parsed = email.utils.parsedate_tz(value) if value else None
+    if parsed is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(email.utils.mktime_tz(parsed))
+
+def validators(source, vary=None):
+    '''
+    (etag_func, last_modified_func) for django.views.decorators.http.condition.
+
+    source(request, *args, **kwargs) returns (version, last modified) of
+    what the response is made from, either of them None when unknown. It
+    is called once per request, and an exception from it (a missing blob,
+    a bad argument) just means no validators: the view runs as usual.
+
+    vary: optional; vary(request) is anything else the response depends
+          on (how it is encoded for the client, say).
+    '''
+    def lookup(request, *args, **kwargs):
+        if not hasattr(request, '_validators'):
+            try:
+                version, modified = source(request, *args, **kwargs)
+            except Exception:
+                version, modified = None, None
+            extra = vary(request) if vary else None
+            etag = strong_etag(version, request.path, sorted(request.GET.lists()), extra) if version else None
+            request._validators = (etag, modified)
+        return request._validators
+
+    def etag_func(request, *args, **kwargs):
+        return lookup(request, *args, **kwargs)[0]
+
+    def last_modified_func(request, *args, **kwargs):
+        return lookup(request, *args, **kwargs)[1]
+
+    return etag_func, last_modified_func
+
+def condition(etag_func=None, last_modified_func=None):
+    '''
+    django.views.decorators.http.condition, except that only 200 and 304
+    responses keep the validators it gives them.
+    '''
+    def decorator(view):
+        conditioned = http.condition(etag_func=etag_func, last_modified_func=last_modified_func)(view)
+
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            response = conditioned(request, *args, **kwargs)
+            if response.status_code not in (200, 304):
+                for header in ('ETag', 'Last-Modified'):
+                    if response.has_header(header):
+                        del response[header]
+            return response
+        return inner
+    return decorator
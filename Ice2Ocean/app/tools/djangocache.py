@@ -0,0 +1,180 @@
+'''
+Django cache backends on blob storage.
+
+BlobCacheBackend keeps a Django cache in a blob container (through
+BlobCache), so the views use the ordinary cache API instead of reaching
+into the blob service themselves, and every response goes to one
+container. DirectoryCacheBackend is the same cache kept in a local
+directory (see localblobs.py), for development and tests.
+
+  * values are pickled into the blob;
+  * a value's expiry time goes in the blob's metadata, and an expired
+    blob reads as a miss (and is deleted);
+  * get_many, set_many and delete_many run their requests on a few
+    threads rather than one round trip after another.
+
+Keys made by cachekeys.response_key keep their namespace in the blob name
+('v1/raster/<sha1>'); delete_prefix drops a whole namespace. Other keys
+are hashed (see cachekeys.blob_name).
+'''
+import cPickle as pickle
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from azure import WindowsAzureMissingResourceError
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from app.settings import connection_properties
+from blobcache import BlobCache
+from cachekeys import blob_name
+from localblobs import LocalBlobService, MissingBlob
+
+# Requests in flight at once for get_many, set_many and delete_many.
+THREADS = 8
+
+MISSING = (WindowsAzureMissingResourceError, MissingBlob)
+
+class BlobCacheBackend(BaseCache):
+    '''
+    A Django cache in a blob container. See the module notes.
+
+    LOCATION: the container.
+    OPTIONS:  ACCOUNT_NAME and ACCOUNT_KEY of the storage account (default:
+              the one in connection_properties).
+    '''
+
+    def __init__(self, location, params):
+        BaseCache.__init__(self, params)
+        # Django 1.6 turns a TIMEOUT of None into 300; here it keeps values
+        # until they are deleted.
+        if params.get('timeout', params.get('TIMEOUT', 300)) is None:
+            self.default_timeout = None
+        self.location = location
+        self.options = params.get('OPTIONS', {})
+        self._blobs = None
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    @property
+    def store(self):
+        # Connected on first use, not when Django creates the cache (which
+        # would create the container on import).
+        with self.pool_lock:
+            if self._blobs is None:
+                self._blobs = self._store(self.location, self.options)
+        return self._blobs
+
+    def _store(self, location, options):
+        return BlobCache(options.get('ACCOUNT_NAME', connection_properties['STORAGE_ACCOUNT_NAME']),
+                         options.get('ACCOUNT_KEY', connection_properties['STORAGE_ACCOUNT_KEY']),
+                         location)
+
+    def _prefix(self, version=None):
+        # Where the blobs of a version of the cache go.
+        version = self.version if version is None else version
+        return '{0}v{1}/'.format(self.key_prefix + '/' if self.key_prefix else '', version)
+
+    def _name(self, key, version=None):
+        return self._prefix(version) + blob_name(key)
+
+    def _map(self, fn, items):
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(THREADS)
+        return self.pool.map(fn, items)
+
+    def _read(self, name):
+        # The value stored as name, or None (expired blobs are deleted).
+        try:
+            blob = self.store.blobstore.get_blob(self.store.container, name)
+        except MISSING:
+            return None
+        expires = blob.properties.get('x-ms-meta-expires')
+        if expires and float(expires) <= time.time():
+            self._delete(name)
+            return None
+        return pickle.loads(bytes(blob))
+
+    def _expires(self, timeout):
+        # When a value set now with timeout expires: None for never, and
+        # now for a timeout of 0 (as Django 1.7's get_backend_timeout).
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return None
+        return time.time() + max(0, timeout)
+
+    def _write(self, name, value, timeout):
+        expires = self._expires(timeout)
+        self.store.blobstore.put_block_blob_from_bytes(
+            self.store.container, name, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            x_ms_meta_name_values={'expires': '' if expires is None else repr(expires)})
+
+    def _delete(self, name):
+        try:
+            self.store.blobstore.delete_blob(self.store.container, name)
+        except MISSING:
+            pass
+
+    def get(self, key, default=None, version=None):
+        value = self._read(self._name(key, version))
+        return default if value is None else value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._write(self._name(key, version), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # Not atomic: two processes adding at once may both succeed.
+        name = self._name(key, version)
+        if self._read(name) is not None:
+            return False
+        self._write(name, value, timeout)
+        return True
+
+    def delete(self, key, version=None):
+        self._delete(self._name(key, version))
+
+    def has_key(self, key, version=None):
+        return self._read(self._name(key, version)) is not None
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = self._map(self._read, [self._name(k, version) for k in keys])
+        return dict((k, v) for k, v in zip(keys, values) if v is not None)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self._map(lambda item: self._write(self._name(item[0], version), item[1], timeout), list(data.items()))
+
+    def delete_many(self, keys, version=None):
+        self._map(self._delete, [self._name(k, version) for k in keys])
+
+    def delete_prefix(self, prefix, version=None):
+        '''
+        Delete every key starting with prefix: a namespace of cachekeys.py,
+        such as 'raster/'.
+        '''
+        self._clear(self._prefix(version) + prefix)
+
+    def clear(self):
+        # Every version.
+        self._clear(self.key_prefix + '/' if self.key_prefix else '')
+
+    def _clear(self, prefix):
+        marker = None
+        while True:
+            listing = self.store.blobstore.list_blobs(self.store.container, prefix=prefix or None, marker=marker)
+            self._map(self._delete, [blob.name for blob in listing.blobs])
+            marker = listing.next_marker
+            if not marker:
+                break
+
+class DirectoryCacheBackend(BlobCacheBackend):
+    '''
+    The same cache kept in a local directory. See localblobs.py.
+
+    LOCATION: the directory.
+    '''
+
+    def _store(self, location, options):
+        return BlobCache(None, None, 'cache', blobstore=LocalBlobService(location))
@@ -0,0 +1,199 @@
+'''
+Parallel, resumable blob downloads.
+
+A cube is hundreds of MB; fetched with one get_blob_to_path call it takes
+minutes on a cold instance, a dropped connection starts it over, and a
+file cut short mid-write can pass for a good one. Here the blob is split
+into byte ranges fetched by a few threads into a temporary file:
+
+  * a failed range is retried on its own, not the whole blob;
+  * finished ranges are recorded next to the temporary file, so a download
+    interrupted by a crash or restart picks up where it stopped (as long
+    as the blob's ETag has not changed);
+  * the result is checked against the blob's length and Content-MD5 (when
+    the blob has one) before it is renamed into place, so the cache only
+    ever holds complete files;
+  * a download can be cancelled between ranges (a prefetch giving way to
+    a request), keeping what it has for whoever resumes it.
+'''
+import base64
+import hashlib
+import json
+import os
+import threading
+import Queue
+
+# Bytes per range request.
+RANGE_BYTES = 8 * 1024 * 1024
+
+# Concurrent range requests per download.
+THREADS = 8
+
+# Attempts per range before the download is given up.
+RETRIES = 3
+
+class DownloadError(IOError):
+    '''
+    A blob could not be downloaded intact.
+    '''
+    pass
+
+class DownloadCancelled(DownloadError):
+    '''
+    The download was cancelled; the ranges it finished are kept.
+    '''
+    pass
+
+def byte_ranges(size, range_bytes=RANGE_BYTES):
+    '''
+    (start, end) inclusive byte ranges covering size bytes.
+    '''
+    return [(start, min(start + range_bytes, size) - 1) for start in range(0, size, range_bytes)]
+
+def file_md5(path, block=1024 * 1024):
+    '''
+    The base64 MD5 of a file, as in a Content-MD5 header.
+    '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            md5.update(data)
+    return base64.b64encode(md5.digest())
+
+class _Progress:
+    '''
+    The ranges of a partial download that are done, kept in a small JSON
+    file beside it.
+    '''
+
+    def __init__(self, path, etag, size):
+        self.path = path
+        self.etag = etag
+        self.size = size
+        self.done = set()
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            if saved['etag'] == etag and saved['size'] == size:
+                self.done = set(tuple(r) for r in saved['done'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def add(self, r):
+        with self.lock:
+            self.done.add(r)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'etag': self.etag, 'size': self.size, 'done': sorted(self.done)}, f)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+
+    def bytes_done(self):
+        with self.lock:
+            return sum(end - start + 1 for start, end in self.done)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def download(blob_service, container, name, fpath, callback=None,
+             range_bytes=RANGE_BYTES, threads=THREADS, retries=RETRIES, cancel=None):
+    '''
+    Download a blob to fpath. See the module notes.
+
+    callback: optional; called as callback(current, total) in bytes, like
+              the azure progress_callback.
+    cancel:   optional; checked before each range. Once it returns True the
+              download stops and raises DownloadCancelled.
+
+    Returns the blob's ETag.
+
+    Raises DownloadError when a range keeps failing, the blob changed
+    underneath the download, or the result does not match its Content-MD5.
+    Missing blob errors from the service are passed through.
+    '''
+    props = blob_service.get_blob_properties(container, name)
+    size = int(props['content-length'])
+    etag = props.get('etag')
+    md5 = props.get('content-md5')
+
+    part = fpath + '.part'
+    progress = _Progress(part + '.json', etag, size)
+    if not os.path.exists(part) or os.path.getsize(part) != size:
+        progress.done = set()
+        with open(part, 'wb') as f:
+            f.truncate(size)
+
+    todo = Queue.Queue()
+    for r in byte_ranges(size, range_bytes):
+        if r not in progress.done:
+            todo.put(r)
+    failures = []
+    cancelled = []
+
+    def report():
+        if callback:
+            callback(progress.bytes_done(), size)
+
+    def work():
+        with open(part, 'r+b') as out:
+            while not failures and not cancelled:
+                if cancel and cancel():
+                    cancelled.append(True)
+                    return
+                try:
+                    start, end = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                for attempt in range(retries):
+                    try:
+                        data = blob_service.get_blob(container, name, x_ms_range='bytes={0}-{1}'.format(start, end))
+                        if len(data) != end - start + 1:
+                            raise DownloadError('Short read of {0} at {1}'.format(name, start))
+                        out.seek(start)
+                        out.write(data)
+                        out.flush()
+                        progress.add((start, end))
+                        report()
+                        break
+                    except Exception as e:
+                        error = e
+                else:
+                    failures.append(error)
+
+    report()
+    workers = [threading.Thread(target=work) for i in range(max(1, min(threads, todo.qsize())))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for w in workers:
+        w.join()
+    if cancelled:
+        raise DownloadCancelled('Downloading {0} was cancelled'.format(name))
+    if failures:
+        raise DownloadError('Downloading {0} failed: {1}'.format(name, failures[0]))
+
+    # The blob must not have been replaced while its ranges were coming in.
+    if blob_service.get_blob_properties(container, name).get('etag') != etag:
+        progress.remove()
+        os.remove(part)
+        raise DownloadError('{0} changed during the download'.format(name))
+    if os.path.getsize(part) != size or (md5 and file_md5(part) != md5):
+        progress.remove()
+        os.remove(part)
+        raise DownloadError('{0} does not match its Content-MD5'.format(name))
+
+    progress.remove()
+    try:
+        os.rename(part, fpath)
+    except OSError:
+        # Windows won't rename over a file; someone else finished it first.
+        if not os.path.exists(fpath):
+            raise
+        os.remove(part)
+    return etag
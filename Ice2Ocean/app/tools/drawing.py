@@ -5,20 +5,185 @@ Nels
 '''
 # Note that this import ordering is significant.
 # the matplotlib.use(..) must occur before importing pyplot.
-#   Otherwise it will try to use the defualt rendering engine, 
+#   Otherwise it will try to use the defualt rendering engine,
 #     which doesn't work
 import matplotlib
 matplotlib.use('Agg')
 # The matplotlib backend must be changed before importing pyplot.
 import matplotlib.pyplot as plt
+from matplotlib import cm, colors
 import netCDF4 as nc
 import numpy as np
+import struct
+import zlib
 
-def plot_to_bytes(x,y,c,buf, cmin=None, cmax=None, cmap_name='binary'):
+# 'lut' writes the png directly from a colormap lookup table.
+# 'matplotlib' is the original pcolormesh/savefig path, kept as a fallback.
+DEFAULT_RENDER_MODE = 'lut'
 
-    if not cmin: cmin = c.min()
-    if not cmax: cmax = c.max()
+# Number of entries in a colormap lookup table (matches matplotlib's default).
+LUT_SIZE = 256
+
+# Agg places path vertices on a grid of 1/SUBPIXELS of a pixel.
+SUBPIXELS = 256
+
+# Lookup tables are cheap to build, but there is no reason to do it per request.
+_luts = {}
+
+def get_lut(cmap_name):
+    '''
+    Return the (LUT_SIZE, 4) uint8 RGBA lookup table for the named colormap.
+    '''
+    lut = _luts.get(cmap_name)
+    if lut is None:
+        cmap = cm.get_cmap(cmap_name, LUT_SIZE)
+        # Agg rounds colors to bytes (cmap(..., bytes=True) truncates).
+        lut = np.floor(cmap(np.arange(LUT_SIZE)) * 255 + 0.5).astype(np.uint8)
+        _luts[cmap_name] = lut
+    return lut
+
+def _figure_size(pixels):
+    '''
+    The size of the figure mpl_to_bytes draws pixels wide (or high): 
+    pixels / 100 inches at 100 dpi, which need not come back to pixels. 
+    Agg's canvas is the size truncated.
+    '''
+    return pixels / 100.0 * 100
+
+def _agg_edges(coords, pixels, flip=False):
+    '''
+    Where Agg puts the cell edges along one axis of the figure mpl_to_bytes 
+    draws, in subpixels from the left (or, flip, the top) of the figure.
+
+    coords: 1d cell edge coordinates (as handed to pcolormesh).
+    pixels: the size of the figure along this axis (see _figure_size).
+
+    The edges go through the same float operations as matplotlib's 
+    transforms, so they round to the same subpixels.
+    '''
+    coords = np.asarray(coords, dtype=np.float64)
+    lo, hi = coords.min(), coords.max()
+    size = _figure_size(pixels)
+    scale = size * (1.0 / (hi - lo))
+    offset = size * (-lo * (1.0 / (hi - lo)))
+    if flip:
+        scale, offset = -scale, -offset + int(size)
+    return np.floor((coords * scale + offset) * SUBPIXELS + 0.5).astype(np.int64)
+
+def _pixel_cells(coords, cells, pixels, flip=False):
+    '''
+    The mesh cells pcolormesh draws into each output pixel along one axis.
+
+    coords: 1d cell edge coordinates (as handed to pcolormesh).
+    cells:  the number of cells drawn along this axis.
+    pixels: the size of the figure along this axis (see _figure_size).
+    flip:   count pixels from the high-coordinate end (rows of an image).
+
+    A pixel reaches into at most two cells. Returns (late, early, cover): 
+    for each pixel of the canvas, the cell drawn last and the cell drawn 
+    first, and the subpixels (of SUBPIXELS) the late one covers.
+    '''
+    edges = _agg_edges(coords, pixels, flip)[:cells + 1]
+    reverse = edges[0] > edges[-1]
+    if reverse:
+        edges = edges[::-1]
+    start = np.arange(int(_figure_size(pixels))) * SUBPIXELS
+    end = start + SUBPIXELS
+    # The cells under the first and the last subpixel, low end first.
+    low = np.clip(np.searchsorted(edges, start, side='right') - 1, 0, cells - 1)
+    high = np.clip(np.searchsorted(edges, end - 1, side='right') - 1, 0, cells - 1)
+    cover = lambda i: np.clip(np.minimum(edges[i + 1], end) - np.maximum(edges[i], start), 0, SUBPIXELS)
+    if reverse:
+        # Cells are drawn in index order, high end first here.
+        return cells - 1 - low, cells - 1 - high, cover(low)
+    return high, low, cover(high)
+
+def colorize(c, cmin, cmax, cmap_name='binary', nodata=None):
+    '''
+    Normalize c against [cmin, cmax] and map it through the colormap lookup
+    table, rounding as matplotlib's Normalize and Colormap do. Masked, 
+    non-finite and nodata cells come back fully transparent.
+
+    Returns a uint8 RGBA array of shape c.shape + (4,).
+    '''
+    lut = get_lut(cmap_name)
+    data = np.ma.getdata(c)
+    invalid = np.ma.getmaskarray(c) | ~np.isfinite(data)
+    if nodata is not None:
+        invalid |= (data == nodata)
+
+    if cmax > cmin:
+        scaled = np.ma.getdata(colors.Normalize(cmin, cmax)(data))
+    else:
+        scaled = np.zeros(data.shape)
+    # In the precision matplotlib normalized in; under and over range take 
+    # the end colors.
+    scaled = scaled * scaled.dtype.type(LUT_SIZE)
+    scaled[invalid] = 0
+    idx = np.clip(np.floor(scaled), 0, LUT_SIZE - 1).astype(np.intp)
 
+    rgba = lut[idx]
+    rgba[invalid] = 0
+    return rgba
+
+def write_png(rgba, buf, level=6):
+    '''
+    Write an (height, width, 4) uint8 RGBA array to buf as a png.
+    '''
+    height, width = rgba.shape[:2]
+    # Every scanline is prefixed with its filter type (0, none).
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+
+    buf.write(b'\x89PNG\r\n\x1a\n')
+    buf.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+    buf.write(chunk(b'IDAT', zlib.compress(raw.tostring(), level)))
+    buf.write(chunk(b'IEND', b''))
+
+def lut_to_bytes(x,y,c,buf, cmin, cmax, cmap_name='binary', nodata=None):
+    '''
+    Render c to buf the way plot_to_bytes does, without a figure.
+
+    The output is len(x) by len(y) pixels (a pixel fewer for the sizes 
+    matplotlib rounds down, see _figure_size) spanning x[0]..x[-1] and
+    y[0]..y[-1], with north (the largest y) at the top. As with pcolormesh
+    the last row and column of c fall outside the mesh and are not drawn.
+
+    Where cells meet inside a pixel, the pixel takes the color of the cell 
+    Agg draws last that covers enough of it to count, and transparent 
+    cells let the ones drawn before show through, as in the figure.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if x.ndim > 1: x = x[0, :]
+    if y.ndim > 1: y = y[:, 0]
+    ny = min(c.shape[0], len(y) - 1)
+    nx = min(c.shape[1], len(x) - 1)
+
+    cells = colorize(c[:ny, :nx], cmin, cmax, cmap_name, nodata)
+    row_late, row_early, row_cover = _pixel_cells(y, ny, len(y), flip=True)
+    col_late, col_early, col_cover = _pixel_cells(x, nx, len(x))
+    # Agg starts from transparent white.
+    rgba = np.empty((len(row_late), len(col_late), 4), dtype=np.uint8)
+    rgba[:] = (255, 255, 255, 0)
+    # Agg fills a pixel when the area of it a cell covers (in subpixels 
+    # squared) comes to anything after shifting out SUBPIXELS: the shift 
+    # rounds away from zero for cells wound one way, but towards zero 
+    # (when just one axis runs backwards) for the other.
+    least = 1 if (x[-1] > x[0]) == (y[-1] > y[0]) else SUBPIXELS
+    # Paint in the order the cells are drawn (row by row).
+    for rows, row_area in ((row_early, SUBPIXELS - row_cover), (row_late, row_cover)):
+        for cols, col_area in ((col_early, SUBPIXELS - col_cover), (col_late, col_cover)):
+            paint = cells[rows][:, cols]
+            drawn = (np.outer(row_area, col_area) >= least) & (paint[..., 3] > 0)
+            rgba[drawn] = paint[drawn]
+    write_png(rgba, buf)
+
+def mpl_to_bytes(x,y,c,buf, cmin, cmax, cmap_name='binary'):
     plt.close()
     # fig = plt.figure(figsize=(float(len(y))/100.0, float(len(x))/100.0), dpi=100)
     fig = plt.figure(figsize=(float(len(x))/100.0, float(len(y))/100.0), dpi=100)
@@ -32,4 +197,25 @@ def plot_to_bytes(x,y,c,buf, cmin=None, cmax=None, cmap_name='binary'):
     ax.set_axis_off()
     ax.margins(0, 0)
     plt.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=None, hspace=None)
-    fig.savefig(buf, transparent=True)
\ No newline at end of file
+    fig.savefig(buf, transparent=True)
+
+def plot_to_bytes(x,y,c,buf, cmin=None, cmax=None, cmap_name='binary', mode=None, nodata=None):
+    '''
+    Render the field c on the mesh (x, y) into buf as a transparent png.
+
+    mode: 'lut' (default) or 'matplotlib'. The lut renderer only draws the
+          image; the matplotlib renderer is kept as a fallback.
+
+    nodata: optional sentinel value drawn as transparent (lut mode only;
+            mask the array for the matplotlib renderer).
+    '''
+    if not cmin: cmin = c.min()
+    if not cmax: cmax = c.max()
+
+    mode = mode or DEFAULT_RENDER_MODE
+    if mode == 'lut':
+        lut_to_bytes(x, y, c, buf, cmin, cmax, cmap_name, nodata)
+    elif mode == 'matplotlib':
+        mpl_to_bytes(x, y, c, buf, cmin, cmax, cmap_name)
+    else:
+        raise ValueError("Unknown render mode '{0}'".format(mode))
@@ -0,0 +1,103 @@
+'''
+Precompressed response bodies.
+
+CSV series, WKT and JSON compress to a fraction of their size, but were
+stored and sent as they are. Here a body is compressed once, when it is
+cached, and stored with its encoding; a hit is sent as stored to clients
+whose Accept-Encoding takes it, and decoded only for those that don't.
+Nothing is compressed on a hit, and the blob cache and local tiers hold
+(and move) the smaller body.
+
+Stored bodies are '<encoding>:<bytes>', encoding being gzip, br (when
+the brotli module is installed) or identity (images, already compressed,
+and bodies too small to gain).
+'''
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing.
+COMPRESSIBLE = ('text/', 'application/json', 'application/xml')
+
+# Bodies smaller than this (bytes) are stored as they are.
+MIN_BYTES = 512
+
+GZIP_LEVEL = 6
+
+def _gzip(data):
+    c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+def _gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def available(coding):
+    '''
+    Whether bodies can be stored in coding here.
+    '''
+    return coding in ('gzip', 'identity') or (coding == 'br' and brotli is not None)
+
+def pack(body, content_type, coding='gzip'):
+    '''
+    body as stored: compressed with coding (gzip, or br, which falls back to
+    gzip without the brotli module) if content_type is worth compressing.
+    '''
+    if not content_type.startswith(COMPRESSIBLE) or len(body) < MIN_BYTES:
+        coding = 'identity'
+    elif not available(coding):
+        coding = 'gzip'
+    if coding == 'gzip':
+        body = _gzip(body)
+    elif coding == 'br':
+        body = brotli.compress(body)
+    return coding + ':' + body
+
+def unpack(stored):
+    '''
+    (encoding, bytes) of a stored body.
+    '''
+    coding, sep, data = stored.partition(':')
+    return coding, data
+
+def decode(coding, data):
+    '''
+    The original body from data in coding.
+    '''
+    if coding == 'gzip':
+        return _gunzip(data)
+    if coding == 'br':
+        return brotli.decompress(data)
+    return data
+
+def accepts(accept_encoding, coding):
+    '''
+    Whether a client sending the Accept-Encoding header accept_encoding
+    takes coding.
+    '''
+    if coding == 'identity':
+        return True
+    for part in (accept_encoding or '').split(','):
+        name, sep, params = part.strip().partition(';')
+        if name.strip().lower() not in (coding, '*'):
+            continue
+        try:
+            q = float(params.strip()[2:]) if params.strip().startswith('q=') else 1.0
+        except ValueError:
+            q = 1.0
+        return q > 0
+    return False
+
+def negotiate(stored, accept_encoding):
+    '''
+    (body, encoding) to send for a stored body: as stored if the client
+    takes it, else decoded (encoding None).
+    '''
+    coding, data = unpack(stored)
+    if coding == 'identity':
+        return data, None
+    if accepts(accept_encoding, coding):
+        return data, coding
+    return decode(coding, data), None
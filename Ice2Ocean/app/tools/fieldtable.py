@@ -4,12 +4,21 @@ Note that this interacts with the BlobCache to invalidate stale data.
 
 -Nels
 '''
+import time
 
 class FieldManager:
 
+    # Seconds a row's revision is trusted before it is looked up again.
+    REVISION_SECONDS = 60
+
+    # Seconds the list of parameters is trusted before it is looked up again.
+    CATALOG_SECONDS = 60
+
     def __init__(self, table_service, table):
         self.table_service = table_service
         self.table = table
+        self.revisions = {}
+        self.catalog = (0, frozenset())
 
     def getInfo(self, param):
         '''
@@ -24,4 +33,25 @@ class FieldManager:
         '''
         result = self.table_service.query_entities(self.table)
         return [r.__dict__ for r in result]
-        
+
+    def revision(self, param):
+        '''
+        The revision of the parameter's row (its ETag), which changes whenever
+        the row does. Looked up at most every REVISION_SECONDS.
+        '''
+        when, etag = self.revisions.get(param, (0, None))
+        if time.time() - when >= self.REVISION_SECONDS:
+            etag = self.getInfo(param).get('etag')
+            self.revisions[param] = (time.time(), etag)
+        return etag
+
+    def params(self):
+        '''
+        The names of every known parameter. Looked up at most every 
+        CATALOG_SECONDS.
+        '''
+        when, names = self.catalog
+        if time.time() - when >= self.CATALOG_SECONDS:
+            names = frozenset(r['PartitionKey'] for r in self.getAll())
+            self.catalog = (time.time(), names)
+        return names
@@ -0,0 +1,245 @@
+'''
+SnowModel grid descriptions.
+
+The .dat cubes written by SnowModel are bare float32 arrays with no shape
+information of their own. Each cube has a GrADS style descriptor (.ctl)
+sidecar in the model output container that gives the grid dimensions, the
+no-data value and the time axis. GridHeader reads that descriptor so the
+cube can be addressed band by band instead of being read whole.
+
+A minimal descriptor looks like:
+
+    DSET ^roff.dat
+    UNDEF -9999.0
+    XDEF 1810 LINEAR 1 1
+    YDEF 900 LINEAR 1 1
+    TDEF 12784 LINEAR 01sep1979 1dy
+'''
+import datetime
+import re
+
+import numpy as np
+import pyproj
+
+from app.settings import grid_properties
+
+# The projection of the model grid.
+projection = pyproj.Proj(grid_properties['PROJECTION'])
+
+# GrADS month abbreviations, for the TDEF start time.
+_months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+# [hh[:mm]Z][dd]mmmyyyy
+_gradstime = re.compile(r'^(?:(\d{1,2})(?::(\d{2}))?z)?(\d{1,2})?([a-z]{3})(\d{4})$')
+
+# 1dy, 6hr, 1mo ...
+_gradsstep = re.compile(r'^(\d+)(mn|hr|dy|mo|yr)$')
+
+def parse_gradstime(s):
+    '''
+    Convert a GrADS absolute time (ex. 01sep1979, 12Z01sep1979) to a datetime.
+    '''
+    m = _gradstime.match(s.strip().lower())
+    if not m:
+        raise ValueError("Unrecognized GrADS time '{0}'".format(s))
+    hour, minute, day, month, year = m.groups()
+    return datetime.datetime(int(year), _months.index(month) + 1, int(day or 1),
+                             int(hour or 0), int(minute or 0))
+
+def parse_gradsstep(s):
+    '''
+    Convert a GrADS time increment (ex. 1dy, 6hr) to a (count, unit) pair.
+    '''
+    m = _gradsstep.match(s.strip().lower())
+    if not m:
+        raise ValueError("Unrecognized GrADS time increment '{0}'".format(s))
+    return int(m.group(1)), m.group(2)
+
+
+class GridHeader:
+    '''
+    The shape, layout and time axis of one SnowModel .dat cube.
+
+    nx, ny, nt: grid dimensions; the cube is laid out (nt, ny, nx).
+    undef:      the no-data value.
+    xdef, ydef: (start, step) of the cell coordinates along each axis.
+    tstart:     datetime of the first band (None if unknown).
+    tstep:      (count, unit) increment between bands, unit in mn/hr/dy/mo/yr.
+    dtype:      numpy dtype string of a cell.
+    '''
+
+    def __init__(self, nx, ny, nt=None, undef=None, xdef=(1.0, 1.0), ydef=(1.0, 1.0),
+                 tstart=None, tstep=(1, 'dy'), dtype='<f4'):
+        self.nx = int(nx)
+        self.ny = int(ny)
+        self.nt = None if nt is None else int(nt)
+        self.undef = undef
+        self.xdef = xdef
+        self.ydef = ydef
+        self.tstart = tstart
+        self.tstep = tstep
+        self.dtype = dtype
+
+    @classmethod
+    def default(cls):
+        '''
+        The grid to assume for a cube without a descriptor.
+        '''
+        return cls(grid_properties['NX'], grid_properties['NY'],
+                   undef=grid_properties['UNDEF'])
+
+    @classmethod
+    def parse(cls, text):
+        '''
+        Build a header from the text of a GrADS descriptor.
+
+        Only the entries needed to address the cube are read; everything
+        else (TITLE, VARS...) is ignored.
+        '''
+        h = cls.default()
+        for line in text.splitlines():
+            parts = line.split()
+            if not parts or parts[0].startswith('*'):
+                continue
+            key = parts[0].upper()
+            if key == 'UNDEF':
+                h.undef = float(parts[1])
+            elif key in ('XDEF', 'YDEF'):
+                n = int(parts[1])
+                axis = (1.0, 1.0)
+                if len(parts) >= 5 and parts[2].upper() == 'LINEAR':
+                    axis = (float(parts[3]), float(parts[4]))
+                if key == 'XDEF':
+                    h.nx, h.xdef = n, axis
+                else:
+                    h.ny, h.ydef = n, axis
+            elif key == 'TDEF':
+                h.nt = int(parts[1])
+                if len(parts) >= 5 and parts[2].upper() == 'LINEAR':
+                    h.tstart = parse_gradstime(parts[3])
+                    h.tstep = parse_gradsstep(parts[4])
+            elif key == 'OPTIONS':
+                opts = [o.lower() for o in parts[1:]]
+                if 'big_endian' in opts:
+                    h.dtype = '>f4'
+                elif 'little_endian' in opts:
+                    h.dtype = '<f4'
+        return h
+
+    def dumps(self, dset):
+        '''
+        The text of a GrADS descriptor for this header.
+
+        dset: file name of the cube, relative to the descriptor.
+        '''
+        lines = ['DSET ^{0}'.format(dset)]
+        if self.undef is not None:
+            lines.append('UNDEF {0!r}'.format(float(self.undef)))
+        lines.append('XDEF {0} LINEAR {1!r} {2!r}'.format(self.nx, float(self.xdef[0]), float(self.xdef[1])))
+        lines.append('YDEF {0} LINEAR {1!r} {2!r}'.format(self.ny, float(self.ydef[0]), float(self.ydef[1])))
+        if self.nt is not None:
+            if self.tstart is not None:
+                t = self.tstart
+                lines.append('TDEF {0} LINEAR {1:02d}:{2:02d}Z{3:02d}{4}{5:04d} {6}{7}'.format(
+                    self.nt, t.hour, t.minute, t.day, _months[t.month - 1], t.year,
+                    self.tstep[0], self.tstep[1]))
+            else:
+                lines.append('TDEF {0}'.format(self.nt))
+        lines.append('OPTIONS {0}'.format('big_endian' if self.dtype.startswith('>') else 'little_endian'))
+        return '\n'.join(lines) + '\n'
+
+    @property
+    def bandsize(self):
+        '''
+        Size of a single band, in bytes.
+        '''
+        return self.nx * self.ny * np.dtype(self.dtype).itemsize
+
+    def bands_in(self, nbytes):
+        '''
+        The number of complete bands in a file of nbytes, capped by TDEF.
+        '''
+        n = nbytes // self.bandsize
+        if self.nt is not None:
+            n = min(n, self.nt)
+        return int(n)
+
+    def band(self, when):
+        '''
+        The band holding the datetime when, from the TDEF time axis.
+
+        Raises a ValueError if the cube has no time axis or when falls
+        before its first band.
+        '''
+        if self.tstart is None:
+            raise ValueError('The cube has no time axis')
+        count, unit = self.tstep
+        if unit in ('mo', 'yr'):
+            months = (when.year - self.tstart.year) * 12 + when.month - self.tstart.month
+            steps = months // (count * 12 if unit == 'yr' else count)
+        else:
+            dt = when - self.tstart
+            seconds = dt.days * 86400 + dt.seconds
+            steps = seconds // (count * {'mn': 60, 'hr': 3600, 'dy': 86400}[unit])
+        if steps < 0:
+            raise ValueError('{0} is before the start of the cube'.format(when))
+        return int(steps)
+
+    def when(self, band):
+        '''
+        The datetime of the given band (the inverse of band()).
+        '''
+        if self.tstart is None:
+            raise ValueError('The cube has no time axis')
+        count, unit = self.tstep
+        if unit in ('mo', 'yr'):
+            months = self.tstart.month - 1 + band * (count * 12 if unit == 'yr' else count)
+            return self.tstart.replace(year=self.tstart.year + months // 12, month=months % 12 + 1)
+        seconds = band * count * {'mn': 60, 'hr': 3600, 'dy': 86400}[unit]
+        return self.tstart + datetime.timedelta(seconds=seconds)
+
+    def geotransform(self):
+        '''
+        Returns (xmn, deltax, ymn, deltay): the projected coordinates of the
+        center of cell (0, 0) and the cell size.
+
+        GrADS index axes (LINEAR 1 1) carry no georeferencing, so those fall
+        back to grid_properties.
+        '''
+        if self.xdef == (1.0, 1.0) and self.ydef == (1.0, 1.0):
+            return (grid_properties['XMN'], grid_properties['DELTAX'],
+                    grid_properties['YMN'], grid_properties['DELTAY'])
+        return (self.xdef[0], self.xdef[1], self.ydef[0], self.ydef[1])
+
+    def coords(self):
+        '''
+        Projected coordinates of the cell centers, as 1d (x, y) arrays.
+        '''
+        xmn, dx, ymn, dy = self.geotransform()
+        return xmn + dx * np.arange(self.nx), ymn + dy * np.arange(self.ny)
+
+    def cells(self, lons, lats):
+        '''
+        The (col, row) of the cells holding each lon/lat, as integer arrays.
+        Points off the grid are -1 in both.
+        '''
+        xmn, dx, ymn, dy = self.geotransform()
+        x, y = projection(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        x = np.asarray(x)
+        y = np.asarray(y)
+        bad = ~(np.isfinite(x) & np.isfinite(y))
+        x[bad] = y[bad] = 0
+        col = np.floor((x - xmn) / dx + 0.5).astype(np.intp)
+        row = np.floor((y - ymn) / dy + 0.5).astype(np.intp)
+        off = bad | (col < 0) | (col >= self.nx) | (row < 0) | (row >= self.ny)
+        col[off] = -1
+        row[off] = -1
+        return col, row
+
+    def open(self, fpath, nbytes):
+        '''
+        Memory map the cube at fpath (nbytes long) as a read-only
+        (time, ny, nx) array. Nothing is read until a band is touched.
+        '''
+        return np.memmap(fpath, dtype=self.dtype, mode='r',
+                         shape=(self.bands_in(nbytes), self.ny, self.nx))
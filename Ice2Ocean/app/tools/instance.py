@@ -27,6 +27,40 @@ for t in todo:
 		b._label(t,'Error',msg=m)
 		continue
 	
+	# SnowModel cubes get their overview pyramid built.
+	if t.endswith('.dat'):
+		try:
+			print 'Building overviews for {0}...'.format(t)
+			b.build_overviews(t[:-len('.dat')])
+		except Exception as e:
+			m = 'Building overviews failed.'
+			m = '{0} on {1}: {2} More details: {3}'.format(iam, t, m, e)
+			print m
+			b._label(t,'Error', msg=m)
+			continue
+		# And a time-major copy for pixel time series.
+		try:
+			print 'Building the time series copy of {0}...'.format(t)
+			b.build_series(t[:-len('.dat')])
+		except Exception as e:
+			m = 'Building the time series copy failed.'
+			m = '{0} on {1}: {2} More details: {3}'.format(iam, t, m, e)
+			print m
+			b._label(t,'Error', msg=m)
+			continue
+
+	# A chunked, compressed copy for the readers.
+	if t.endswith('.dat') or t.endswith('.nc'):
+		try:
+			print 'Compressing {0}...'.format(t)
+			b.build_compressed(t)
+		except Exception as e:
+			m = 'Building the compressed copy failed.'
+			m = '{0} on {1}: {2} More details: {3}'.format(iam, t, m, e)
+			print m
+			b._label(t,'Error', msg=m)
+			continue
+
 	# Construct images of the depth slices
 	# for each parameter with a geotemporal index.
 	try:
@@ -0,0 +1,130 @@
+'''
+A local directory standing in for the Azure blob service.
+
+For development and tests the response cache (see djangocache.py) can be
+kept in a directory instead of a storage account. LocalBlobService
+implements just the part of azure.storage.BlobService that BlobCache and
+the cache backends use, with the same arguments and results: blobs are
+files under <directory>/<container>/, and their metadata sits beside
+them in a .meta JSON file.
+'''
+import email.utils
+import json
+import os
+import threading
+
+class MissingBlob(KeyError):
+    '''
+    The blob (or container) does not exist; WindowsAzureMissingResourceError
+    in the blob service.
+    '''
+    pass
+
+class BlobResult(bytes):
+    '''
+    A blob's bytes, with its headers as properties (as azure's BlobResult).
+    '''
+
+    def __new__(cls, blob, properties):
+        return bytes.__new__(cls, blob)
+
+    def __init__(self, blob, properties):
+        self.properties = properties
+
+class _Blob:
+    def __init__(self, name):
+        self.name = name
+
+class _Listing:
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.next_marker = ''
+
+class LocalBlobService:
+    '''
+    Blob containers in a directory.
+
+    directory: where the containers go.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, container, name):
+        # Blob names may have '/' in them, as virtual directories.
+        return os.path.join(self.directory, container, *name.split('/'))
+
+    def create_container(self, container_name, fail_on_exist=False):
+        path = os.path.join(self.directory, container_name)
+        if os.path.isdir(path):
+            return False
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+        return True
+
+    def put_block_blob_from_bytes(self, container_name, blob_name, blob, x_ms_meta_name_values=None):
+        path = self._path(container_name, blob_name)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        # Written aside and renamed, so readers never see half a blob.
+        tmp = '{0}.{1}-{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp + '.meta', 'w') as f:
+            json.dump(x_ms_meta_name_values or {}, f)
+        with open(tmp, 'wb') as f:
+            f.write(blob)
+        for src, dst in ((tmp + '.meta', path + '.meta'), (tmp, path)):
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.rename(src, dst)
+
+    def get_blob_properties(self, container_name, blob_name):
+        path = self._path(container_name, blob_name)
+        try:
+            with open(path + '.meta', 'r') as f:
+                meta = json.load(f)
+            stat = os.stat(path)
+        except (IOError, OSError, ValueError):
+            raise MissingBlob(blob_name)
+        props = dict(('x-ms-meta-' + k.lower(), v) for k, v in meta.items())
+        props['content-length'] = str(stat.st_size)
+        props['last-modified'] = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        props['etag'] = '"{0:x}-{1:x}"'.format(int(stat.st_mtime * 1e6), stat.st_size)
+        return props
+
+    def get_blob(self, container_name, blob_name):
+        props = self.get_blob_properties(container_name, blob_name)
+        try:
+            with open(self._path(container_name, blob_name), 'rb') as f:
+                return BlobResult(f.read(), props)
+        except (IOError, OSError):
+            raise MissingBlob(blob_name)
+
+    def get_blob_to_bytes(self, container_name, blob_name):
+        return bytes(self.get_blob(container_name, blob_name))
+
+    def delete_blob(self, container_name, blob_name):
+        path = self._path(container_name, blob_name)
+        if not os.path.exists(path):
+            raise MissingBlob(blob_name)
+        for p in (path, path + '.meta'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def list_blobs(self, container_name, prefix=None, marker=None):
+        root = os.path.join(self.directory, container_name)
+        names = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for f in filenames:
+                if f.endswith('.meta') or f.endswith('.tmp'):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, f), root).replace(os.sep, '/')
+                if not prefix or name.startswith(prefix):
+                    names.append(name)
+        return _Listing([_Blob(name) for name in sorted(names)])
@@ -0,0 +1,314 @@
+'''
+The local cache of downloaded model output.
+
+Blobs fetched from the model output container (cubes, overviews, netCDF
+files, descriptors) are kept on local disk so the next request does not
+download them again. LocalCache keeps that directory within a byte
+budget by evicting the least recently used files, never one that is
+pinned (open in this process), and only ever files it put there itself:
+everything else in the temp directory is left alone.
+
+What is cached, how big, which version (the blob's ETag) and when it was
+last used lives in a small index
+file in the cache directory, so starting up does not mean walking and
+stat-ing the whole directory. The index is rewritten when files come and
+go, and at most every FLUSH_SECONDS for access times.
+'''
+import json
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+from app.settings import cache_properties
+from singleflight import FileLock, lock_path
+
+# Seconds between index writes that only record access times.
+FLUSH_SECONDS = 30
+
+# Seconds without progress after which a download's lock is broken.
+STALL_SECONDS = 300
+
+class LocalCache:
+    '''
+    A size bounded, least recently used cache of files in a directory.
+
+    directory: where the files live (default: the temp directory).
+    budget:    bytes the cached files may take up; past it the least
+               recently used unpinned files are deleted.
+    '''
+
+    INDEX = 'localcache.json'
+
+    def __init__(self, directory=None, budget=None):
+        self.directory = directory or cache_properties['DIRECTORY'] or tempfile.gettempdir()
+        self.budget = budget if budget is not None else cache_properties['BUDGET_BYTES']
+        self.lock = threading.RLock()
+        self.pins = {}
+        self.saved = 0
+        self.removed = set()
+        self.entries = self._load()
+
+    def _index_path(self):
+        return os.path.join(self.directory, self.INDEX)
+
+    def _load(self):
+        try:
+            with open(self._index_path(), 'r') as f:
+                # Indexes written before versions were kept have none.
+                return dict((name, (tuple(e) + (None,))[:3]) for name, e in json.load(f).items())
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _merge(self):
+        # Called with the lock held. Other processes share the index, so
+        # their additions (and later access times) are taken in.
+        for name, (size, atime, version) in self._load().items():
+            if name in self.removed:
+                continue
+            if name in self.entries:
+                mine = self.entries[name]
+                self.entries[name] = (mine[0], max(atime, mine[1]), mine[2])
+            elif os.path.exists(self.path(name)):
+                self.entries[name] = (size, atime, version)
+        self.removed.clear()
+
+    def _save(self):
+        # Called with the lock held.
+        self._merge()
+        path = self._index_path()
+        tmp = '{0}.{1}-{2}'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+            self.saved = time.time()
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def path(self, name):
+        '''
+        The local path for name (which may not be cached).
+        '''
+        return os.path.join(self.directory, name)
+
+    def partial_path(self, name):
+        '''
+        Where fetch has name written before it is renamed into place. The
+        name is stable, so a download that gave way can be resumed.
+        '''
+        root, ext = os.path.splitext(self.path(name))
+        return root + '.partial' + ext
+
+    def get(self, name):
+        '''
+        The local path of name if it is cached (marking it used), else None.
+        '''
+        path = self.path(name)
+        if not os.path.exists(path):
+            with self.lock:
+                if self.entries.pop(name, None) is not None:
+                    self.removed.add(name)
+                    self._save()
+            return None
+        with self.lock:
+            if name not in self.entries:
+                # Perhaps another process put it there.
+                self._merge()
+            size, atime, version = self.entries.get(name) or (os.path.getsize(path), 0, None)
+            self.entries[name] = (size, time.time(), version)
+            if time.time() - self.saved > FLUSH_SECONDS:
+                self._save()
+        return path
+
+    def add(self, name, version=None):
+        '''
+        Record a file just placed at path(name), then evict down to the
+        budget. Returns its path.
+
+        version: optional; what version of the blob it is (its ETag).
+        '''
+        path = self.path(name)
+        with self.lock:
+            self._merge()
+            self.entries[name] = (os.path.getsize(path), time.time(), version)
+            self.evict()
+            self._save()
+        return path
+
+    def fetch(self, name, download, timeout=None, background=False):
+        '''
+        The local path of name, calling download(path, heartbeat) to put it 
+        there first if it is not cached. download returns the version it 
+        fetched (or None), and should call heartbeat() as it makes progress.
+
+        Only one process (or thread) on the host downloads name at a time, 
+        under a lock file; the others wait for it and then find the file in 
+        place. A download that makes no progress for STALL_SECONDS is taken 
+        to have died and its lock is broken.
+
+        download is given a path next to the cached one (same extension, so
+        np.savez and the like write where they are told), and its file is
+        renamed into place only once it returns: nobody ever finds half a
+        file under name.
+
+        timeout:    seconds to wait for someone else's download (default 
+                    cache_properties DOWNLOAD_TIMEOUT); LockTimeout after that.
+        background: a prefetch. Foreground callers that have to wait mark 
+                    name as wanted, and a background download should check
+                    wanted(name) and give way (leaving a partial file to be
+                    resumed).
+        '''
+        path = self.get(name)
+        if path is not None:
+            return path
+        timeout = cache_properties['DOWNLOAD_TIMEOUT'] if timeout is None else timeout
+        lock = FileLock(lock_path('download:' + name, self.directory),
+                        timeout=timeout, poll=0.2, stale=STALL_SECONDS)
+        if not lock.acquire(blocking=False):
+            marker = None if background else self._want(name)
+            try:
+                lock.acquire()
+            finally:
+                if marker:
+                    try:
+                        os.remove(marker)
+                    except OSError:
+                        pass
+        try:
+            path = self.get(name)
+            if path is None:
+                partial = self.partial_path(name)
+                version = download(partial, lock.touch)
+                path = self.path(name)
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(partial, path)
+                path = self.add(name, version)
+        finally:
+            lock.release()
+        return path
+
+    def _want(self, name):
+        marker = lock_path('wanted:' + name, self.directory)
+        try:
+            with open(marker, 'a'):
+                os.utime(marker, None)
+        except (IOError, OSError):
+            return None
+        return marker
+
+    def wanted(self, name):
+        '''
+        Whether a foreground caller is waiting for name's download.
+        '''
+        try:
+            age = time.time() - os.path.getmtime(lock_path('wanted:' + name, self.directory))
+        except OSError:
+            return False
+        return age < cache_properties['DOWNLOAD_TIMEOUT']
+
+    def version(self, name):
+        '''
+        The version recorded for name, None if unknown or not cached.
+        '''
+        with self.lock:
+            entry = self.entries.get(name)
+            return entry[2] if entry else None
+
+    def pin(self, name, owner=None):
+        '''
+        Keep name from being evicted: until owner is garbage collected if
+        an owner (the open dataset or memory map) is given, otherwise until
+        unpin().
+        '''
+        with self.lock:
+            refs = self.pins.setdefault(name, [])
+            if owner is None:
+                refs.append(None)
+            else:
+                refs.append(weakref.ref(owner, lambda ref: self._drop_pin(name, ref)))
+
+    def _drop_pin(self, name, ref):
+        with self.lock:
+            refs = self.pins.get(name, [])
+            if ref in refs:
+                refs.remove(ref)
+            if not refs:
+                self.pins.pop(name, None)
+
+    def unpin(self, name):
+        '''
+        Release a pin taken without an owner.
+        '''
+        self._drop_pin(name, None)
+
+    def pinned(self, name):
+        with self.lock:
+            return any(r is None or r() is not None for r in self.pins.get(name, []))
+
+    def total(self):
+        '''
+        Bytes taken up by the cached files.
+        '''
+        with self.lock:
+            return sum(e[0] for e in self.entries.values())
+
+    def evict(self, budget=None):
+        '''
+        Delete least recently used, unpinned files until the cache fits in
+        budget bytes (default: the cache's budget). Returns the names
+        deleted.
+        '''
+        budget = self.budget if budget is None else budget
+        deleted = []
+        with self.lock:
+            total = self.total()
+            for name, (size, atime, version) in sorted(self.entries.items(), key=lambda e: e[1][1]):
+                if total <= budget:
+                    break
+                if self.pinned(name):
+                    continue
+                try:
+                    if os.path.exists(self.path(name)):
+                        os.remove(self.path(name))
+                except OSError:
+                    # Open in another process (Windows); try again next time.
+                    continue
+                del self.entries[name]
+                self.removed.add(name)
+                total -= size
+                deleted.append(name)
+            if deleted:
+                self._save()
+        return deleted
+
+    def remove(self, name):
+        '''
+        Delete name from the cache, pinned or not. Returns False if it could
+        not be deleted.
+        '''
+        with self.lock:
+            try:
+                if os.path.exists(self.path(name)):
+                    os.remove(self.path(name))
+            except OSError:
+                return False
+            self.entries.pop(name, None)
+            self.removed.add(name)
+            self._save()
+            return True
+
+    def listing(self):
+        '''
+        The cached files, most recently used first, as dicts of file, size,
+        last_access (seconds since the epoch), version and pinned.
+        '''
+        with self.lock:
+            return [{'file': name, 'size': size, 'last_access': atime, 'version': version,
+                     'pinned': self.pinned(name)}
+                    for name, (size, atime, version) in sorted(self.entries.items(), key=lambda e: -e[1][1])]
@@ -0,0 +1,137 @@
+'''
+An in-process cache of open datasets and decoded arrays.
+
+Requests for the same file follow each other closely (tiles of one map,
+the days of a time slider), and reopening the dataset, rereading the band
+and redoing coordinate transforms for each one is most of the work of a
+cache miss. MemoryCache keeps them in memory:
+
+  * decoded arrays count against a byte budget, at their exact size
+    (ndarray.nbytes), least recently used first out;
+  * open handles (netCDF datasets, memory maps) hold no decoded data, so
+    they are capped by number instead;
+  * keys start with (blob name, version), the version being the blob's
+    ETag. Once something of a blob is stored under a new version,
+    everything stored under the old one is dropped.
+'''
+import collections
+import threading
+
+import numpy as np
+
+def _nbytes(value):
+    # Decoded bytes held by value; None for handles.
+    if isinstance(value, np.memmap):
+        return None
+    if isinstance(value, np.ma.MaskedArray):
+        return value.data.nbytes + (value.mask.nbytes if value.mask is not np.ma.nomask else 0)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        sizes = [_nbytes(v) for v in value]
+        return None if None in sizes else sum(sizes)
+    return None
+
+class MemoryCache:
+    '''
+    A least recently used cache of arrays and handles. See the module notes.
+
+    budget:      bytes of decoded arrays kept.
+    max_handles: open handles kept.
+    '''
+
+    def __init__(self, budget, max_handles=32):
+        self.budget = budget
+        self.max_handles = max_handles
+        self.entries = collections.OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.handles = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''
+        The value stored under key (name, version, ...), or None.
+        '''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes=None):
+        '''
+        Store value under key (name, version, ...). Arrays (or tuples of
+        them) count their nbytes against the budget; anything else is a
+        handle, unless its size is given as nbytes. Returns value.
+        '''
+        size = _nbytes(value) if nbytes is None else nbytes
+        with self.lock:
+            name, version = key[0], key[1]
+            if self.versions.get(name, version) != version:
+                self._drop(name)
+            self.versions[name] = version
+            self._remove(key)
+            self.entries[key] = (value, size)
+            if size is None:
+                self.handles += 1
+            else:
+                self.nbytes += size
+            self._evict()
+        return value
+
+    def invalidate(self, name):
+        '''
+        Drop everything stored for the blob name.
+        '''
+        with self.lock:
+            self._drop(name)
+            self.versions.pop(name, None)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+            self.versions.clear()
+
+    def stats(self):
+        '''
+        Counters, as a dict: hits, misses, evictions, entries, handles,
+        bytes and budget.
+        '''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'handles': self.handles,
+                    'bytes': self.nbytes, 'budget': self.budget}
+
+    # Called with the lock held.
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        if entry[1] is None:
+            self.handles -= 1
+        else:
+            self.nbytes -= entry[1]
+        return True
+
+    def _drop(self, name):
+        for key in [k for k in self.entries if k[0] == name]:
+            self._remove(key)
+
+    def _evict(self):
+        for key in list(self.entries):
+            if self.nbytes <= self.budget and self.handles <= self.max_handles:
+                break
+            size = self.entries[key][1]
+            if (size is None and self.handles > self.max_handles) or \
+               (size is not None and self.nbytes > self.budget):
+                self._remove(key)
+                self.evictions += 1
@@ -0,0 +1,121 @@
+'''
+Reduced resolution overviews of the SnowModel cubes.
+
+Each overview is a cube of its own (param.ovN.dat with a param.ovN.ctl
+descriptor) where every cell is the mean of an N by N block of the full
+resolution grid. No-data cells are left out of the means; a block with
+no data at all is no-data in the overview.
+
+Overviews are built once, when a cube is ingested, and let low zoom tiles
+and small images read a fraction of the bytes.
+'''
+import os
+
+import numpy as np
+
+from app.settings import grid_properties
+from grid import GridHeader
+
+# Reduction factors, finest first. Each level halves the previous one.
+OVERVIEW_FACTORS = (2, 4, 8, 16)
+
+def overview_name(param, factor):
+    '''
+    The cube name (no extension) of the given overview of param.
+    '''
+    return '{0}.ov{1}'.format(param, factor)
+
+def overview_header(header, factor):
+    '''
+    The GridHeader of the overview of a cube at the given factor.
+
+    The overview's cell centers are written as real XDEF/YDEF coordinates
+    so it georeferences on its own.
+    '''
+    xmn, dx, ymn, dy = header.geotransform()
+    shift = (factor - 1) / 2.0
+    return GridHeader(-(-header.nx // factor), -(-header.ny // factor), header.nt,
+                      undef=header.undef,
+                      xdef=(xmn + shift * dx, dx * factor),
+                      ydef=(ymn + shift * dy, dy * factor),
+                      tstart=header.tstart, tstep=header.tstep, dtype=header.dtype)
+
+def _block_sum(a, factor):
+    '''
+    Sum a (ny, nx) array over factor by factor blocks. Edge blocks are
+    partial.
+    '''
+    ny, nx = a.shape
+    py = -ny % factor
+    px = -nx % factor
+    if py or px:
+        a = np.pad(a, ((0, py), (0, px)), mode='constant')
+    return a.reshape(a.shape[0] // factor, factor, a.shape[1] // factor, factor).sum(axis=3).sum(axis=1)
+
+def reduce_band(band, undef, factors=OVERVIEW_FACTORS):
+    '''
+    Block means of a single band at each factor, ignoring no-data cells.
+
+    The levels cascade: each one is reduced from the sums and counts of the
+    previous level, so the means stay exact without rereading the band.
+
+    Returns a list of float32 arrays, one per factor.
+    '''
+    data = np.asarray(band, dtype=np.float64)
+    valid = np.isfinite(data)
+    if undef is not None:
+        valid &= (data != undef)
+    sums = np.where(valid, data, 0.0)
+    counts = valid.astype(np.float64)
+
+    levels = []
+    done = 1
+    for f in factors:
+        step = f // done
+        sums = _block_sum(sums, step)
+        counts = _block_sum(counts, step)
+        done = f
+        mean = np.empty(sums.shape, dtype=np.float32)
+        has = counts > 0
+        mean[has] = sums[has] / counts[has]
+        mean[~has] = undef if undef is not None else np.nan
+        levels.append(mean)
+    return levels
+
+def build_overviews(cube, header, prefix, factors=OVERVIEW_FACTORS):
+    '''
+    Write the overviews of a (time, ny, nx) cube, one band at a time.
+
+    prefix: local path prefix for the output; the overview at factor f is
+            written to prefix.ovf.dat with its descriptor next to it.
+
+    Returns the list of (factor, dat path, ctl path) written.
+    '''
+    written = []
+    outs = []
+    for f in factors:
+        path = overview_name(prefix, f)
+        outs.append(open(path + '.dat', 'wb'))
+        written.append((f, path + '.dat', path + grid_properties['DESCRIPTOR_SUFFIX']))
+    try:
+        for t in range(cube.shape[0]):
+            for out, level in zip(outs, reduce_band(cube[t], header.undef, factors)):
+                out.write(level.astype(header.dtype).tostring())
+    finally:
+        for out in outs:
+            out.close()
+
+    for f, dat, ctl in written:
+        oh = overview_header(header, f)
+        oh.nt = cube.shape[0]
+        with open(ctl, 'w') as out:
+            out.write(oh.dumps(os.path.basename(dat)))
+    return written
+
+def factors_for(scale, factors=OVERVIEW_FACTORS):
+    '''
+    The overview factors that still give at least one cell per output pixel
+    when scale source cells fall in each output pixel, coarsest first, and
+    ending with 1 (the full resolution cube).
+    '''
+    return sorted([f for f in factors if f <= scale], reverse=True) + [1]
@@ -0,0 +1,134 @@
+'''
+Predictive prefetching for getraster.
+
+People browsing runoff step through the days one at a time, or flip
+between parameters for the same day. The Prefetcher watches the sequence
+of raster requests and, on a couple of background threads, warms what
+the next request is likely to need:
+
+  * the next band in the direction the user is stepping (both neighbours
+    when there is no direction yet);
+  * the same band of the sibling parameters;
+  * the overview levels of the parameter, coarsest first.
+
+It stays out of the way of the requests being served: the queue is
+bounded (predictions are dropped, not queued, when it is full), work
+waits while a foreground download is running, prefetch downloads go
+through a Throttle so they never take more than a set bandwidth, and a
+prefetch download is cancelled as soon as a request waits for the same
+blob (the request resumes it at full speed). The threads start with the
+first prediction.
+'''
+import threading
+import time
+
+from app.settings import prefetch_properties
+from background import Workers
+
+class Throttle:
+    '''
+    Holds a stream of transfers to bytes_per_second on average.
+    '''
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.lock = threading.Lock()
+        self.next_free = time.time()
+
+    def consume(self, nbytes):
+        '''
+        Account for nbytes just transferred, sleeping as long as it takes
+        to bring the average back down to the rate.
+        '''
+        with self.lock:
+            now = time.time()
+            self.next_free = max(self.next_free, now) + nbytes / self.rate
+            wait = self.next_free - now
+        if wait > 0:
+            time.sleep(wait)
+
+    def callback(self):
+        '''
+        A progress callback (current, total) that throttles the transfer it
+        is given to. The first call only sets the baseline, so the part of a
+        resumed download already on disk is not counted.
+        '''
+        seen = [None]
+        def progress(current, total):
+            delta, seen[0] = current - (current if seen[0] is None else seen[0]), current
+            if delta > 0:
+                self.consume(delta)
+        return progress
+
+def predict(last, param, band, siblings):
+    '''
+    What to warm after a request for band of param, as a list of
+    (param, band) most likely first. last is the band of param asked
+    for before this one (or None).
+    '''
+    if last is not None and band == last + 1:
+        steps = [band + 1, band + 2]
+    elif last is not None and band == last - 1:
+        steps = [band - 1, band - 2]
+    else:
+        steps = [band + 1, band - 1]
+    out = [(param, b) for b in steps if b >= 0]
+    out += [(s, band) for s in siblings if s != param]
+    return out
+
+class Prefetcher:
+    '''
+    Background warming of the caches. See the module notes.
+
+    warm_band(param, band, width, height): warms one band.
+    warm_overviews(param):                 warms a parameter's overviews.
+    busy():                                True while foreground work
+                                           should not be competed with.
+    start():                               optional; run on each thread
+                                           before it does any work.
+    version(param):                        optional; the version of the
+                                           parameter's data, so replaced
+                                           data has its overviews warmed
+                                           again.
+    '''
+
+    def __init__(self, warm_band, warm_overviews, busy=None, start=None, threads=None, depth=None,
+                 version=None):
+        self.warm_band = warm_band
+        self.warm_overviews = warm_overviews
+        self.busy = busy or (lambda: False)
+        self.version = version or (lambda param: None)
+        self.last = {}
+        self.lock = threading.Lock()
+        # Overviews only need warming once per version (until it fails);
+        #  bands once at a time.
+        self.workers = Workers(self._warm,
+                               threads or prefetch_properties['THREADS'],
+                               depth or prefetch_properties['QUEUE_DEPTH'],
+                               start=start, keep=lambda task: task[0] == 'overviews')
+
+    def observe(self, param, band, siblings=(), width=None, height=None):
+        '''
+        Note a request for band of param, and queue what is likely to be
+        asked for next.
+        '''
+        with self.lock:
+            last = self.last.get(param)
+            self.last[param] = band
+        self.workers.submit(('overviews', param, self.version(param)))
+        for p, b in predict(last, param, band, siblings):
+            self.workers.submit(('band', p, b, width, height))
+
+    def _warm(self, task):
+        # Failures are a band past the end of the cube, a missing overview...
+        while self.busy():
+            time.sleep(0.1)
+        if task[0] == 'overviews':
+            self.warm_overviews(task[1])
+        else:
+            self.warm_band(*task[1:])
+
+    def stats(self):
+        stats = self.workers.stats()
+        return {'queued': stats['queued'], 'warmed': stats['done'],
+                'failed': stats['failed'], 'dropped': stats['dropped']}
@@ -0,0 +1,199 @@
+'''
+Resampling indexes for reprojecting SnowModel grids to web mercator.
+
+Reprojecting with pyproj on every request is most of the cost of drawing a
+band on a Bing/web mercator map. The mapping from output pixels to grid
+cells only depends on the grid and the output image, so it is worked out
+once, kept in memory, and every band after that is reprojected with a
+single vectorized gather. Indexes for whole grids (one per grid and image
+size) are also kept on local disk, in the local cache and within its
+budget; those for tiles, one per tile, only ever live in memory.
+'''
+import collections
+import hashlib
+import threading
+
+import numpy as np
+
+from app.settings import grid_properties
+from grid import projection
+
+# Memory budget for indexes kept in memory, in bytes. A full extent
+# bilinear index is tens of MB; a tile's nearest neighbour index is 512KB.
+MEMORY_BYTES = 256 * 1024 * 1024
+
+_indexes = collections.OrderedDict()
+_lock = threading.Lock()
+
+def pixel_centers(bounds, width, height):
+    '''
+    Web mercator coordinates of the pixel centers of a width by height image
+    covering bounds (minx, miny, maxx, maxy), as (height, width) arrays with
+    row 0 at the top.
+    '''
+    minx, miny, maxx, maxy = bounds
+    px = minx + (np.arange(width) + 0.5) * ((maxx - minx) / float(width))
+    py = maxy - (np.arange(height) + 0.5) * ((maxy - miny) / float(height))
+    return np.meshgrid(px, py)
+
+def mercator_bounds(header, mercator, samples=64):
+    '''
+    The web mercator bounding box (minx, miny, maxx, maxy) of a grid,
+    traced along its outer cell edges.
+    '''
+    xmn, dx, ymn, dy = header.geotransform()
+    xs = xmn - dx / 2.0 + np.linspace(0, header.nx * dx, samples)
+    ys = ymn - dy / 2.0 + np.linspace(0, header.ny * dy, samples)
+    ex = np.concatenate([xs, xs, np.repeat(xs[0], samples), np.repeat(xs[-1], samples)])
+    ey = np.concatenate([np.repeat(ys[0], samples), np.repeat(ys[-1], samples), ys, ys])
+    lons, lats = projection(ex, ey, inverse=True)
+    mx, my = mercator(lons, lats)
+    return float(np.min(mx)), float(np.min(my)), float(np.max(mx)), float(np.max(my))
+
+
+class RegridIndex:
+    '''
+    For every output pixel, the grid cells it draws from and their weights.
+
+    cells:   (pixels, k) flat indexes into a (ny, nx) band.
+    weights: (pixels, k) weights; 0 where a neighbour is off the grid.
+    shape:   (height, width) of the output image.
+    '''
+
+    def __init__(self, cells, weights, shape):
+        self.cells = cells
+        self.weights = weights
+        self.shape = tuple(shape)
+
+    @property
+    def nbytes(self):
+        return self.cells.nbytes + self.weights.nbytes
+
+    @classmethod
+    def build(cls, header, mercator, bounds, width, height, method='bilinear'):
+        '''
+        Work out the index for a width by height web mercator image covering
+        bounds, drawn from a grid described by header.
+
+        method: 'nearest' or 'bilinear'.
+        '''
+        mx, my = pixel_centers(bounds, width, height)
+        lons, lats = mercator(mx.ravel(), my.ravel(), inverse=True)
+        gx, gy = projection(lons, lats)
+        xmn, dx, ymn, dy = header.geotransform()
+        fc = (np.asarray(gx) - xmn) / dx
+        fr = (np.asarray(gy) - ymn) / dy
+        bad = ~(np.isfinite(fc) & np.isfinite(fr))
+        fc[bad] = fr[bad] = -1e9
+
+        if method == 'nearest':
+            cols = [np.floor(fc + 0.5)]
+            rows = [np.floor(fr + 0.5)]
+            weights = [np.ones(fc.shape)]
+        elif method == 'bilinear':
+            c0 = np.floor(fc)
+            r0 = np.floor(fr)
+            wx = fc - c0
+            wy = fr - r0
+            cols = [c0, c0 + 1, c0, c0 + 1]
+            rows = [r0, r0, r0 + 1, r0 + 1]
+            weights = [(1 - wx) * (1 - wy), wx * (1 - wy), (1 - wx) * wy, wx * wy]
+        else:
+            raise ValueError("Unknown resampling method '{0}'".format(method))
+
+        cols = np.column_stack(cols)
+        rows = np.column_stack(rows)
+        weights = np.column_stack(weights)
+        off = (cols < 0) | (cols >= header.nx) | (rows < 0) | (rows >= header.ny)
+        # Pixels whose center is off the grid are dropped entirely, rather
+        # than being filled in from the edge cells.
+        outside = (fc < -0.5) | (fc > header.nx - 0.5) | (fr < -0.5) | (fr > header.ny - 0.5)
+        weights[off | outside[:, None]] = 0
+        cells = (rows.clip(0, header.ny - 1) * header.nx + cols.clip(0, header.nx - 1)).astype(np.int32)
+        return cls(cells, weights.astype(np.float32), (height, width))
+
+    def apply(self, band, undef=None):
+        '''
+        Reproject a (ny, nx) band. No-data neighbours are left out and the
+        remaining weights renormalized.
+
+        Returns a (height, width) masked array, row 0 at the top.
+        '''
+        values = np.take(np.asarray(band).ravel(), self.cells)
+        valid = np.isfinite(values)
+        if undef is not None:
+            valid &= (values != undef)
+        w = np.where(valid, self.weights, 0)
+        total = w.sum(axis=1)
+        out = np.where(valid, values, 0).astype(np.float64)
+        out = (out * w).sum(axis=1) / np.where(total > 0, total, 1)
+        return np.ma.masked_array(out.astype(np.float32), mask=(total <= 0)).reshape(self.shape)
+
+    def save(self, path):
+        '''
+        Write the index to path (an .npz file).
+        '''
+        np.savez(path, cells=self.cells, weights=self.weights, shape=np.array(self.shape))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read an index written by save().
+        '''
+        f = np.load(path)
+        try:
+            return cls(f['cells'], f['weights'], f['shape'])
+        finally:
+            f.close()
+
+def _key(header, mercator, bounds, width, height, method):
+    spec = repr((header.nx, header.ny, header.geotransform(), grid_properties['PROJECTION'],
+                 mercator.srs, tuple(round(b, 3) for b in bounds), width, height, method))
+    return hashlib.sha1(spec.encode('utf-8')).hexdigest()
+
+def get_index(header, mercator, bounds, width, height, method='bilinear', files=None):
+    '''
+    The RegridIndex for a web mercator image, from memory if it has been 
+    worked out before, built otherwise.
+
+    files: optional; a LocalCache to keep the index in on disk as well, 
+           for indexes of whole grids.
+    '''
+    key = _key(header, mercator, bounds, width, height, method)
+    with _lock:
+        index = _indexes.pop(key, None)
+        if index is not None:
+            _indexes[key] = index
+            return index
+
+    built = []
+    def build(path=None, heartbeat=None):
+        built.append(RegridIndex.build(header, mercator, bounds, width, height, method))
+        if path is not None:
+            built[0].save(path)
+
+    if files is None:
+        build()
+    else:
+        # One process on the host builds it; the rest read its file.
+        path = files.fetch('regrid-{0}.npz'.format(key), build)
+        if not built:
+            try:
+                built.append(RegridIndex.load(path))
+            except Exception:
+                build()
+    index = built[0]
+
+    with _lock:
+        _indexes[key] = index
+        total = sum(i.nbytes for i in _indexes.values())
+        while total > MEMORY_BYTES and len(_indexes) > 1:
+            total -= _indexes.popitem(last=False)[1].nbytes
+    return index
+
+def reproject(band, header, mercator, bounds, width, height, method='bilinear', files=None):
+    '''
+    Reproject a band of the grid described by header onto a width by height
+    web mercator image covering bounds. See RegridIndex.apply and get_index.
+    '''
+    return get_index(header, mercator, bounds, width, height, method, files).apply(band, header.undef)
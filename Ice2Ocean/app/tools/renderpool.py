@@ -0,0 +1,248 @@
+'''
+Out of process rendering.
+
+Drawing a raster holds the GIL for a long time and (for the matplotlib
+renderer) leans on global pyplot state, so renders are handed to a small
+pool of worker processes instead of running in the request thread. The
+number of jobs waiting or running is bounded, and a caller only waits so
+long for its image; requests served from the cache never touch the pool.
+
+A job holds its queue slot while its caller waits for it. A worker that
+dies (killed for memory, say) loses its job without a word, so a job
+past its timeout gives its slot back anyway and is counted as overdue;
+once as many jobs are overdue as there are workers, they are all taken
+to be stuck or lost and the pool is replaced.
+
+So a job must not spend its time downloading: a cold cube can take longer
+than the timeout to arrive, and replacing the pool would kill the download
+along with it. raster, aggregate and zonal fetch what the job will read to
+the local cache in the calling thread first, where the wait is only the
+request's; the worker then finds the files in place.
+'''
+import multiprocessing
+import threading
+import traceback
+from io import BytesIO
+
+from app.settings import render_properties
+
+class RenderBusy(Exception):
+    '''
+    The render queue is full.
+    '''
+    pass
+
+class RenderTimeout(Exception):
+    '''
+    The render did not finish in time.
+    '''
+    pass
+
+class RenderError(Exception):
+    '''
+    The render failed in the worker; the message carries its traceback.
+    '''
+    pass
+
+# Worker side. Everything below runs in the pool's processes.
+
+_projections = {}
+
+def _projection(srs):
+    import pyproj
+    p = _projections.get(srs)
+    if p is None:
+        p = _projections[srs] = pyproj.Proj(srs)
+    return p
+
+def _scale(header, width, height):
+    # Full resolution cells per output pixel, for picking an overview.
+    scales = []
+    if width:
+        scales.append(header.nx / float(width))
+    if height:
+        scales.append(header.ny / float(height))
+    return min(scales) if scales else 1
+
+def _draw(grid, header, cmap, cmin, cmax, srs):
+    # Reproject a (ny, nx) grid to srs and draw it. The pixel to cell
+    # mapping is worked out once per grid and image size (see regrid); here
+    # it is just a gather.
+    import builder as b
+    import regrid
+    from drawing import colorize, write_png
+
+    mercator = _projection(srs)
+    bounds = regrid.mercator_bounds(header, mercator)
+    rows = int(round(header.nx * (bounds[3] - bounds[1]) / (bounds[2] - bounds[0])))
+    # Whole grid indexes are kept on disk too, in the local cache.
+    img = regrid.reproject(grid, header, mercator, bounds, header.nx, rows, files=b.local_cache)
+    img = img*(img > 0)
+
+    buf = BytesIO()
+    write_png(colorize(img, cmin, cmax, cmap), buf)
+    return buf.getvalue()
+
+def render_raster(param, band, cmap, cmin, cmax, width, height, srs):
+    '''
+    Draw one band of a cube parameter, reprojected to srs, as png bytes.
+
+    width, height: the size the client wants (either may be None); used to
+                   pick an overview level.
+    '''
+    import builder as b
+
+    header = b.fetch_header(param)
+    header, grid = b.fetch_overview_band(param, band, _scale(header, width, height), header=header)
+    return _draw(grid, header, cmap, cmin, cmax, srs)
+
+def warm_raster(param, band, width, height):
+    '''
+    Fetch and decode what render_raster would read, without drawing. Runs
+    in the calling process; the downloaded files and decoded band are
+    shared with the pool's workers (see localcache.py and sharedgrids.py).
+    '''
+    import builder as b
+
+    header = b.fetch_header(param)
+    b.fetch_overview_band(param, band, _scale(header, width, height), header=header)
+
+def render_aggregate(param, first, last, op, cmap, cmin, cmax, width, height, srs):
+    '''
+    Draw bands first..last of a cube parameter reduced with op (see
+    builder.fetch_aggregate), reprojected to srs, as png bytes.
+    '''
+    import builder as b
+
+    header = b.fetch_header(param)
+    header, grid = b.fetch_aggregate(param, first, last, op, _scale(header, width, height))
+    return _draw(grid, header, cmap, cmin, cmax, srs)
+
+def zonal_totals(param, zoneset, first, last, ids):
+    '''
+    Per-zone totals of a cube parameter over bands first..last. See
+    builder.zonal_totals.
+    '''
+    import builder as b
+    return b.zonal_totals(param, zoneset, first, last, ids)
+
+def _run(fn, args):
+    # Exceptions are returned rather than raised so that the pool's callback
+    # (which frees the job's queue slot) always fires.
+    try:
+        return True, fn(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+# Caller side.
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(render_properties['QUEUE_DEPTH'])
+_jobs = [0]
+_jobs_lock = threading.Lock()
+# Jobs that ran past their timeout and have not finished since.
+_overdue = []
+
+def _count(n):
+    with _jobs_lock:
+        _jobs[0] += n
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(processes=render_properties['PROCESSES'],
+                                         maxtasksperchild=render_properties['JOBS_PER_PROCESS'])
+        return _pool
+
+def _abandon(job):
+    # The job ran past its timeout: its worker is stuck, or died with it.
+    global _pool
+    with _pool_lock:
+        _overdue[:] = [j for j in _overdue if not j.ready()] + [job]
+        if len(_overdue) >= render_properties['PROCESSES'] and _pool is not None:
+            old, _pool = _pool, None
+            del _overdue[:]
+            # terminate() waits for the workers to go; not on the request.
+            t = threading.Thread(target=old.terminate)
+            t.daemon = True
+            t.start()
+
+def submit(fn, *args, **kwargs):
+    '''
+    Run fn(*args) in the render pool and return its result.
+
+    fn must be a module level function (it is pickled by name).
+
+    timeout: seconds to wait for the result (default render_properties TIMEOUT).
+
+    Raises RenderBusy when QUEUE_DEPTH jobs are already waiting or running,
+    RenderTimeout when the result does not arrive in time and RenderError
+    when fn raised. However it ends, the job's queue slot is given back; see
+    the module notes for jobs that time out.
+    '''
+    timeout = kwargs.get('timeout', render_properties['TIMEOUT'])
+    if not _slots.acquire(False):
+        raise RenderBusy()
+    _count(1)
+    released = []
+    release_lock = threading.Lock()
+
+    def done(result=None):
+        # Called by the pool when the job finishes, and by the caller when
+        # it stops waiting; whichever comes first frees the slot.
+        with release_lock:
+            if released:
+                return
+            released.append(True)
+        _count(-1)
+        _slots.release()
+
+    try:
+        job = _get_pool().apply_async(_run, (fn, args), callback=done)
+        try:
+            ok, value = job.get(timeout)
+        except multiprocessing.TimeoutError:
+            _abandon(job)
+            raise RenderTimeout()
+    finally:
+        done()
+    if not ok:
+        raise RenderError(value)
+    return value
+
+def _fetch_sources(param, width=None, height=None):
+    # Download the cube (or the overview) the job will read; see the module
+    # notes. Nothing is decoded here.
+    import builder as b
+
+    header = b.fetch_header(param)
+    b.fetch_overview(param, _scale(header, width, height), header=header)
+
+def busy():
+    '''
+    True while any job of this process is waiting or running in the pool.
+    '''
+    return _jobs[0] > 0
+
+def raster(param, band, cmap, cmin, cmax, width=None, height=None, srs='+init=EPSG:3857'):
+    '''
+    Render a band of a cube parameter in the pool. See render_raster.
+    '''
+    _fetch_sources(param, width, height)
+    return submit(render_raster, param, band, cmap, cmin, cmax, width, height, srs)
+
+def aggregate(param, first, last, op, cmap, cmin, cmax, width=None, height=None, srs='+init=EPSG:3857'):
+    '''
+    Render a reduction of a cube parameter in the pool. See render_aggregate.
+    '''
+    _fetch_sources(param, width, height)
+    return submit(render_aggregate, param, first, last, op, cmap, cmin, cmax, width, height, srs)
+
+def zonal(param, zoneset, first, last, ids=None, timeout=render_properties['TIMEOUT']):
+    '''
+    Work out per-zone totals of a cube parameter in the pool. See zonal_totals.
+    '''
+    _fetch_sources(param)
+    return submit(zonal_totals, param, zoneset, first, last, ids, timeout=timeout)
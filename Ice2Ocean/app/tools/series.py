@@ -0,0 +1,49 @@
+'''
+Time-major copies of the SnowModel cubes, for pixel time series.
+
+The .dat cubes are band-major (time, ny, nx): a day's map is contiguous, a
+cell's history is one strided read per day. The series copy (param.ts.dat)
+holds the same values as (ny, nx, time), so the history of a cell is a
+single contiguous read. It is built once, when a cube is ingested, by
+transposing a block of rows at a time.
+'''
+import numpy as np
+
+# Memory budget for the block of rows transposed at a time, in bytes.
+BLOCK_BYTES = 256 * 1024 * 1024
+
+def series_name(param):
+    '''
+    The cube name (no extension) of the series copy of param.
+    '''
+    return '{0}.ts'.format(param)
+
+def build_series(cube, header, path, block_bytes=BLOCK_BYTES):
+    '''
+    Write the (ny, nx, time) copy of a (time, ny, nx) cube to path.
+    '''
+    nt = cube.shape[0]
+    itemsize = np.dtype(header.dtype).itemsize
+    rows = max(1, block_bytes // max(1, nt * header.nx * itemsize))
+    with open(path, 'wb') as out:
+        for r in range(0, header.ny, rows):
+            block = np.asarray(cube[:, r:min(r + rows, header.ny), :])
+            out.write(np.ascontiguousarray(block.transpose(1, 2, 0)).astype(header.dtype).tostring())
+    return path
+
+def open_series(header, fpath, nbytes):
+    '''
+    Memory map the series copy at fpath (nbytes long) as a read-only
+    (ny, nx, time) array.
+    '''
+    nt = nbytes // (header.nx * header.ny * np.dtype(header.dtype).itemsize)
+    return np.memmap(fpath, dtype=header.dtype, mode='r', shape=(header.ny, header.nx, int(nt)))
+
+def read_series(series, col, row, first, last):
+    '''
+    The values of cell (col, row) for bands first..last (inclusive) of a
+    series copy, as a float32 array.
+    '''
+    if first < 0 or last >= series.shape[2] or first > last:
+        raise IndexError('Bands {0}..{1} are not in the cube'.format(first, last))
+    return np.array(series[row, col, first:last + 1], dtype=np.float32)
@@ -0,0 +1,212 @@
+'''
+A host wide store of decoded grids, shared by the worker processes.
+
+Each Django worker process would otherwise decode and hold its own copy
+of the same bands and coordinate arrays. SharedGrids writes a grid once,
+as an .npy file in shared memory (/dev/shm, or the temp directory where
+there is none, as on Windows, and the OS page cache does the sharing),
+and every process attaches it read-only as a memory map. A grid decoded
+by one worker is then warm for all of them, and memory stays flat as
+workers are added.
+
+Reference counting is done with marker files: a process attaching a grid
+leaves <grid>.<pid>.ref next to it and removes it when it lets go (or
+exits). sweep() deletes grids nobody holds once the store is over its
+byte budget, least recently attached first, along with the markers of
+processes that have died.
+'''
+import atexit
+import collections
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from app.settings import cache_properties
+from singleflight import FileLock, lock_path
+
+# Grids attached by this process at once.
+MAX_ATTACHED = 256
+
+# Markers older than this (seconds) are assumed to belong to dead processes
+# where that can't be checked directly (Windows).
+STALE_SECONDS = 24 * 3600
+
+def default_directory():
+    '''
+    Shared memory where there is some, the temp directory otherwise.
+    '''
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'ice2ocean-grids')
+
+def _alive(pid, marker):
+    if os.name == 'nt':
+        # os.kill would terminate the process here.
+        try:
+            return time.time() - os.path.getmtime(marker) < STALE_SECONDS
+        except OSError:
+            return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError as e:
+        return e.errno == 1  # EPERM: alive, someone else's.
+
+class SharedGrids:
+    '''
+    Read-only grids shared between processes. See the module notes.
+
+    directory: where the grids live (default: see default_directory).
+    budget:    bytes of grids kept once nobody holds them.
+    '''
+
+    def __init__(self, directory=None, budget=None):
+        self.directory = directory or cache_properties['SHARED_DIRECTORY'] or default_directory()
+        self.budget = budget if budget is not None else cache_properties['SHARED_BYTES']
+        self.attached = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        atexit.register(self.release_all)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def _marker(self, path):
+        return '{0}.{1}.ref'.format(path, os.getpid())
+
+    def get(self, key, build):
+        '''
+        The grid stored under key (any string), attached read-only. If no
+        process has stored it yet, build() makes it (once per host: other
+        processes asking meanwhile wait for it).
+        '''
+        with self.lock:
+            grid = self.attached.pop(key, None)
+            if grid is not None:
+                self.attached[key] = grid
+                self.hits += 1
+                return grid
+            self.misses += 1
+
+        path = self._path(key)
+        built = False
+        if not os.path.exists(path):
+            with FileLock(lock_path(key, self.directory), timeout=300):
+                if not os.path.exists(path):
+                    # Not named .npy until complete, so sweep() leaves it be.
+                    tmp = '{0}.{1}-{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+                    with open(tmp, 'wb') as f:
+                        np.save(f, np.ascontiguousarray(build()))
+                    try:
+                        os.rename(tmp, path)
+                    except OSError:
+                        os.remove(tmp)
+                    self.builds += 1
+                    built = True
+        grid = self._attach(key, path)
+        if built:
+            # Make room, now that the new grid is held.
+            self.sweep()
+        return grid
+
+    def _attach(self, key, path):
+        marker = self._marker(path)
+        with open(marker, 'w'):
+            pass
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        grid = np.load(path, mmap_mode='r')
+        with self.lock:
+            self.attached[key] = grid
+            while len(self.attached) > MAX_ATTACHED:
+                self._detach(*self.attached.popitem(last=False))
+        return grid
+
+    def _detach(self, key, grid):
+        # Arrays already handed out keep working; the marker only says this
+        # process no longer needs the grid kept.
+        try:
+            os.remove(self._marker(self._path(key)))
+        except OSError:
+            pass
+
+    def release_all(self):
+        '''
+        Let go of every grid this process has attached.
+        '''
+        with self.lock:
+            while self.attached:
+                self._detach(*self.attached.popitem(last=False))
+
+    def _refs(self, path):
+        # Live processes holding the grid at path; dead ones' markers go.
+        live = 0
+        for marker in glob.glob(path + '.*.ref'):
+            try:
+                pid = int(marker[len(path) + 1:-len('.ref')])
+            except ValueError:
+                continue
+            if _alive(pid, marker):
+                live += 1
+            else:
+                try:
+                    os.remove(marker)
+                except OSError:
+                    pass
+        return live
+
+    def sweep(self, budget=None):
+        '''
+        Delete grids nobody holds, least recently attached first, until the
+        store fits in budget bytes (default: the store's budget). Returns
+        the number deleted.
+        '''
+        budget = self.budget if budget is None else budget
+        grids = []
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            try:
+                grids.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+        total = sum(size for mtime, size, path in grids)
+        deleted = 0
+        for mtime, size, path in sorted(grids):
+            if total <= budget:
+                break
+            if self._refs(path):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            deleted += 1
+        return deleted
+
+    def stats(self):
+        '''
+        Counters, as a dict: hits, misses, builds, attached, and the bytes
+        and budget of the whole store.
+        '''
+        total = 0
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'builds': self.builds,
+                    'attached': len(self.attached), 'bytes': total, 'budget': self.budget}
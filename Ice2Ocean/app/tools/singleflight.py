@@ -0,0 +1,169 @@
+'''
+Single flight execution of identical work.
+
+When new model output lands, many clients ask for the same thing at the
+same moment and each one misses the cache. SingleFlight makes the first
+caller for a key do the work while every concurrent caller with the same
+key waits for it and shares the result:
+
+  * threads in one process wait on the in-flight call directly;
+  * worker processes on one host queue up behind a lock file, and once a
+    process gets the lock it checks (recheck) whether the result has been
+    published, e.g. to the blob cache, before doing the work itself.
+
+FileLock is usable on its own for other host wide critical sections.
+'''
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+class LockTimeout(Exception):
+    '''
+    A lock file was not acquired in time.
+    '''
+    pass
+
+class FileLock:
+    '''
+    A host wide lock held by exclusively creating a file.
+
+    path:    the lock file.
+    timeout: seconds to wait for the lock (None waits forever).
+    poll:    seconds between attempts.
+    stale:   a lock file older than this (seconds) is assumed to belong to
+             a crashed process and is broken.
+    '''
+
+    def __init__(self, path, timeout=None, poll=0.05, stale=900):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self.stale = stale
+        self.held = False
+
+    def _break_stale(self):
+        try:
+            if time.time() - os.path.getmtime(self.path) > self.stale:
+                os.remove(self.path)
+        except OSError:
+            pass
+
+    def acquire(self, blocking=True):
+        '''
+        Take the lock. Returns False if it could not be had without waiting
+        (blocking=False); raises LockTimeout if the timeout ran out.
+        '''
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode('ascii'))
+                os.close(fd)
+                self.held = True
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.EACCES):
+                    raise
+            self._break_stale()
+            if not blocking:
+                return False
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise LockTimeout(self.path)
+            time.sleep(self.poll)
+
+    def touch(self):
+        '''
+        Mark a held lock as still in use, so it is not taken for stale.
+        '''
+        if self.held:
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+
+    def release(self):
+        if self.held:
+            self.held = False
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def lock_path(key, lockdir=None):
+    '''
+    The lock file used for key (any string).
+    '''
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(lockdir or tempfile.gettempdir(), '{0}.lock'.format(name))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls for the same key. See the module notes.
+
+    lockdir: where the lock files live (default: the temp directory).
+    timeout: seconds a caller waits for another process's work before
+             giving up with LockTimeout.
+    '''
+
+    def __init__(self, lockdir=None, timeout=300):
+        self.lockdir = lockdir
+        self.timeout = timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, recheck=None):
+        '''
+        Return fn(), computed at most once at a time for key on this host.
+
+        key:     any string identifying the work (the canonical request).
+        fn:      does the work (and publishes it, if other processes should
+                 see it).
+        recheck: optional; returns the published result or None. Called
+                 once the host lock is held, so a process that waited behind
+                 another can pick up its result instead of redoing the work.
+
+        Waiting threads get the leader's result, or its exception.
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            with FileLock(lock_path(key, self.lockdir), timeout=self.timeout):
+                value = recheck() if recheck else None
+                if value is None:
+                    value = fn()
+            call.value = value
+            return value
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
@@ -0,0 +1,95 @@
+'''
+Stale while revalidate.
+
+Cached responses used to be good until they dropped out of the cache, or
+until the data under them changed and their key with it; either way the
+first request after that paid for the whole download and render, or the
+whole query. Here a cached body carries the time it was made, and each
+endpoint has a freshness window and a stale window after it:
+
+  * fresh bodies are served as they are;
+  * stale bodies (past the freshness window, or made from data that has
+    since been replaced) are still served at once, and a Refresher
+    recomputes them on a background thread, once per key however many
+    requests see them stale;
+  * past the stale window a body is a miss.
+
+So popular responses never block on being recomputed.
+'''
+from app.settings import stale_properties
+from background import Workers
+
+FRESH, STALE, EXPIRED = 'fresh', 'stale', 'expired'
+
+def stamp(stored, now):
+    '''
+    stored, as cached at time now (seconds since the epoch).
+    '''
+    return '{0:.0f}|'.format(now) + stored
+
+def unstamp(entry):
+    '''
+    (time cached, stored body) of a cached entry.
+    '''
+    cached, sep, stored = entry.partition('|')
+    return float(cached), stored
+
+def window(endpoint):
+    '''
+    (fresh, stale) seconds for the bodies of endpoint (see stale_properties).
+    '''
+    return stale_properties['WINDOWS'].get(endpoint, (None, 0))
+
+def state(age, fresh, stale, current=True):
+    '''
+    FRESH, STALE or EXPIRED for a body age seconds old.
+
+    fresh, stale: the windows (see window).
+    current:      False when the data it was made from has been replaced.
+    '''
+    if current and (fresh is None or age < fresh):
+        return FRESH
+    if age < (fresh or 0) + stale:
+        return STALE
+    return EXPIRED
+
+class Previous(str):
+    '''
+    A body cached for data that has since been replaced. It needs its own
+    validators: those of the request describe the new data.
+
+    cached: when it was cached (seconds since the epoch).
+    '''
+
+    def __new__(cls, body, cached):
+        return str.__new__(cls, body)
+
+    def __init__(self, body, cached):
+        self.cached = cached
+
+class Refresher:
+    '''
+    Recomputes stale bodies on background threads. See the module notes.
+
+    threads: refresh threads.
+    depth:   refreshes waiting at most; more are dropped (the stale body is
+             served again, and the next request schedules it).
+    '''
+
+    def __init__(self, threads=None, depth=None):
+        # On failure the stale body stays; a later request tries again.
+        self.workers = Workers(lambda refresh: refresh(),
+                               threads or stale_properties['THREADS'],
+                               depth or stale_properties['QUEUE_DEPTH'])
+
+    def schedule(self, key, refresh):
+        '''
+        Run refresh() in the background unless a refresh of key is already
+        waiting or running.
+        '''
+        self.workers.submit(refresh, key=key)
+
+    def stats(self):
+        stats = self.workers.stats()
+        return {'refreshed': stats['done'], 'failed': stats['failed'], 'dropped': stats['dropped'],
+                'queued': stats['queued'], 'refreshing': stats['pending']}
@@ -0,0 +1,260 @@
+'''
+A tiered cache of response bodies.
+
+Every cached response used to be read from the blob cache, a round trip
+to Azure even for the hottest keys. TieredCache puts faster, smaller
+tiers in front of it:
+
+  * MemoryTier:  a least recently used dict in this process;
+  * DiskTier:    files on local disk, within a byte budget (see
+                 localcache.py), shared by the processes on the host;
+  * CacheTier:   a Django cache; the blob cache, durable and shared by
+                 every instance (see djangocache.py).
+
+Reads go through the tiers in order and a hit is copied into the tiers
+above it; writes go to every tier. Each tier has its own time to live
+(None keeps entries until they are pushed out), and counts its hits,
+misses, errors and the time spent in it.
+
+Keys made by cachekeys.response_key are namespaced per endpoint
+('raster/...'); drop() removes a whole namespace from every tier.
+'''
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from localcache import LocalCache
+
+class MemoryTier:
+    '''
+    Bodies kept in this process, least recently used first out.
+
+    budget: bytes of bodies kept.
+    ttl:    seconds a body is served for (None: until pushed out).
+    '''
+
+    name = 'memory'
+
+    def __init__(self, budget, ttl=None):
+        self.budget = budget
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, stored = entry
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                self.nbytes -= len(value)
+                return None
+            self.entries[key] = entry
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._remove(key)
+            if len(value) > self.budget:
+                return
+            self.entries[key] = (value, time.time())
+            self.nbytes += len(value)
+            while self.nbytes > self.budget:
+                self._remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= len(entry[0])
+
+class DiskTier:
+    '''
+    Bodies kept as files in a directory, within a byte budget.
+
+    directory: where the files go (default: a directory in the temp
+               directory).
+    budget:    bytes of files kept; least recently used go first.
+    ttl:       seconds a body is served for, from when it was written.
+    '''
+
+    name = 'disk'
+
+    def __init__(self, directory=None, budget=1024 ** 3, ttl=None):
+        directory = directory or os.path.join(tempfile.gettempdir(), 'ice2ocean-responses')
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        self.files = LocalCache(directory, budget)
+        self.ttl = ttl
+
+    def _name(self, key):
+        # Namespace first, so a namespace's files can be found.
+        namespace = key.partition('/')[0] if '/' in key else 'misc'
+        return '{0}.{1}'.format(namespace, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        name = self._name(key)
+        path = self.files.get(name)
+        if path is None:
+            return None
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                self.files.remove(name)
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            # Evicted by another process meanwhile.
+            return None
+
+    def put(self, key, value):
+        name = self._name(key)
+        path = self.files.path(name)
+        tmp = '{0}.{1}-{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(value)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+        self.files.add(name)
+
+    def delete(self, key):
+        self.files.remove(self._name(key))
+
+    def delete_prefix(self, prefix):
+        # Only whole namespaces ('raster/') can be found by name.
+        namespace = prefix.rstrip('/') + '.'
+        for entry in self.files.listing():
+            if entry['file'].startswith(namespace):
+                self.files.remove(entry['file'])
+
+class CacheTier:
+    '''
+    Bodies kept in a Django cache, which sets their time to live (its
+    TIMEOUT).
+
+    cache: the cache (django.core.cache.get_cache).
+    '''
+
+    name = 'cache'
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def put(self, key, value):
+        self.cache.set(key, value)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def delete_prefix(self, prefix):
+        # Only the blob backends can find keys by prefix (see djangocache.py).
+        if hasattr(self.cache, 'delete_prefix'):
+            self.cache.delete_prefix(prefix)
+
+class _Counters:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+class TieredCache:
+    '''
+    Read-through, write-through cache over tiers, fastest first. See the
+    module notes.
+
+    Keys are strings; values are byte strings.
+    '''
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.counters = [_Counters() for t in tiers]
+        self.lock = threading.Lock()
+
+    def _call(self, i, method, *args):
+        # A tier that fails is counted and passed over.
+        try:
+            return getattr(self.tiers[i], method)(*args)
+        except Exception:
+            with self.lock:
+                self.counters[i].errors += 1
+            return None
+
+    def get(self, key, default=None):
+        '''
+        The value for key from the fastest tier that has it (copying it into
+        the tiers above), else default.
+        '''
+        for i in range(len(self.tiers)):
+            start = time.time()
+            value = self._call(i, 'get', key)
+            with self.lock:
+                counters = self.counters[i]
+                counters.seconds += time.time() - start
+                if value is None:
+                    counters.misses += 1
+                else:
+                    counters.hits += 1
+            if value is not None:
+                for j in range(i):
+                    self._call(j, 'put', key, value)
+                return value
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def put(self, key, value):
+        '''
+        Store value under key in every tier.
+        '''
+        for i in range(len(self.tiers)):
+            self._call(i, 'put', key, value)
+
+    def invalidate(self, key):
+        '''
+        Drop key from every tier.
+        '''
+        for i in range(len(self.tiers)):
+            self._call(i, 'delete', key)
+
+    def drop(self, namespace):
+        '''
+        Drop every key in namespace (an endpoint, see cachekeys.py) from 
+        every tier.
+        '''
+        for i in range(len(self.tiers)):
+            self._call(i, 'delete_prefix', namespace + '/')
+
+    def stats(self):
+        '''
+        Per tier counters, fastest tier first, as dicts of tier, hits, misses
+        (failed reads included), errors and the mean milliseconds per read.
+        '''
+        with self.lock:
+            return [{'tier': t.name, 'hits': c.hits, 'misses': c.misses, 'errors': c.errors,
+                     'mean_ms': 1000 * c.seconds / max(1, c.hits + c.misses)}
+                    for t, c in zip(self.tiers, self.counters)]
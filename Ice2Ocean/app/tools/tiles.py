@@ -0,0 +1,60 @@
+'''
+Web mercator (EPSG:3857) XYZ tiles cut from the SnowModel grids.
+
+Tiles follow the usual slippy map scheme: zoom z splits the world into
+2**z by 2**z tiles, x counts east from the antimeridian and y counts
+south from the top of the map.
+'''
+import numpy as np
+
+from grid import projection
+import regrid
+
+# Half the width of the web mercator world, in metres.
+ORIGIN_SHIFT = 20037508.342789244
+
+# Tile edge, in pixels.
+TILE_SIZE = 256
+
+def tile_bounds(z, x, y):
+    '''
+    Returns (minx, miny, maxx, maxy) of the tile in web mercator metres.
+    '''
+    size = 2 * ORIGIN_SHIFT / (1 << z)
+    minx = -ORIGIN_SHIFT + x * size
+    maxy = ORIGIN_SHIFT - y * size
+    return minx, maxy - size, minx + size, maxy
+
+def valid_tile(z, x, y):
+    '''
+    True if (z, x, y) names a tile that exists.
+    '''
+    return 0 <= z <= 30 and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+def grid_scale(header, mercator, bounds, width=TILE_SIZE):
+    '''
+    Roughly how many full resolution grid cells fall across one pixel of a
+    width pixel wide image covering bounds (measured along its middle).
+    Used to pick an overview level.
+    '''
+    minx, miny, maxx, maxy = bounds
+    my = (miny + maxy) / 2.0
+    lons, lats = mercator(np.array([minx, maxx]), np.array([my, my]), inverse=True)
+    gx, gy = projection(lons, lats)
+    dx = header.geotransform()[1]
+    return np.hypot(gx[1] - gx[0], gy[1] - gy[0]) / abs(dx) / width
+
+def sample(band, header, mercator, bounds, width=TILE_SIZE, height=TILE_SIZE):
+    '''
+    Nearest neighbour sample of a (ny, nx) band onto a web mercator image.
+
+    band:     The band to sample (any array indexable by [row, col]).
+    header:   The GridHeader of the band's cube.
+    mercator: The web mercator pyproj.Proj.
+    bounds:   (minx, miny, maxx, maxy) of the image in web mercator metres.
+
+    Returns a (height, width) masked array, row 0 at the top. Pixels off the
+    grid or on no-data cells are masked. The pixel to cell mapping of each
+    tile is cached (see regrid).
+    '''
+    return regrid.reproject(band, header, mercator, bounds, width, height, method='nearest')
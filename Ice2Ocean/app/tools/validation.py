@@ -0,0 +1,126 @@
+'''
+Fast-fail request validation, and a negative cache.
+
+A request with a missing or unknown parameter used to get as far as
+storage (a field table lookup, a blob read, a SQL query) before failing
+somewhere inside the view's broad except. Here requests are checked up
+front, from what is already in memory:
+
+  * parameters against the field table's catalog (FieldManager.params,
+    looked up at most once a minute);
+  * tables against the ones each endpoint can query (for get-vector, the
+    tables in the database, looked up once), along with the arguments
+    that table needs.
+
+A request that is well formed but has nothing behind it (a day before or
+past the end of a cube, a glacier with no series) raises NoData; its key
+is kept in a NegativeCache for a short while, so asking again costs a
+dictionary lookup rather than the round trips that found nothing.
+'''
+import collections
+import threading
+import time
+
+from app.settings import validation_properties
+
+class Invalid(ValueError):
+    '''
+    The request can't be served: an unknown parameter or table, or a
+    missing argument.
+    '''
+    pass
+
+class NoData(Exception):
+    '''
+    The request is fine, but there is no data for it.
+    '''
+    pass
+
+# Timeseries table kinds (matched as in the view, by substring) and the
+# sets of arguments each can be asked with; one of them must be given.
+TIMESERIES = collections.OrderedDict([
+    ('GRACE', (('version', 'mascon'), ('version', 'region'))),
+    ('streamgauges', (('location',),)),
+    ('pointbalances', (('glacier',),)),
+    ('snowradar', (('collection',),)),
+])
+
+def _given(args, name):
+    value = args.get(name, None)
+    return value is not None and value.strip() != ''
+
+def _require(args, *names):
+    for name in names:
+        if not _given(args, name):
+            raise Invalid('{0} is required'.format(name))
+
+def timeseries_kind(table):
+    '''
+    The kind of timeseries table (a key of TIMESERIES) table is.
+    '''
+    for kind in TIMESERIES:
+        if kind in table:
+            return kind
+    raise Invalid('Unknown timeseries table {0}'.format(table))
+
+def check(endpoint, args, params, tables=None):
+    '''
+    Raise Invalid unless args makes a request endpoint can serve.
+
+    args:   a dict of argument -> string (a QueryDict will do).
+    params: returns the names of the known parameters; only called for
+            endpoints that take one.
+    tables: returns the names of the tables get-vector may query, or None
+            when they can't be looked up (the table is not checked then).
+    '''
+    if endpoint in ('raster', 'tile', 'aggregate', 'zonal'):
+        _require(args, 'param')
+        if args['param'] not in params():
+            raise Invalid('Unknown parameter {0}'.format(args['param']))
+    elif endpoint == 'timeseries':
+        _require(args, 'table')
+        alternatives = TIMESERIES[timeseries_kind(args['table'])]
+        if not any(all(_given(args, name) for name in names) for names in alternatives):
+            raise Invalid('{0} needs {1}'.format(args['table'], ' or '.join('+'.join(n) for n in alternatives)))
+    elif endpoint == 'timeseries-metadata':
+        _require(args, 'table')
+        timeseries_kind(args['table'])
+    elif endpoint == 'vector':
+        _require(args, 'table', 'name')
+        known = tables() if tables else None
+        if known is not None and args['table'] not in known:
+            raise Invalid('Unknown vector table {0}'.format(args['table']))
+
+class NegativeCache:
+    '''
+    Keys known to have no data, each kept for ttl seconds.
+
+    size: keys kept at most; the oldest go first.
+    '''
+
+    def __init__(self, ttl=None, size=None):
+        self.ttl = ttl if ttl is not None else validation_properties['NEGATIVE_TTL']
+        self.size = size or validation_properties['NEGATIVE_KEYS']
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = time.time() + self.ttl
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires <= time.time():
+                del self.entries[key]
+                return False
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
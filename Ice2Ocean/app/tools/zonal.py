@@ -0,0 +1,150 @@
+'''
+Zonal statistics over the SnowModel cubes.
+
+Zones (glacier outlines, drainage basins) are rasterized once per grid
+into a sparse cells x zones matrix whose entries are the area (m^2) of
+each cell covered by each zone. Per-zone totals for any run of days are
+then a single sparse product per chunk of bands:
+
+    totals (days, zones) = bands (days, cells) . W (cells, zones)
+
+Depth fields (metres of runoff or precipitation) come out as volumes (m^3).
+'''
+import re
+
+import numpy as np
+import scipy.sparse as sparse
+from matplotlib.path import Path
+
+# Samples per cell edge when working out how much of a cell a zone covers.
+SUBSAMPLES = 4
+
+# Bands read per step.
+CHUNK_BANDS = 16
+
+_ring = re.compile(r'\(([^()]*)\)')
+
+def parse_wkt(wkt):
+    '''
+    Parse a WKT POLYGON or MULTIPOLYGON into a list of polygons, each a list
+    of rings ((n, 2) arrays), exterior ring first.
+    '''
+    kind = wkt.strip().split('(', 1)[0].strip().upper()
+    if kind not in ('POLYGON', 'MULTIPOLYGON'):
+        raise ValueError("Unsupported geometry '{0}'".format(kind))
+    body = wkt[wkt.index('('):]
+    polygons = []
+    if kind == 'POLYGON':
+        groups = [body[1:-1]]
+    else:
+        # Split the multipolygon on the ')),((' between its polygons.
+        groups = re.split(r'\)\s*\)\s*,\s*\(\s*\(', body.strip()[2:-2])
+        groups = ['({0})'.format(g) for g in groups]
+    for g in groups:
+        rings = []
+        for r in _ring.findall(g):
+            pts = [p.split() for p in r.split(',') if p.strip()]
+            rings.append(np.array([[float(p[0]), float(p[1])] for p in pts]))
+        if rings:
+            polygons.append(rings)
+    return polygons
+
+def coverage(polygons, header, subsamples=SUBSAMPLES):
+    '''
+    The fraction of each grid cell covered by the polygons (in the grid's
+    projection), as (flat cell indexes, fractions) for the cells touched.
+    '''
+    xmn, dx, ymn, dy = header.geotransform()
+    cells = {}
+    offsets = (np.arange(subsamples) + 0.5) / subsamples - 0.5
+    for rings in polygons:
+        ext = rings[0]
+        c0 = max(int(np.floor((ext[:, 0].min() - xmn) / dx + 0.5)), 0)
+        c1 = min(int(np.floor((ext[:, 0].max() - xmn) / dx + 0.5)), header.nx - 1)
+        r0 = max(int(np.floor((ext[:, 1].min() - ymn) / dy + 0.5)), 0)
+        r1 = min(int(np.floor((ext[:, 1].max() - ymn) / dy + 0.5)), header.ny - 1)
+        if c1 < c0 or r1 < r0:
+            continue
+
+        # Sample points inside each cell of the polygon's bounding box.
+        cols = np.arange(c0, c1 + 1)
+        rows = np.arange(r0, r1 + 1)
+        sx = (xmn + dx * (cols[:, None] + offsets[None, :])).ravel()
+        sy = (ymn + dy * (rows[:, None] + offsets[None, :])).ravel()
+        px, py = np.meshgrid(sx, sy)
+        points = np.column_stack([px.ravel(), py.ravel()])
+
+        inside = Path(ext).contains_points(points)
+        for hole in rings[1:]:
+            inside &= ~Path(hole).contains_points(points)
+
+        hits = inside.reshape(len(rows), subsamples, len(cols), subsamples).sum(axis=3).sum(axis=1)
+        rr, cc = np.nonzero(hits)
+        for r, c, n in zip(rr + r0, cc + c0, hits[rr, cc]):
+            k = int(r) * header.nx + int(c)
+            cells[k] = cells.get(k, 0.0) + float(n) / subsamples ** 2
+
+    keys = np.array(sorted(cells), dtype=np.int64)
+    return keys, np.minimum(np.array([cells[k] for k in keys]), 1.0)
+
+def zone_matrix(zones, header, subsamples=SUBSAMPLES):
+    '''
+    Build the sparse (cells, zones) matrix of covered areas (m^2).
+
+    zones: a list of WKT geometries, in the grid's projection.
+    '''
+    xmn, dx, ymn, dy = header.geotransform()
+    area = abs(dx * dy)
+    rows, cols, vals = [], [], []
+    for j, wkt in enumerate(zones):
+        keys, frac = coverage(parse_wkt(wkt), header, subsamples)
+        rows.append(keys)
+        cols.append(np.repeat(j, len(keys)))
+        vals.append(frac * area)
+    if rows:
+        rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    return sparse.csc_matrix((vals, (rows, cols)), shape=(header.nx * header.ny, len(zones)))
+
+def save_matrix(path, matrix, ids, names):
+    '''
+    Write a zone matrix and its zone ids/names to path (an .npz file).
+    '''
+    m = matrix.tocsc()
+    np.savez(path, data=m.data, indices=m.indices, indptr=m.indptr, shape=np.array(m.shape),
+             ids=np.array(ids, dtype=object), names=np.array(names, dtype=object))
+
+def load_matrix(path):
+    '''
+    Read a zone matrix written by save_matrix. Returns (matrix, ids, names).
+    '''
+    f = np.load(path)
+    try:
+        m = sparse.csc_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return m, list(f['ids']), list(f['names'])
+    finally:
+        f.close()
+
+def zone_totals(cube, matrix, first, last, undef=None, chunk=CHUNK_BANDS):
+    '''
+    Per-zone totals for bands first..last (inclusive) of a (time, ny, nx)
+    cube. No-data cells contribute nothing.
+
+    Returns a (days, zones) float64 array.
+    '''
+    if first < 0 or last >= cube.shape[0] or first > last:
+        raise IndexError('Bands {0}..{1} are not in the cube'.format(first, last))
+    ncells = cube.shape[1] * cube.shape[2]
+    # Only the cells some zone touches need to be read.
+    touched = np.unique(matrix.indices)
+    weights = matrix[touched, :]
+
+    out = []
+    for start in range(first, last + 1, chunk):
+        block = np.asarray(cube[start:min(start + chunk, last + 1)]).reshape(-1, ncells)[:, touched]
+        block = block.astype(np.float64)
+        bad = ~np.isfinite(block)
+        if undef is not None:
+            bad |= (block == undef)
+        block[bad] = 0
+        out.append(np.asarray((weights.T.dot(block.T)).T))
+    return np.vstack(out)